@@ -16,12 +16,13 @@ def list_to_readable(items):
     return '\n'.join(f"{i + 1}. {item}" for i, item in enumerate(items))
 
 def get_state_questioner(self):
+    answered_questions, notes = self.st.session_state.prompt_renderer.render(self.st.session_state)
     state = (
         "[Questioner] :\n\n"
         # f"Questions answered: {len(self.st.session_state.answered_questions)}. Notes: {len(self.st.session_state.notes)} "
         f"Questions:\n{list_to_readable(self.st.session_state.questions)}\n\n"
-        f"Answered Questions:\n{list_to_readable(self.st.session_state.answered_questions)}\n\n"
-        f"Notes:\n{list_to_readable(self.st.session_state.notes)}\n\n"
+        f"Answered Questions:\n{answered_questions}\n\n"
+        f"Notes:\n{notes}\n\n"
         # f"Previous Action and Thought: {list_to_readable(self.st.session_state.questions)}"
         
     )
@@ -29,101 +30,108 @@ def get_state_questioner(self):
     return HumanMessage(content=f"{state}")
 
 def get_state_researcher(self):
+    # under a token budget, the notes closest to the research question are the ones kept
+    question = self.st.session_state.questions[0]
+    answered_questions, notes = self.st.session_state.prompt_renderer.render(self.st.session_state, query=question)
     state = (
         "[Researcher] Self-Reflect:\n\n"
-        f"Research Question:\n{self.st.session_state.questions[0]}\n\n"
-        f"Answered Questions:\n{list_to_readable(self.st.session_state.answered_questions)}\n\n"
-        f"Notes:\n{list_to_readable(self.st.session_state.notes)}\n\n"
+        f"Research Question:\n{question}\n\n"
+        f"Answered Questions:\n{answered_questions}\n\n"
+        f"Notes:\n{notes}\n\n"
         # f"Previous Action and Thought: {list_to_readable(self.st.session_state.questions)}"
     )
 
     return HumanMessage(content=f"{state}")
 
 def get_state_builder(self):
+    # never trimmed, a note left out here is an event missing from the timeline
+    answered_questions, notes = self.st.session_state.prompt_renderer.render(self.st.session_state, trim=False)
     state = (
         "[Timeline Builder] Self-Reflect:\n\n"
-        f"Answered Questions:\n{list_to_readable(self.st.session_state.answered_questions)}\n\n"
-        f"Notes:\n{list_to_readable(self.st.session_state.notes)}\n\n"
+        f"Answered Questions:\n{answered_questions}\n\n"
+        f"Notes:\n{notes}\n\n"
     )
 
     return HumanMessage(content=f"{state}")
 
+class MessageLedger():
+    """Index of the tool calls still waiting for a response in the local llm log and of the latest
+    tool response seen per tool_call_id in the graph state. Both lists only ever grow between resets,
+    so each sync only looks at the messages appended since the previous one."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.source_seen = 0
+        self.responses = {} # tool_call_id -> most recent ToolMessage in the source list
+        self.target_seen = 0
+        self.pending = {} # tool_call_id -> tool call without a response in the target list, in call order
+
+    def sync_source(self, source_list):
+        if len(source_list) < self.source_seen:
+            self.source_seen = 0
+            self.responses = {}
+
+        for msg in source_list[self.source_seen:]:
+            if isinstance(msg, ToolMessage):
+                self.responses[msg.tool_call_id] = msg
+        self.source_seen = len(source_list)
+
+    def sync_target(self, target_list):
+        if len(target_list) < self.target_seen:
+            self.target_seen = 0
+            self.pending = {}
+
+        for msg in target_list[self.target_seen:]:
+            if isinstance(msg, AIMessage) and msg.tool_calls:
+                for tool_call in msg.tool_calls:
+                    self.pending[tool_call['id']] = tool_call
+            elif isinstance(msg, ToolMessage):
+                self.pending.pop(msg.tool_call_id, None)
+        self.target_seen = len(target_list)
+
 # This function is to jerry rig the inability for langgraph to reset its message state
 # we maintain our own state and have full control of it
-def copy_tool_output_over(source_list, target_list):
+def copy_tool_output_over(source_list, target_list, ledger=None):
     """
     Copies the most recent tool responses from source_list to target_list.
-    Handles duplicate tool calls by considering their position in the message chain.
+    Only tool calls in target_list that don't have a response yet are filled in.
     
     Args:
         source_list: List containing all messages including tool responses
         target_list: List containing messages that need corresponding tool responses
+        ledger: MessageLedger kept across calls, so only newly appended messages are scanned.
+            It must be reset whenever target_list is replaced. Without one, both lists are scanned once.
     """
-    # Find all tool calls in the target list and track which ones already have responses
-    pending_tool_calls = []
-    existing_responses = {}  # Maps (tool_call_id, call_position) to response count
-    
-    # First pass: collect existing tool responses and their positions
-    call_position = 0
-    for msg in target_list:
-        if isinstance(msg, AIMessage) and msg.tool_calls:
-            for tool_call in msg.tool_calls:
-                key = (tool_call['id'], call_position)
-                call_position += 1
-                existing_responses[key] = 0
-                
-        if isinstance(msg, ToolMessage):
-            # Find the corresponding call position
-            for (call_id, pos), count in existing_responses.items():
-                if call_id == msg.tool_call_id:
-                    existing_responses[(call_id, pos)] = count + 1
-                    break
-    
-    # Second pass: collect pending tool calls that need more responses
-    call_position = 0
-    for msg in target_list:
-        if isinstance(msg, AIMessage) and msg.tool_calls:
-            for tool_call in msg.tool_calls:
-                key = (tool_call['id'], call_position)
-                # If this call has fewer responses than it should, add it to pending
-                if existing_responses[key] < 1:  # Adjust if tool calls can have multiple responses
-                    pending_tool_calls.append((tool_call, call_position))
-                call_position += 1
-    
-    if not pending_tool_calls:
+    if ledger is None:
+        ledger = MessageLedger()
+
+    ledger.sync_source(source_list)
+    ledger.sync_target(target_list)
+
+    if not ledger.pending:
         return  # No new tool calls to process
-    
-    # Find matching tool responses in source list, starting from the end
+
     tool_responses = []
-    source_responses_used = set()  # Track which responses we've already used
-    
-    for msg in reversed(source_list):
-        if isinstance(msg, ToolMessage):
-            # Generate a unique identifier for this response
-            response_id = (msg.tool_call_id, msg.content, id(msg))
-            
-            if response_id not in source_responses_used:
-                # Check if this tool response matches any pending tool call
-                for (tool_call, pos) in pending_tool_calls[:]:  # Use slice to allow removal
-                    if (tool_call['id'] == msg.tool_call_id and 
-                        tool_call['name'] == msg.name):
-                        tool_responses.append(msg)
-                        source_responses_used.add(response_id)
-                        pending_tool_calls.remove((tool_call, pos))
-                        break
-        
-        if not pending_tool_calls:
-            break  # Found all needed tool responses
-    
-    # Append only the new tool responses to target list in correct order
-    target_list.extend(reversed(tool_responses))
+    for call_id, tool_call in list(ledger.pending.items()):
+        msg = ledger.responses.get(call_id)
+        if msg is not None and msg.name == tool_call['name']:
+            tool_responses.append(msg)
+            del ledger.pending[call_id]
+
+    # Append only the new tool responses to target list in call order
+    target_list.extend(tool_responses)
+    ledger.target_seen = len(target_list)
 
 class Questioner(Assistant):
-    def __init__(self, st=None, stream_callback=None):
+    def __init__(self, st=None, stream_callback=None, llm=None):
         self.name = "questioner"
-        super().__init__(st, stream_callback, tool_set=self.name)
+        super().__init__(st, stream_callback, tool_set=self.name, llm=llm)
 
-        self.system_prompt = (
+    @property
+    def system_prompt(self):
+        # built on every use, an agent shared by every session can outlive the date in it
+        return (
             "You are a timeline researcher. "
             "Your will call ask_questions to produce concise questions appropriate to the user's prompt that can be researched online. "
             "If no more questions are needed, you will NOT call ask_questions, and will simply output 'done'. "
@@ -136,28 +144,29 @@ class Questioner(Assistant):
     def get_state(self):
         return get_state_questioner(self)
 
-    def __call__(self, state: State, config: RunnableConfig):
+    def prepare_state(self, state):
         # tool results appear in the state here for some reason, we need it to show up in the local llm log
-        copy_tool_output_over(state['messages'], self.st.session_state.llm_state['messages'])
-        
-        state = self.st.session_state.llm_state
+        copy_tool_output_over(state['messages'], self.st.session_state.llm_state['messages'], self.st.session_state.message_ledger)
         
         print("!!! questions", "\n\t --> " + "\n\t --> ".join(self.st.session_state.questions), "\n")
         print("!!! answered_questions", "\n\t --> " + "\n\t --> ".join(self.st.session_state.answered_questions), "\n")
         print("!!! notes", "\n\t --> " + "\n\t --> ".join(self.st.session_state.notes), "\n")
 
-        return super().__call__(state, config)
+        return super().prepare_state(self.st.session_state.llm_state)
 
 
 class Researcher(Assistant):
-    def __init__(self, st=None, stream_callback=None):
+    def __init__(self, st=None, stream_callback=None, llm=None):
         self.name = "researcher"
-        super().__init__(st, stream_callback, tool_set=self.name)
+        super().__init__(st, stream_callback, tool_set=self.name, llm=llm)
 
-        self.system_prompt = (
+    @property
+    def system_prompt(self):
+        return (
             "You are a timeline researcher. "
             "You will be assigned a research question. "
             "Your job is to search online to answer your assigned question. You may search up to 3 times. "
+            "Before searching online, call search_fetched to check the pages already fetched for earlier questions, only search online if it doesn't answer your question. "
             "After searching, you will log dates found into your notes to place it in persistent memory. "
             # "You MUST ONLY log extremely important dates, since note logging is expensive. "
             "Your log MUST follow this format -> (MM-DD-YYYY): <note>. "
@@ -170,20 +179,20 @@ class Researcher(Assistant):
     def get_state(self):
         return get_state_researcher(self)
 
-    def __call__(self, state: State, config: RunnableConfig):
+    def prepare_state(self, state):
         # tool results appear in the state here for some reason, we need it to show up in the local llm log
-        copy_tool_output_over(state['messages'], self.st.session_state.llm_state['messages'])
+        copy_tool_output_over(state['messages'], self.st.session_state.llm_state['messages'], self.st.session_state.message_ledger)
 
-        state = self.st.session_state.llm_state
-        
-        return super().__call__(state, config)
+        return super().prepare_state(self.st.session_state.llm_state)
 
 class Builder(Assistant):
-    def __init__(self, st=None, stream_callback=None):
+    def __init__(self, st=None, stream_callback=None, llm=None):
         self.name = "builder"
-        super().__init__(st, stream_callback, tool_set=self.name)
+        super().__init__(st, stream_callback, tool_set=self.name, llm=llm)
 
-        self.system_prompt = (
+    @property
+    def system_prompt(self):
+        return (
             "You are a timeline builder. "
             "You will take the provided notes and questions/answers and builder an event timeline. "
             "You will build a list of events in chronological order. "
@@ -195,10 +204,8 @@ class Builder(Assistant):
     def get_state(self):
         return get_state_builder(self)
 
-    def __call__(self, state: State, config: RunnableConfig):
+    def prepare_state(self, state):
         # tool results appear in the state here for some reason, we need it to show up in the local llm log
-        copy_tool_output_over(state['messages'], self.st.session_state.llm_state['messages'])
+        copy_tool_output_over(state['messages'], self.st.session_state.llm_state['messages'], self.st.session_state.message_ledger)
 
-        state = self.st.session_state.llm_state
-        
-        return super().__call__(state, config)
\ No newline at end of file
+        return super().prepare_state(self.st.session_state.llm_state)
\ No newline at end of file
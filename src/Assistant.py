@@ -1,46 +1,78 @@
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain_core.prompts import ChatPromptTemplate
+# the LLM clients (langchain_openai, langchain_anthropic) are imported where the model is created,
+# they pull in their whole SDKs and are the slowest part of a cold start
 from langchain_core.runnables import Runnable, RunnableConfig
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage, message_chunk_to_message
 from langgraph.graph.message import add_messages, AnyMessage
-from langchain.agents import initialize_agent, Tool
 
 from typing import Annotated, Dict, Optional, TypedDict
 from typing_extensions import TypedDict
 
-import streamlit as st
-
 import datetime
+import threading
 
 from Tools import Tools
+from SearchCache import get_search_cache
+import ResponseCache
+import Tracing
 
 class State(TypedDict):
     messages: Annotated[list[AnyMessage], add_messages] = []
 
-class Assistant:
-    def __init__(self, st=None, stream_callback=None, tool_set="questioner"):
-        self.stream_callback = stream_callback
-        self.st = st
+def build_llm(secrets, temperature=None):
+    # CAUTION: if you plan on enable ollama, you MUST enable the helper for it, search within the project 'convert_tool_messages'
+    # llm = ChatOllama(model="llama3.2")
+
+    # CONFIGURABLE BLOCK: you can disable whichever LLM if you have the API key
+
+    # you can use 'gpt-4o' if you are rich lol
+    from langchain_openai import ChatOpenAI
+    api_key = secrets["OPENAI_API_KEY"]
+    # stream_usage keeps token counts coming when responses are streamed
+    llm = ChatOpenAI(model="gpt-4o-mini", api_key=api_key, temperature=temperature, stream_usage=True)  # Replace with your API key
+
+    # you can use 'claude-3-5-sonnet-latest' if you are rich lol
+    # from langchain_anthropic import ChatAnthropic
+    # api_key = secrets["ANTHROPIC_API_KEY"]
+    # llm = ChatAnthropic(model="claude-3-5-haiku-latest", api_key=api_key)  # Replace with your API key
 
-        # CAUTION: if you plan on enable ollama, you MUST enable the helper for it, search within the project 'convert_tool_messages'
-        # llm = ChatOllama(model="llama3.2")
+    return llm
 
-        # CONFIGURABLE BLOCK: you can disable whichever LLM if you have the API key
+_chat_models = {}
+_chat_models_lock = threading.Lock()
 
-        # you can use 'gpt-4o' if you are rich lol
-        api_key = st.secrets["OPENAI_API_KEY"]
-        llm = ChatOpenAI(model="gpt-4o-mini", api_key=api_key)  # Replace with your API key
+def get_chat_model(secrets, temperature=None):
+    """One client, and with it one HTTP connection pool, per API key and temperature for the whole process"""
+    key = (secrets["OPENAI_API_KEY"], secrets["ANTHROPIC_API_KEY"], temperature)
+    with _chat_models_lock:
+        if key not in _chat_models:
+            _chat_models[key] = build_llm(secrets, temperature)
+        return _chat_models[key]
 
-        # you can use 'claude-3-5-sonnet-latest' if you are rich lol
-        # api_key = st.secrets["ANTHROPIC_API_KEY"]
-        # llm = ChatAnthropic(model="claude-3-5-haiku-latest", api_key=api_key)  # Replace with your API key
+class Assistant:
+    def __init__(self, st=None, stream_callback=None, tool_set="questioner", llm=None):
+        self.stream_callback = stream_callback
+        self.st = st
+        self.tool_set = tool_set
+
+        # a chat model passed in (ex. a scripted one for benchmarks) skips the configurable block
+        if llm is None:
+            llm = get_chat_model(self.st.secrets, self.st.options.get('temperature'))
 
         self.llm = llm
         self.tools = Tools(st=self.st, assistant=llm, tool_set=tool_set)
         self.runnable = self.tools.get_assistant()
 
+        # responses are only cached for deterministic models, and only for sessions with llm_cache on, see ResponseCache.py
+        self.response_cache = None
+        if ResponseCache.cacheable(llm):
+            self.response_cache = get_search_cache()
+            self.model_name = ResponseCache.model_name_of(llm)
+            self.tool_schemas = ResponseCache.tool_schemas(self.tools.tools)
+
+    def get_stream_callback(self):
+        # a shared agent streams to the session it is working for, sub-run sessions don't stream
+        return self.stream_callback or getattr(self.st, 'stream_callback', None)
+
     def convert_messages_for_llm(self, messages, provider="anthropic"):
         """
         Converts message format between OpenAI and Anthropic styles.
@@ -191,11 +223,160 @@ class Assistant:
         
         state['messages'] = cleaned_messages
 
-    def __call__(self, state: State, config: RunnableConfig):
+    def prepare_state(self, state):
         state['messages'] = self.st.session_state.llm_state['messages']
         state = self.st.session_state.llm_state
 
         self.clean_messages(state)
+        return state
+
+    def cached_response(self, messages):
+        """Returns (key, cached response or None), the key is None when responses aren't cached"""
+        if self.response_cache is None or not self.st.options.get('llm_cache'):
+            return None, None
+        # a replay is served from the cassette alone, it doesn't depend on or change what is cached
+        cassette = self.st.options.get('cassette')
+        if cassette and cassette.replaying:
+            return None, None
+
+        key = ResponseCache.response_key(self.model_name, self.tool_schemas, messages)
+        value, _ = self.response_cache.get('llm', key)
+        if value is None:
+            return key, None
+
+        result = ResponseCache.load_response(value)
+        result.response_metadata['llm_cache_hit'] = True
+        if cassette:
+            cassette.observe_llm(self.tool_set, messages, result)
+        return key, result
+
+    def emit(self, content):
+        stream_callback = self.get_stream_callback()
+        if stream_callback and content and isinstance(content, str):
+            stream_callback(content)
+
+    def stream_invoke(self, messages):
+        """Calls the LLM, with a stream_callback the response is streamed and every text delta forwarded as it arrives"""
+        if not self.get_stream_callback():
+            return self.runnable.invoke(messages)
+
+        # chunks add up into one message, tool call chunks are merged by index and parsed at the end
+        result = None
+        for chunk in self.runnable.stream(messages):
+            self.emit(chunk.content)
+            result = chunk if result is None else result + chunk
+        if result is None:
+            # a stream that ends before its first chunk, the plain request gives a whole (maybe empty) message
+            # that accept_result can re-prompt on
+            return self.runnable.invoke(messages)
+        return message_chunk_to_message(result)
+
+    async def astream_invoke(self, messages):
+        if not self.get_stream_callback():
+            return await self.runnable.ainvoke(messages)
+
+        result = None
+        async for chunk in self.runnable.astream(messages):
+            self.emit(chunk.content)
+            result = chunk if result is None else result + chunk
+        if result is None:
+            return await self.runnable.ainvoke(messages)
+        return message_chunk_to_message(result)
+
+    def invoke(self, messages):
+        with Tracing.span("llm", kind="llm", agent=self.tool_set, messages=len(messages)) as span:
+            result = self.request(messages)
+            self.trace_result(span, result)
+            return result
+
+    async def ainvoke(self, messages):
+        with Tracing.span("llm", kind="llm", agent=self.tool_set, messages=len(messages)) as span:
+            result = await self.arequest(messages)
+            self.trace_result(span, result)
+            return result
+
+    def trace_result(self, span, result):
+        usage = result.usage_metadata or {}
+        span.set_attributes(
+            input_tokens=usage.get('input_tokens', 0),
+            output_tokens=usage.get('output_tokens', 0),
+            cache_hit=result.response_metadata.get('llm_cache_hit', False),
+            tool_calls=[tool_call['name'] for tool_call in result.tool_calls],
+        )
+
+    def request(self, messages):
+        # cached and replayed responses never reach the LLM, they are forwarded to stream_callback in one piece
+        key, result = self.cached_response(messages)
+        if result is not None:
+            return self.finish_request(None, result, streamed=False)
+
+        calls = []
+        def call_llm(messages):
+            calls.append(messages)
+            return self.stream_invoke(messages)
+
+        # with a cassette attached the request is recorded, or served back from a recording
+        cassette = self.st.options.get('cassette')
+        if cassette:
+            result = cassette.invoke(self.tool_set, messages, call_llm)
+        else:
+            result = call_llm(messages)
+        return self.finish_request(key, result, streamed=bool(calls))
+
+    async def arequest(self, messages):
+        key, result = self.cached_response(messages)
+        if result is not None:
+            return self.finish_request(None, result, streamed=False)
+
+        calls = []
+        async def call_llm(messages):
+            calls.append(messages)
+            return await self.astream_invoke(messages)
+
+        cassette = self.st.options.get('cassette')
+        if cassette:
+            result = await cassette.ainvoke(self.tool_set, messages, call_llm)
+        else:
+            result = await call_llm(messages)
+        return self.finish_request(key, result, streamed=bool(calls))
+
+    def finish_request(self, key, result, streamed):
+        """Shared tail of request and arequest, emits a response that wasn't streamed and caches it under key"""
+        if not streamed:
+            self.emit(result.content)
+        if key is not None:
+            self.response_cache.set('llm', key, ResponseCache.dump_response(result))
+        return result
+
+    def accept_result(self, result):
+        """Records token usage, returns False if the LLM gave an empty response and has to be re-prompted"""
+        # a cached response costs nothing, its tokens are counted as saved instead
+        cache_hit = result.response_metadata.get('llm_cache_hit', False)
+        if cache_hit:
+            self.st.session_state.llm_cache_hits += 1
+        try:
+            if cache_hit:
+                self.st.session_state.llm_cache_input_tokens_saved += result.usage_metadata['input_tokens']
+                self.st.session_state.llm_cache_output_tokens_saved += result.usage_metadata['output_tokens']
+            else:
+                self.st.session_state.input_tokens += result.usage_metadata['input_tokens']
+                self.st.session_state.output_tokens += result.usage_metadata['output_tokens']
+        except Exception as e:
+            print(f"An error occurred: {str(e)}")
+
+        return bool(result.tool_calls) or not (
+            not result.content
+            or isinstance(result.content, list)
+            and not result.content[0].get("text")
+        )
+
+    def finish(self, state, result):
+        state['messages'] += [result]
+        # print("--->", "RETURNING RESULT", result)
+        return self.st.session_state.llm_state
+
+    def __call__(self, state: State, config: RunnableConfig):
+        state = self.prepare_state(state)
 
         # print("--->", "ASSISTANT CALL")
         while True:
@@ -209,35 +390,29 @@ class Assistant:
             invoke_input = state['messages'] # use this for well behaved models like chatgpt
             # invoke_input = self.convert_tool_messages(state['messages']) # we have to do this for ollama models because there is a bug where seeing ToolMessage will confuse it
 
-            result = self.runnable.invoke(invoke_input)
+            result = self.invoke(invoke_input)
 
-            # print("--->", "INVOKING DONE")
             # If the LLM happens to return an empty response, we will re-prompt it
             # for an actual response.
-            # print("--->", "LLM RESPONSE:", result.content)
-            # print("--->", "LLM TOOL CALLS:", result.tool_calls)
+            if self.accept_result(result):
+                break
 
-            try:
-                self.st.session_state.input_tokens += result.usage_metadata['input_tokens']
-                self.st.session_state.output_tokens += result.usage_metadata['output_tokens']
-            except Exception as e:
-                print(f"An error occurred: {str(e)}")
-            
-            if not result.tool_calls and (
-                not result.content
-                or isinstance(result.content, list)
-                and not result.content[0].get("text")
-            ):
-                # print("--->", "MODIFYING STATE", state)
-                messages = state["messages"] + [HumanMessage(content="Provide a nonempty response.")]
-                state = {**state, "messages": messages}
-            else:
-                # print("--->", "ELSE STATEMENT")
+            messages = state["messages"] + [HumanMessage(content="Provide a nonempty response.")]
+            state = {**state, "messages": messages}
+
+        return self.finish(state, result)
+
+    async def acall(self, state: State, config: RunnableConfig):
+        """Async twin of __call__, lets the graph run under astream without blocking the event loop"""
+        state = self.prepare_state(state)
+
+        while True:
+            result = await self.ainvoke(state['messages'])
+
+            if self.accept_result(result):
                 break
 
-        if self.stream_callback and result.content:
-            self.stream_callback(result.content)
+            messages = state["messages"] + [HumanMessage(content="Provide a nonempty response.")]
+            state = {**state, "messages": messages}
 
-        state['messages'] += [result]
-        # print("--->", "RETURNING RESULT", result)
-        return self.st.session_state.llm_state
\ No newline at end of file
+        return self.finish(state, result)
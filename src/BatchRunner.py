@@ -0,0 +1,333 @@
+"""
+Headless batch runner, generates a timeline for every prompt of a JSONL file across a pool of worker processes.
+
+Each input line is {"id": "...", "prompt": "..."} (id defaults to the line number). Each output line is
+{"id", "prompt", "status", "stop_reason", "timeline", "metrics", "latency", "elapsed", "error"} with status "ok", "timeout"
+or "error". stop_reason says why the research ended, ex. max_questions or the budget (--max-tokens, --max-cost,
+--max-seconds, --max-calls) that ran out first, see Budget.py.
+Jobs already finished with status "ok" in the output file are skipped, so an interrupted run can simply be restarted.
+
+--record DIR saves the LLM and search traffic of every job to DIR/<id>.json.gz, --replay DIR serves it back
+without any network requests (any OPENAI_API_KEY value will do), see Cassette.py.
+--trace DIR writes a tracing span log of every job to DIR/<id>.jsonl, see Tracing.py.
+
+Secrets come from the environment (OPENAI_API_KEY, optionally BLACKLIST_SEARCH_TERMS as a JSON list),
+then .streamlit/secrets.toml, or only from the TOML file given with --secrets.
+
+    python src/BatchRunner.py prompts.jsonl timelines.jsonl --workers 4 --timeout 900
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import sys
+import threading
+import time
+
+# seconds a worker gets after its soft timeout to wind down before it is killed
+KILL_GRACE = 30
+
+# workers in a row that may exit before they are ready, ex. on bad secrets, before the run gives up
+STARTUP_FAILURES = 3
+
+def read_jobs(path):
+    jobs = []
+    lines = {} # id -> line it was first seen on
+    with open(path) as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            job_id = str(job.get("id", line_number))
+            # results are matched to jobs by id, and an id that is already done is skipped
+            if job_id in lines:
+                raise ValueError(f"{path}:{line_number} repeats the job id {job_id!r} of line {lines[job_id]}")
+            lines[job_id] = line_number
+            jobs.append({"id": job_id, "prompt": job["prompt"]})
+    return jobs
+
+def read_finished(path):
+    """Ids already written to the output file with status ok"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # a partially written last line from an interrupted run
+            if record.get("status") == "ok":
+                finished.add(str(record["id"]))
+    return finished
+
+def collect_metrics(session_state):
+    # every plain counter of the session state, tokens, api calls, cache hits, ...
+    return {
+        key: value for key, value in session_state._dict.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+def job_path(directory, job_id, extension):
+    return os.path.join(directory, re.sub(r"[^\w.-]", "_", job_id) + extension)
+
+def run_job(graph, job, timeout, cassette=None, trace_dir=None):
+    """Runs one prompt to completion, a timer aborts the graph gracefully once the timeout is reached"""
+    if cassette:
+        from Cassette import Cassette
+        directory, mode = cassette
+        graph.st.options['cassette'] = Cassette(job_path(directory, job["id"], ".json.gz"), mode=mode)
+    if trace_dir:
+        import Tracing
+        graph.tracer = Tracing.Tracer(Tracing.JsonlExporter(job_path(trace_dir, job["id"], ".jsonl")))
+
+    timer = threading.Timer(timeout, graph.abort)
+    timer.daemon = True
+
+    start = time.time()
+    status, error = "ok", None
+    timer.start()
+    try:
+        graph.call(job["prompt"])
+        if graph.aborted:
+            status = "timeout"
+    except Exception as e:
+        status, error = "error", f"{type(e).__name__}: {e}"
+    finally:
+        timer.cancel()
+
+    messages = graph.st.session_state.llm_state["messages"]
+    timeline = messages[-1].content if status == "ok" and messages else None
+
+    return {
+        "id": job["id"],
+        "prompt": job["prompt"],
+        "status": status,
+        "stop_reason": graph.st.session_state.stop_reason,
+        "timeline": timeline,
+        "metrics": collect_metrics(graph.st.session_state),
+        "latency": graph.st.session_state.metrics.to_json(),
+        "elapsed": round(time.time() - start, 3),
+        "error": error,
+    }
+
+def worker_main(tasks, results, graph_options, secrets_path, timeout, verbose, cassette, trace_dir):
+    # the graph is built once per worker and reused across jobs, call() resets its state
+    from ModelGraph import AgentGraph
+    from Config import TomlSecrets, resolve_secrets
+
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            # the agents print their whole reasoning, which would drown the progress output
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+
+        secrets = resolve_secrets(TomlSecrets(secrets_path) if secrets_path else None)
+        graph = AgentGraph(model_name="TimelineGPT", secrets=secrets, **graph_options)
+        results.send(("ready", None, None))
+        while True:
+            try:
+                job = tasks.recv()
+            except EOFError:
+                return # the pool is gone
+            if job is None:
+                return
+            results.send(("start", job["id"], None))
+            results.send(("done", job["id"], run_job(graph, job, timeout, cassette, trace_dir)))
+
+class WorkerPool():
+    """Worker processes that get one job at a time, so the pool always knows which job a worker holds.
+    Jobs only go to workers that are ready, their startup doesn't count against the timeout.
+    A worker that overruns its job's timeout is killed and replaced, so is one that dies.
+
+    Every worker has a pipe of its own each way. With one queue shared by all workers, a worker that died while
+    writing to it would hold its lock forever and silence every other worker."""
+    worker = staticmethod(worker_main) # runs in every worker process, gets its two pipe ends then worker_args
+
+    def __init__(self, size, graph_options, timeout, secrets_path=None, verbose=False, cassette=None, trace_dir=None):
+        self.context = multiprocessing.get_context("spawn")
+        self.worker_args = (graph_options, secrets_path, timeout, verbose, cassette, trace_dir)
+        self.timeout = timeout
+
+        self.workers = {} # pid -> (process, task pipe, result pipe)
+        self.ready = set() # pids of workers done starting up
+        self.assigned = {} # pid -> (job id, started at), ready workers without an entry are idle
+        self.startup_failures = 0
+        for _ in range(size):
+            self.spawn()
+
+    def spawn(self):
+        tasks_out, tasks_in = self.context.Pipe(duplex=False)
+        results_out, results_in = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=self.worker, args=(tasks_out, results_in) + self.worker_args, daemon=True)
+        process.start()
+        # the worker has its own copies, the pool only keeps its ends
+        tasks_out.close()
+        results_in.close()
+        self.workers[process.pid] = (process, tasks_in, results_out)
+
+    def remove(self, pid):
+        process, tasks, results = self.workers.pop(pid)
+        tasks.close()
+        results.close()
+        self.assigned.pop(pid, None)
+        self.ready.discard(pid)
+
+    def receive(self, timeout):
+        """(pid, kind, job id, payload) of every message the workers sent, waits up to timeout for the first one"""
+        pids = {results: pid for pid, (_, _, results) in self.workers.items()}
+        messages = []
+        for results in multiprocessing.connection.wait(list(pids), timeout=timeout):
+            try:
+                while results.poll():
+                    messages.append((pids[results],) + results.recv())
+            except (EOFError, OSError):
+                pass # the worker is gone, the liveness check below deals with it
+        return messages
+
+    def run(self, jobs, on_result):
+        outstanding = {} # job id -> job, until its one result is reported
+        for job in jobs:
+            if job["id"] in outstanding:
+                raise ValueError(f"duplicate job id {job['id']!r}")
+            outstanding[job["id"]] = job
+        pending = list(reversed(jobs))
+
+        def settle(job_id, record):
+            # a job is reported once, ex. the result of a worker killed for being overdue that arrives anyway is dropped
+            if outstanding.pop(job_id, None) is not None:
+                on_result(record)
+
+        while outstanding:
+            for pid, (_, tasks, _) in self.workers.items():
+                if pid in self.ready and pid not in self.assigned and pending:
+                    job = pending.pop()
+                    self.assigned[pid] = (job["id"], time.time())
+                    tasks.send(job)
+
+            # everything that arrived is handled before any worker is judged overdue or dead
+            for pid, kind, job_id, payload in self.receive(timeout=1):
+                if kind == "ready":
+                    self.ready.add(pid)
+                    self.startup_failures = 0
+                elif kind == "start":
+                    # the clock starts when the worker actually starts, not when the job was sent to it
+                    if self.assigned.get(pid, (None,))[0] == job_id:
+                        self.assigned[pid] = (job_id, time.time())
+                else:
+                    if self.assigned.get(pid, (None,))[0] == job_id:
+                        del self.assigned[pid]
+                    settle(job_id, payload)
+
+            # hard timeouts and dead workers, whatever job they held is recorded and the worker replaced
+            for pid, (process, _, _) in list(self.workers.items()):
+                job_id, started = self.assigned.get(pid, (None, None))
+                # a worker that died is an error even if it was past its time as well
+                died = not process.is_alive()
+                overdue = not died and job_id is not None and time.time() - started > self.timeout + KILL_GRACE
+                if not overdue and not died:
+                    continue
+
+                if overdue:
+                    process.kill()
+                process.join()
+                was_ready = pid in self.ready
+                self.remove(pid)
+                if not was_ready:
+                    self.startup_failures += 1
+                    if self.startup_failures >= STARTUP_FAILURES:
+                        raise RuntimeError(f"{self.startup_failures} workers in a row exited with code {process.exitcode} before they were ready")
+                self.spawn()
+
+                if job_id not in outstanding:
+                    continue # an idle worker, or its job was already reported
+                settle(job_id, {
+                    "id": job_id,
+                    "prompt": outstanding[job_id]["prompt"],
+                    "status": "timeout" if overdue else "error",
+                    "stop_reason": None,
+                    "timeline": None,
+                    "metrics": {},
+                    "latency": None,
+                    "elapsed": round(time.time() - started, 3),
+                    "error": None if overdue else f"worker exited with code {process.exitcode}",
+                })
+
+    def close(self):
+        for _, tasks, _ in self.workers.values():
+            try:
+                tasks.send(None)
+            except OSError:
+                pass # already gone
+        for process, _, _ in self.workers.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate timelines for every prompt of a JSONL file.")
+    parser.add_argument("input", help="JSONL file of {\"id\", \"prompt\"} objects")
+    parser.add_argument("output", help="JSONL file results are appended to, finished jobs in it are skipped")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--timeout", type=float, default=900, help="seconds per job before it is aborted")
+    parser.add_argument("--max-questions", type=int, default=5)
+    parser.add_argument("--max-notes", type=int, default=5)
+    parser.add_argument("--recursion-depth", type=int, default=100)
+    parser.add_argument("--research-width", type=int, default=1)
+    parser.add_argument("--max-tokens", type=int, help="token budget per job, the run winds down to the timeline once it is spent")
+    parser.add_argument("--max-cost", type=float, help="dollar budget per job")
+    parser.add_argument("--max-seconds", type=float, help="wall-clock budget per job, unlike --timeout the timeline still gets written")
+    parser.add_argument("--max-calls", type=int, help="budget of non cached search calls per job")
+    parser.add_argument("--secrets", help="secrets.toml to read instead of the environment")
+    parser.add_argument("--verbose", action="store_true", help="keep the agents' printed output")
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument("--record", metavar="DIR", help="record every job's LLM and search traffic to a cassette in DIR")
+    recording.add_argument("--replay", metavar="DIR", help="replay every job from its cassette in DIR instead of the network")
+    parser.add_argument("--trace", metavar="DIR", help="write a tracing span log of every job to DIR")
+    args = parser.parse_args(argv)
+
+    jobs = read_jobs(args.input)
+    finished = read_finished(args.output)
+    pending = [job for job in jobs if job["id"] not in finished]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to run on {args.workers} workers")
+    if not pending:
+        return
+
+    graph_options = {
+        "max_questions": args.max_questions,
+        "max_notes": args.max_notes,
+        "recursion_depth": args.recursion_depth,
+        "research_width": args.research_width,
+    }
+    if any(limit is not None for limit in (args.max_tokens, args.max_cost, args.max_seconds, args.max_calls)):
+        from Budget import Budget
+        graph_options["budget"] = Budget(max_tokens=args.max_tokens, max_cost=args.max_cost, max_seconds=args.max_seconds, max_calls=args.max_calls)
+
+    cassette = None
+    if args.record:
+        cassette = (args.record, "record")
+    elif args.replay:
+        cassette = (args.replay, "replay")
+
+    done = 0
+    with open(args.output, "a") as output:
+        def on_result(record):
+            nonlocal done
+            done += 1
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            print(f"[{done}/{len(pending)}] {record['id']}: {record['status']} in {record['elapsed']:.1f}s")
+
+        pool = WorkerPool(min(args.workers, len(pending)), graph_options, args.timeout, secrets_path=args.secrets, verbose=args.verbose, cassette=cassette, trace_dir=args.trace)
+        try:
+            pool.run(pending, on_result)
+        finally:
+            pool.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
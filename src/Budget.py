@@ -0,0 +1,57 @@
+"""
+Budget of a research run: tokens, dollars, wall-clock seconds and external search calls.
+
+AgentGraph checks the budget in every edge function. Once one of them is nearly spent the run winds down to the
+builder, which still writes the timeline from what was found so far, and session_state.stop_reason names the budget.
+Budgets are checked between nodes and between the steps of a sub-run, against the main state plus every sub-run of
+the research batch in flight, so only the steps already running can overshoot. The reserve fraction of the token,
+dollar and time budgets is kept for that and for the builder's own turn, the builder makes no searches.
+"""
+import time
+
+from Config import estimate_cost
+
+# searches counted against max_calls, cache hits and coalesced searches are subtracted since they never leave the process
+SEARCH_COUNTERS = ['wikipedia_deep_calls', 'wikipedia_shallow_calls', 'DDGS_calls', 'arxiv_calls']
+
+RESERVED = ('tokens', 'cost', 'seconds')
+
+class Budget():
+    def __init__(self, max_tokens=None, max_cost=None, max_seconds=None, max_calls=None, reserve=0.1):
+        self.limits = {
+            'tokens': max_tokens,
+            'cost': max_cost, # USD, priced with Config.PRICING
+            'seconds': max_seconds,
+            'calls': max_calls,
+        }
+        self.reserve = reserve
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def usage(self, model_name, *session_states):
+        """What the run has spent so far, summed over the main state and any unmerged sub-run states"""
+        input_tokens = sum(state.input_tokens for state in session_states)
+        output_tokens = sum(state.output_tokens for state in session_states)
+        searches = sum(state[counter] for state in session_states for counter in SEARCH_COUNTERS)
+        cache_hits = sum(state.web_call_cache_hits + state.web_call_coalesced for state in session_states)
+        return {
+            'tokens': input_tokens + output_tokens,
+            'cost': estimate_cost(model_name, input_tokens, output_tokens),
+            'seconds': time.monotonic() - self.started if self.started is not None else 0.0,
+            'calls': searches - cache_hits,
+        }
+
+    def report(self, model_name, *session_states):
+        """(used, limit) of every budget that has a limit"""
+        used = self.usage(model_name, *session_states)
+        return {name: (used[name], limit) for name, limit in self.limits.items() if limit is not None}
+
+    def exhausted(self, model_name, *session_states):
+        """Name of the first budget that is spent down to its reserve, None while every budget has room left"""
+        for name, (used, limit) in self.report(model_name, *session_states).items():
+            threshold = limit * (1 - self.reserve) if name in RESERVED else limit
+            if used >= threshold:
+                return name
+        return None
@@ -0,0 +1,213 @@
+"""
+Record/replay of LLM and search traffic, so a full research run can be profiled or regression tested offline.
+
+In record mode every LLM response and search backend result is stored under a stable hash of its normalized input,
+in replay mode the stored responses are served back instead (with the recorded latency scaled by latency_scale),
+so a run makes no network requests and costs nothing. Identical inputs seen several times are served back in order.
+LLM requests also get a loose key that ignores what the tools returned, it is used when the exact key misses,
+ex. search_fetched answers depend on the order concurrent researchers fetched pages in. Such a response was recorded
+against different search results, every one served is counted (loose_hits) and printed as a warning.
+A replaying cassette bypasses the search and LLM response caches, it neither reads nor writes them. While recording,
+responses served by those caches are recorded too (observe, observe_llm), so the recording replays without them.
+
+    cassette = Cassette("runs/wwii.json.gz", mode="record")
+    AgentGraph(cassette=cassette).call("Timeline of WW2")  # saved when the call finishes
+    AgentGraph(cassette=Cassette("runs/wwii.json.gz", mode="replay")).call("Timeline of WW2")
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from langchain_core.messages import message_to_dict, messages_from_dict
+
+CASSETTE_VERSION = 1
+
+# the system prompts embed the current date and time, which would otherwise change every key
+VOLATILE = [
+    (re.compile(r"\d{2}-\d{2}-\d{4} \(MM-DD-YY\)"), "<date>"),
+    (re.compile(r"\d{2}:\d{2} [AP]M"), "<time>"),
+]
+
+class CassetteMiss(KeyError):
+    """Replay was asked for a request that was never recorded"""
+
+def normalize_text(text):
+    if not isinstance(text, str):
+        text = json.dumps(text, sort_keys=True)
+    for pattern, replacement in VOLATILE:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+def normalize_message(message, loose=False):
+    # ids (message and tool call ids) are left out, they are random for every real request
+    content = "" if loose and message.type == "tool" else normalize_text(message.content)
+    normalized = {"type": message.type, "content": content}
+    if getattr(message, "tool_calls", None):
+        normalized["tool_calls"] = [[call["name"], call["args"]] for call in message.tool_calls]
+    if message.type == "tool":
+        normalized["name"] = message.name
+    return normalized
+
+def request_key(kind, scope, payload):
+    data = json.dumps([kind, scope, payload], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+class Cassette():
+    def __init__(self, path, mode="replay", latency_scale=0.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown cassette mode {mode!r}, expected 'record' or 'replay'")
+
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale # 1.0 replays at the recorded speed, 0 as fast as possible
+        self.lock = threading.Lock()
+
+        self.metadata = {}
+        self.responses = [] # {"response", "elapsed"} in the order they were recorded
+        self.entries = {} # key -> indexes into responses
+        self.cursors = {} # key -> next entry to replay
+        self.hits = 0
+        self.loose_hits = 0 # hits on a key other than the first, ex. the loose LLM key
+        self.misses = 0
+
+        # re-recording starts from scratch, the old file is only replaced on save
+        if mode == "replay":
+            self.load()
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as file:
+            data = json.load(file)
+        if data.get("version") != CASSETTE_VERSION:
+            raise ValueError(f"{self.path} is a version {data.get('version')} cassette, expected {CASSETTE_VERSION}")
+        self.metadata = data.get("metadata", {})
+        self.responses = data["responses"]
+        self.entries = data["entries"]
+
+    def save(self):
+        if not self.recording:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.lock:
+            data = {"version": CASSETTE_VERSION, "metadata": self.metadata, "responses": self.responses, "entries": self.entries}
+            temporary = f"{self.path}.tmp"
+            with gzip.open(temporary, "wt", encoding="utf-8") as file:
+                json.dump(data, file, separators=(",", ":"))
+            os.replace(temporary, self.path)
+
+    def record(self, keys, response, elapsed):
+        with self.lock:
+            self.responses.append({"response": response, "elapsed": round(elapsed, 4)})
+            for key in keys:
+                self.entries.setdefault(key, []).append(len(self.responses) - 1)
+
+    def replay(self, keys, description):
+        """The recording of the first key that has one, past the last recording the last response keeps being served"""
+        with self.lock:
+            for key in keys:
+                indexes = self.entries.get(key)
+                if indexes:
+                    cursor = self.cursors.get(key, 0)
+                    self.cursors[key] = cursor + 1
+                    self.hits += 1
+                    if key != keys[0]:
+                        self.loose_hits += 1
+                        print(f"---------------->>> CASSETTE WARNING: {description} only matched loosely, the response was recorded against different tool output")
+                    return self.responses[indexes[min(cursor, len(indexes) - 1)]]
+
+            self.misses += 1
+            raise CassetteMiss(f"no recording for {description} in {self.path}")
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "entries": len(self.responses),
+            "hits": self.hits,
+            "loose_hits": self.loose_hits,
+            "misses": self.misses,
+        }
+
+    # LLM traffic, scope tells the agents apart since they are bound to different tools
+
+    def llm_keys(self, scope, messages):
+        return [
+            request_key("llm", scope, [normalize_message(message) for message in messages]),
+            request_key("llm-loose", scope, [normalize_message(message, loose=True) for message in messages]),
+        ]
+
+    def invoke(self, scope, messages, invoke):
+        keys = self.llm_keys(scope, messages)
+        if self.recording:
+            start = time.perf_counter()
+            result = invoke(messages)
+            self.record(keys, message_to_dict(result), time.perf_counter() - start)
+            return result
+
+        entry = self.replay(keys, f"a {scope} LLM request")
+        if self.latency_scale:
+            time.sleep(entry["elapsed"] * self.latency_scale)
+        return messages_from_dict([entry["response"]])[0]
+
+    async def ainvoke(self, scope, messages, ainvoke):
+        keys = self.llm_keys(scope, messages)
+        if self.recording:
+            start = time.perf_counter()
+            result = await ainvoke(messages)
+            self.record(keys, message_to_dict(result), time.perf_counter() - start)
+            return result
+
+        entry = self.replay(keys, f"a {scope} LLM request")
+        if self.latency_scale:
+            await asyncio.sleep(entry["elapsed"] * self.latency_scale)
+        return messages_from_dict([entry["response"]])[0]
+
+    def observe_llm(self, scope, messages, result):
+        """Records a response served by the LLM response cache, so the replay doesn't depend on what was cached"""
+        if self.recording:
+            self.record(self.llm_keys(scope, messages), message_to_dict(result), 0.0)
+
+    # search traffic, recorded around the backend fetchers of Tools.BACKENDS
+
+    def fetch(self, backend, search_term, fetch, errors=()):
+        """errors are exception types that are recorded like a result and raised again on replay"""
+        keys = [request_key("search", backend, normalize_text(search_term))]
+        if self.recording:
+            start = time.perf_counter()
+            try:
+                result = fetch(search_term)
+            except errors as e:
+                self.record(keys, {"error": type(e).__name__, "message": str(e)}, time.perf_counter() - start)
+                raise
+            self.record(keys, result, time.perf_counter() - start)
+            return result
+
+        entry = self.replay(keys, f"{backend} search {search_term!r}")
+        if self.latency_scale:
+            time.sleep(entry["elapsed"] * self.latency_scale)
+
+        response = entry["response"]
+        if isinstance(response, dict) and "error" in response:
+            error_types = {error_type.__name__: error_type for error_type in errors}
+            raise error_types.get(response["error"], RuntimeError)(response["message"])
+        return response
+
+    def observe(self, backend, search_term, result):
+        """Records a result served by the search cache, so the replay doesn't depend on what was cached"""
+        if self.recording:
+            self.record([request_key("search", backend, normalize_text(search_term))], result, 0.0)
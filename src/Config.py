@@ -0,0 +1,109 @@
+import json
+import os
+import sys
+import threading
+
+# every secret the agents read, anything else in a secrets source is ignored
+SECRET_KEYS = ["OPENAI_API_KEY", "ANTHROPIC_API_KEY", "BLACKLIST_SEARCH_TERMS"]
+
+# USD per million tokens (input, output), used to put a price on token counts
+PRICING = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "claude-3-5-haiku-latest": (0.80, 4.00),
+    "claude-3-5-sonnet-latest": (3.00, 15.00),
+}
+
+def estimate_cost(model_name, input_tokens, output_tokens):
+    """Dollar cost of a token count, 0 for models missing from PRICING"""
+    input_price, output_price = PRICING.get(model_name, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+# where streamlit itself looks for secrets, relative to the working directory
+DEFAULT_TOML_PATH = os.path.join(".streamlit", "secrets.toml")
+
+class SecretsProvider():
+    """A source of secrets, get returns None for anything the source doesn't have"""
+    def get(self, key):
+        raise NotImplementedError
+
+class DictSecrets(SecretsProvider):
+    def __init__(self, values):
+        self.values = dict(values)
+
+    def get(self, key):
+        return self.values.get(key)
+
+class EnvSecrets(SecretsProvider):
+    """Environment variables, list values (BLACKLIST_SEARCH_TERMS) are given as a JSON list"""
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+
+    def get(self, key):
+        value = os.environ.get(self.prefix + key)
+        if value is not None and value.lstrip().startswith("["):
+            return json.loads(value)
+        return value
+
+class TomlSecrets(SecretsProvider):
+    """A secrets.toml file in the format streamlit uses, read once on first access"""
+    def __init__(self, path=DEFAULT_TOML_PATH):
+        self.path = path
+        self.values = None
+
+    def get(self, key):
+        if self.values is None:
+            self.values = {}
+            if os.path.exists(self.path):
+                import tomllib
+                with open(self.path, "rb") as file:
+                    self.values = tomllib.load(file)
+        return self.values.get(key)
+
+class StreamlitSecrets(SecretsProvider):
+    """st.secrets, only consulted when streamlit has already been imported by the page"""
+    def get(self, key):
+        if "streamlit" not in sys.modules:
+            return None
+        import streamlit as st
+        try:
+            return st.secrets.get(key)
+        except Exception:
+            return None # no secrets file, st.secrets raises on first access
+
+class ChainedSecrets(SecretsProvider):
+    """Asks each provider in order, the first one that has a key wins"""
+    def __init__(self, providers):
+        self.providers = providers
+
+    def get(self, key):
+        for provider in self.providers:
+            value = provider.get(key)
+            if value is not None:
+                return value
+        return None
+
+def default_provider():
+    return ChainedSecrets([EnvSecrets(), TomlSecrets(), StreamlitSecrets()])
+
+_resolved = {}
+_resolved_lock = threading.Lock()
+
+def resolve_secrets(source=None):
+    """Reads SECRET_KEYS once from a provider or a plain mapping, the default chain is environment,
+    then .streamlit/secrets.toml, then st.secrets. The default chain is resolved once per process."""
+    if source is None:
+        with _resolved_lock:
+            if "default" not in _resolved:
+                _resolved["default"] = resolve_secrets(default_provider())
+            return _resolved["default"]
+
+    if not isinstance(source, SecretsProvider):
+        source = DictSecrets(source)
+
+    secrets = {key: source.get(key) for key in SECRET_KEYS}
+    if not secrets["OPENAI_API_KEY"]:
+        raise KeyError("OPENAI_API_KEY is not set in the environment, .streamlit/secrets.toml or the given secrets")
+
+    secrets["BLACKLIST_SEARCH_TERMS"] = list(secrets["BLACKLIST_SEARCH_TERMS"] or [])
+    return secrets
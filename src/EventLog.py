@@ -0,0 +1,61 @@
+import time
+from collections import deque
+
+class LogEntry():
+    """One rendered event, text is what is shown up front and full the untruncated content, if it was cut"""
+    __slots__ = ("kind", "text", "full", "placeholder")
+
+    def __init__(self, kind, text, full=None):
+        self.kind = kind
+        self.text = text
+        self.full = full
+        self.placeholder = None # the UI element the entry was rendered into
+
+    @property
+    def truncated(self):
+        return self.full is not None
+
+class EventLog():
+    """Append-only log of graph events for the UI, every entry is rendered once into its own element.
+    Only the last window entries stay visible, large tool outputs are cut down to a preview."""
+    def __init__(self, window=50, preview_chars=800):
+        self.window = window
+        self.preview_chars = preview_chars
+        self.entries = deque()
+        self.hidden = 0 # entries dropped out of the window
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.hidden = 0
+
+    def add(self, kind, text, truncate=False):
+        """Returns the new entry and the entries that fell out of the window, for the UI to remove"""
+        entry = LogEntry(kind, text)
+        if truncate and len(text) > self.preview_chars:
+            entry = LogEntry(kind, text[:self.preview_chars].rstrip() + " ...", full=text)
+
+        self.entries.append(entry)
+        evicted = []
+        while len(self.entries) > self.window:
+            evicted.append(self.entries.popleft())
+            self.hidden += 1
+        return entry, evicted
+
+class Throttle():
+    """Lets a call through at most once every interval seconds, ex. refreshing the metadata panel"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = 0.0
+
+    def ready(self, force=False):
+        now = time.monotonic()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            return True
+        return False
@@ -0,0 +1,157 @@
+"""
+Latency histograms and counters of a research run, exportable as Prometheus text or JSON.
+
+AgentGraph times every graph node (with the tokens, LLM cache hits and search cache hits spent in it)
+and Tools times every tool call, into the run's MetricsRegistry at session_state.metrics.
+"""
+import bisect
+import contextlib
+import json
+import math
+import threading
+import time
+from collections import deque
+
+# seconds, from a cached tool call up to a slow LLM turn
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_PREFIX = "timeliner_"
+
+def percentile(sorted_samples, q):
+    """Linear interpolation between closest ranks, q in [0, 100]"""
+    if not sorted_samples:
+        return None
+    rank = (len(sorted_samples) - 1) * q / 100
+    low = math.floor(rank)
+    high = math.ceil(rank)
+    return sorted_samples[low] + (sorted_samples[high] - sorted_samples[low]) * (rank - low)
+
+class Histogram():
+    """Cumulative buckets for Prometheus plus the most recent max_samples values for exact percentiles"""
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_samples=4096):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def percentiles(self, qs=(50, 95, 99)):
+        ordered = sorted(self.samples)
+        return {f"p{q}": percentile(ordered, q) for q in qs}
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            total += count
+            yield bound, total
+
+def format_labels(labels, extra=None):
+    items = list(labels) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+class MetricsRegistry():
+    """Histograms and counters keyed by name and labels, safe to share between concurrent researchers"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {} # (name, labels) -> Histogram
+        self.counters = {} # (name, labels) -> number
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self.key(name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        if not amount:
+            return
+        with self.lock:
+            key = self.key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observes the seconds spent in the block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get(self.key(name, labels))
+
+    def counter(self, name, **labels):
+        return self.counters.get(self.key(name, labels), 0)
+
+    def total(self, name):
+        """Sum of a counter over all of its label sets"""
+        with self.lock:
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def series(self, name):
+        """(labels dict, histogram) of every label set recorded under name"""
+        with self.lock:
+            return [(dict(labels), histogram) for (series_name, labels), histogram in self.histograms.items() if series_name == name]
+
+    def to_json(self):
+        with self.lock:
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    **{key: None if value is None else round(value, 6) for key, value in histogram.percentiles().items()},
+                }
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ]
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+        return {"histograms": histograms, "counters": counters}
+
+    def to_json_text(self):
+        return json.dumps(self.to_json(), indent=2)
+
+    def to_prometheus(self):
+        """Prometheus text exposition format, histograms as _bucket/_sum/_count and counters as _total"""
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = METRIC_PREFIX + name
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} histogram")
+                    typed.add(metric)
+                for bound, total in histogram.cumulative():
+                    lines.append(f"{metric}_bucket{format_labels(labels, {'le': bound})} {total}")
+                lines.append(f"{metric}_bucket{format_labels(labels, {'le': '+Inf'})} {histogram.count}")
+                lines.append(f"{metric}_sum{format_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{metric}_count{format_labels(labels)} {histogram.count}")
+
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = METRIC_PREFIX + name + "_total"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                lines.append(f"{metric}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
@@ -3,24 +3,33 @@ import asyncio
 from typing import Annotated, Dict, Optional, TypedDict
 from typing_extensions import TypedDict
 import uuid
+import time
+import contextlib
+import contextvars
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
-import streamlit as st
-
-from langchain.agents import AgentExecutor
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain_core.runnables import RunnableConfig
-from langchain_core.tools import tool
 
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import StateGraph, START, END, MessagesState
 from langgraph.graph.message import add_messages, AnyMessage
-from langgraph.prebuilt import ToolNode, tools_condition
 
 from langchain_core.messages import ToolMessage
 from langchain_core.runnables import RunnableLambda
 
 from DotDict import DotDict
-from Agents import Researcher, Questioner, Builder
+from Config import resolve_secrets
+from Similarity import QuestionIndex, NoteIndex
+from PromptState import StateRenderer
+from Retrieval import DocumentStore
+from Metrics import MetricsRegistry
+from ResponseCache import model_name_of
+import Tracing
+import SessionContext
+from Agents import Researcher, Questioner, Builder, MessageLedger
+from Assistant import get_chat_model
 import Tools
 
 import datetime
@@ -45,110 +54,316 @@ class ST_Proxy():
     # "Thread 'MainThread': missing ScriptRunContext! This warning can be ignored when running in bare mode."
     # error
 
-    def __init__(self):
+    def __init__(self, parent=None, options=None, secrets=None, graph=None, stream_callback=None):
+        # child proxies are used by parallel researcher sub-runs, they borrow the parent's secrets and options
+        self.parent = parent
+        self.options = parent.options if parent is not None else (options or {})
+
+        # secrets are resolved once here (see Config.resolve_secrets), resetting the state doesn't read them again
+        self.secrets = parent.secrets if parent is not None else DotDict(resolve_secrets(secrets))
+
+        # the session this state belongs to, for the shared agents and graph (see SessionContext.py)
+        # sub-runs belong to their parent's session and don't stream, interleaved deltas would be unreadable
+        self.graph = parent.graph if parent is not None else graph
+        self.stream_callback = None if parent is not None else stream_callback
         self.reset_state()
 
     def reset_state(self):
         self.session_state = DotDict(self.new_state())
-        self.secrets = DotDict({
-            'OPENAI_API_KEY': st.secrets["OPENAI_API_KEY"],
-            'ANTHROPIC_API_KEY': st.secrets["ANTHROPIC_API_KEY"],
-        })
 
     def new_state(self):
         return {
             'questions': [],
             'answered_questions': [],
             'notes': [],
+
+            # near-duplicate lookup over every question asked this run, queued or answered
+            'question_index': QuestionIndex(threshold=self.options.get('question_similarity', 0.6)),
+            'note_index': NoteIndex(threshold=self.options.get('note_similarity', 0.6)),
+
+            # renders answered questions and notes into the prompt, trimmed to state_token_budget if set
+            'prompt_renderer': StateRenderer(token_budget=self.options.get('state_token_budget')),
+
+            # everything fetched this run, searchable offline by the search_fetched tool
+            'document_store': DocumentStore(),
+
             'llm_state': {"messages": []},
+            'message_ledger': MessageLedger(), # pending tool calls of llm_state, see copy_tool_output_over
 
             # this is always true until the LLM sets it to false, which shuts off the research loop
             'researching': True,
 
+            # why the research loop ended: max_questions, max_notes, finished or the name of a spent budget
+            'stop_reason': None,
+
             'input_tokens': 0,
             'output_tokens': 0,
+            'input_tokens_saved': 0, # prompt state tokens trimmed away by the token budget
+            'llm_cache_hits': 0, # LLM responses served from the response cache, see ResponseCache.py
+            'llm_cache_input_tokens_saved': 0,
+            'llm_cache_output_tokens_saved': 0,
             
             'wikipedia_deep_calls': 0,
             'wikipedia_shallow_calls': 0,
             'DDGS_calls': 0,
             'arxiv_calls': 0,
+            'search_fetched_calls': 0,
+            'search_fetched_hits': 0, # search_fetched calls that found something
 
             'call_failures': 0,
 
+            # tokens of the search results as fetched and as shown to the LLM, see ResultFormat.py
+            'search_tokens_raw': 0,
+            'search_tokens_shown': 0,
+
             'web_call_cache_hits': 0,
+            'web_call_cache_hits_memory': 0,
+            'web_call_cache_hits_disk': 0,
+            'web_call_cache_hits_exact': 0, # hits the raw search term would have had too, without canonical keys
+            'web_call_coalesced': 0, # searches that shared an identical search already in flight
+
+            # latency histograms and per node counters of this run, see Metrics.py
+            'metrics': MetricsRegistry(),
         }
 
-class AgentGraph():
-    def __init__(self, st=None, model_name="PersonalGPT", event_callback=None, stream_callback=None, max_questions=5, max_notes=5, recursion_depth=100):
-        self.model_name = model_name
-        self.event_callback = event_callback
-        self.stream_callback = stream_callback
-        self.real_st = st
-        self.st = ST_Proxy()
+    def fork(self, question):
+        """Seeds this child proxy with a snapshot of the parent state, scoped to a single research question"""
+        parent_state = self.parent.session_state
 
-        self.max_questions = max_questions
-        self.max_notes = max_notes
-        self.recursion_depth = recursion_depth
+        self.session_state = DotDict(self.new_state())
+        self.session_state.questions = [question]
+        self.session_state.answered_questions = list(parent_state.answered_questions)
+        self.session_state.question_index = parent_state.question_index
+        self.session_state.notes = list(parent_state.notes)
+        self.session_state.note_index = parent_state.note_index.copy()
+        self.session_state.prompt_renderer = parent_state.prompt_renderer.copy()
+        self.session_state.document_store = parent_state.document_store
+        self.session_state.metrics = parent_state.metrics
+
+    def merge(self, child, base_notes):
+        """Folds the notes and counters of a finished child sub-run back into this state"""
+        for note in child.session_state.notes[base_notes:]:
+            if self.session_state.note_index.find(note):
+                continue
+            self.session_state.notes.append(note)
+            self.session_state.note_index.add(note)
+
+        for key, value in child.session_state._dict.items():
+            if isinstance(value, int) and not isinstance(value, bool) and key in self.session_state._dict:
+                self.session_state[key] += value
+
+# session counters recorded per graph node, as the difference before and after the node ran
+NODE_COUNTERS = {
+    'input_tokens': 'node_input_tokens',
+    'output_tokens': 'node_output_tokens',
+    'llm_cache_hits': 'node_llm_cache_hits',
+    'web_call_cache_hits': 'node_search_cache_hits',
+    'web_call_coalesced': 'node_search_coalesced',
+}
+
+def current_graph():
+    """The AgentGraph of the session the shared graph is running for"""
+    return SessionContext.current().graph
+
+def timed_node(name, runnable):
+    """Wraps a node so its duration, and the tokens and cache hits spent in it, are recorded under node=name"""
+    def start(graph):
+        return time.perf_counter(), {key: graph.st.session_state[key] for key in NODE_COUNTERS}
+
+    def record(graph, started, before):
+        metrics = graph.st.session_state.metrics
+        metrics.observe('node_seconds', time.perf_counter() - started, node=name)
+        for key, metric in NODE_COUNTERS.items():
+            metrics.inc(metric, graph.st.session_state[key] - before[key], node=name)
+
+    def attributes(graph):
+        # the question a researcher node works on, the whole batch for research_batch
+        questions = graph.st.session_state.questions
+        if name == "researcher" and questions:
+            return {"question": questions[0]}
+        if name == "research_batch":
+            return {"questions": questions[:graph.research_width]}
+        return {}
+
+    def record_span(graph, span, before):
+        span.set_attributes(**{metric: graph.st.session_state[key] - before[key] for key, metric in NODE_COUNTERS.items()})
+
+    def func(state, config):
+        graph = current_graph()
+        started, before = start(graph)
+        with Tracing.span(name, kind="node", **attributes(graph)) as span:
+            try:
+                return runnable.invoke(state, config)
+            finally:
+                record(graph, started, before)
+                record_span(graph, span, before)
+
+    async def afunc(state, config):
+        graph = current_graph()
+        started, before = start(graph)
+        with Tracing.span(name, kind="node", **attributes(graph)) as span:
+            try:
+                return await runnable.ainvoke(state, config)
+            finally:
+                record(graph, started, before)
+                record_span(graph, span, before)
+
+    return RunnableLambda(func, afunc=afunc, name=name)
+
+class GraphRuntime():
+    """The immutable part of an AgentGraph, built once per chat model and shared by every session using it:
+    the agents with their tools and bound model, and the compiled graph. The agents' st is a CurrentSession and
+    the nodes and edges dispatch to the AgentGraph of the session they run for, see SessionContext.py."""
+    def __init__(self, llm, st):
+        self.llm = llm
 
-        self.reset_state()
-        self.build_state_graph()
+        # agents
+        # they stream to the stream_callback of the session they work for
+        # the tool sets are picked while the first session is bound, only RUNTIME_OPTIONS may change them
+        with SessionContext.bind(st):
+            self.questioner = Questioner(st=SessionContext.CurrentSession(), llm=llm)
+            self.researcher = Researcher(st=SessionContext.CurrentSession(), llm=llm) # also runs every parallel sub-run, each on its own forked state
+            self.builder = Builder(st=SessionContext.CurrentSession(), llm=llm)  # Final output processor
 
-    def reset_state(self):
-        self.st.reset_state()
-        self.prompt = "<System> There is no prompt. Please alert the user."
+        self.graph = self.build_state_graph()
+
+    def research_batch(self, state: MessagesState):
+        return current_graph().research_batch(state)
+
+    async def aresearch_batch(self, state: MessagesState):
+        return await current_graph().aresearch_batch(state)
 
     def build_state_graph(self):
         workflow = StateGraph(MessagesState)
 
-        # agents
-        self.questioner = Questioner(st=self.st)
-        self.researcher = Researcher(st=self.st)
-        self.builder = Builder(st=self.st)  # Final output processor
-
         # nodes
-        workflow.add_node("questioner", self.questioner.__call__)
-        workflow.add_node("researcher", self.researcher.__call__)
-        workflow.add_node("builder", self.builder.__call__)
+        # agent nodes carry an async twin so the same graph can be driven by stream or astream
+        # every node is timed, see timed_node
+        workflow.add_node("questioner", timed_node("questioner", RunnableLambda(self.questioner.__call__, afunc=self.questioner.acall)))
+        workflow.add_node("researcher", timed_node("researcher", RunnableLambda(self.researcher.__call__, afunc=self.researcher.acall)))
+        workflow.add_node("builder", timed_node("builder", RunnableLambda(self.builder.__call__, afunc=self.builder.acall)))
+        workflow.add_node("research_batch", timed_node("research_batch", RunnableLambda(self.research_batch, afunc=self.aresearch_batch)))
         
-        workflow.add_node("questioner_tools", self.questioner.tools.tools_fallback)
-        workflow.add_node("researcher_tools", self.researcher.tools.tools_fallback)
+        workflow.add_node("questioner_tools", timed_node("questioner_tools", self.questioner.tools.tools_fallback))
+        workflow.add_node("researcher_tools", timed_node("researcher_tools", self.researcher.tools.tools_fallback))
 
         # this node doesn't do anything by itself
         # it is used to build conditional connections that handle the flow of the graph
-        workflow.add_node("dequeuer", lambda state: state) 
+        workflow.add_node("dequeuer", timed_node("dequeuer", RunnableLambda(lambda state: state)))
 
         # edges
         workflow.add_edge(START, "questioner")
         
         workflow.add_conditional_edges(
             "questioner",
-            lambda state: self.should_continue_questioner(state=state),
+            lambda state: current_graph().should_continue_questioner(state=state),
             ["questioner_tools", "builder", "questioner"]
         )
 
+        # every edge can wind the run down to the builder once the budget is spent
         workflow.add_conditional_edges(
             "questioner_tools",
-            lambda state: self.should_continue_questioner_tools(state=state),
-            ["dequeuer", "questioner"]
+            lambda state: current_graph().should_continue_questioner_tools(state=state),
+            ["dequeuer", "questioner", "builder"]
         )
         
         workflow.add_conditional_edges(
             "dequeuer",
-            lambda state: self.should_continue_dequeuer(state=state),
-            ["researcher", "questioner"]
+            lambda state: current_graph().should_continue_dequeuer(state=state),
+            ["researcher", "research_batch", "questioner", "builder"]
         )
         
         workflow.add_conditional_edges(
             "researcher",
-            lambda state: self.should_continue_researcher(state=state),
-            ["researcher_tools", "dequeuer"]
+            lambda state: current_graph().should_continue_researcher(state=state),
+            ["researcher_tools", "dequeuer", "builder"]
+        )
+        workflow.add_conditional_edges(
+            "researcher_tools",
+            lambda state: current_graph().should_continue_researcher_tools(state=state),
+            ["researcher", "builder"]
         )
-        workflow.add_edge("researcher_tools", "researcher")
+        workflow.add_edge("research_batch", "dequeuer")
         
         workflow.add_edge("builder", END)
 
+        # from langgraph.checkpoint.memory import MemorySaver
         # self.memory = MemorySaver()
 
+        return workflow.compile()# checkpointer=self.memory)
+        # return workflow.compile() # no memory
+
+# options that change which tools the agents get, sessions only share a runtime if they agree on these
+RUNTIME_OPTIONS = {
+    'wiki_passages': lambda value: value is None, # wikipedia_deep returns the whole article or passages
+}
+
+# a runtime keeps its llm alive, so the id can't be reused while the entry exists
+_runtimes = weakref.WeakValueDictionary() # (id(llm), runtime options) -> GraphRuntime
+_runtimes_lock = threading.Lock()
+
+def get_runtime(llm, st):
+    """The runtime of a chat model, built on first use and shared for as long as some session uses it"""
+    key = (id(llm),) + tuple(shape(st.options.get(option)) for option, shape in RUNTIME_OPTIONS.items())
+    with _runtimes_lock:
+        runtime = _runtimes.get(key)
+        if runtime is None:
+            runtime = _runtimes[key] = GraphRuntime(llm, st)
+        return runtime
+
+class AgentGraph():
+    def __init__(self, st=None, model_name="PersonalGPT", event_callback=None, stream_callback=None, max_questions=5, max_notes=5, recursion_depth=100, secrets=None, llm=None, cassette=None, llm_cache=False, temperature=None, trace_path=None, budget=None, canonical_search_keys=True, compact_search_results=True, search_result_chars=2400, research_width=1, research_steps=10, question_similarity=0.6, note_similarity=0.6, state_token_budget=None, wiki_passages=5, wiki_passage_chars=4000, fetched_passage_chars=4000):
+        self.model_name = model_name
+        self.event_callback = event_callback
+        self.stream_callback = stream_callback
+        self.real_st = st
+        self.llm = llm # optional chat model shared by every agent instead of the one built in Assistant
+
+        # with a trace_path every call is traced into that JSONL file, see Tracing.py
+        self.tracer = Tracing.Tracer(Tracing.JsonlExporter(trace_path)) if trace_path else None
+        self.st = ST_Proxy(secrets=secrets, graph=self, stream_callback=stream_callback, options={
+            'question_similarity': question_similarity,
+            'note_similarity': note_similarity,
+            'state_token_budget': state_token_budget,
+            'wiki_passages': wiki_passages,
+            'wiki_passage_chars': wiki_passage_chars,
+            'fetched_passage_chars': fetched_passage_chars, # cap on what search_fetched returns
+            'cassette': cassette, # records or replays LLM and search traffic, see Cassette.py
+            'llm_cache': llm_cache, # reuse responses to identical requests, only with a deterministic temperature
+            'temperature': temperature, # None leaves the provider default
+            'canonical_search_keys': canonical_search_keys, # cache searches under a normalized key, see QueryKeys.py
+            'compact_search_results': compact_search_results, # per backend templates instead of the raw result
+            'search_result_chars': search_result_chars, # snippets are cut to fit a compacted result in this, None keeps them whole
+        })
+
+        self.max_questions = max_questions
+        self.max_notes = max_notes
+        self.recursion_depth = recursion_depth
+
+        # optional limits on tokens, dollars, seconds and searches per call, see Budget.py
+        self.budget = budget
+
+        # research_width > 1 fans the question queue out to concurrent researcher sub-runs
+        # research_steps caps the ReAct loop of each sub-run, the serial researcher relies on recursion_depth instead
+        self.research_width = research_width
+        self.research_steps = research_steps
+
+        self.reset_state()
+        self.build_state_graph()
+
+    def reset_state(self):
+        self.st.reset_state()
+        self.prompt = "<System> There is no prompt. Please alert the user."
+
+    def build_state_graph(self):
+        # the agents, their tools, the model client and the compiled graph are shared by every session on the same model
+        llm = self.llm if self.llm is not None else get_chat_model(self.st.secrets, self.st.options.get('temperature'))
+        self.runtime = get_runtime(llm, self.st)
+        self.questioner = self.runtime.questioner
+        self.researcher = self.runtime.researcher
+        self.builder = self.runtime.builder
+        self.graph = self.runtime.graph
+
         self.config = {
             "configurable": {
                 "thread_id": str(uuid.uuid4()),
@@ -156,13 +371,14 @@ class AgentGraph():
             "recursion_limit": self.recursion_depth,
         }
 
-        self.graph = workflow.compile()# checkpointer=self.memory)
-        # self.graph = workflow.compile() # no memory
+    @contextlib.contextmanager
+    def bound(self):
+        """Binds this session for the shared agents, tools and graph, every call runs inside it"""
+        with SessionContext.bind(self.st):
+            yield
 
-    def call(self, user_input):
+    def begin_call(self, user_input):
         self.reset_state()
-   
-        _printed = set()
 
         self.prompt = user_input
         self.st.session_state.llm_state = {"messages": []}
@@ -170,19 +386,92 @@ class AgentGraph():
         # print("--->", "CALL INIT", user_input)
         self.message_index = 0 # where are you on the list of messages
         self.aborted = False
+        if self.budget is not None:
+            self.budget.start()
 
         self.load_system_prompt(self.questioner)
 
-        for event in self.graph.stream(
-            self.st.session_state.llm_state,
-            stream_mode="values",
-            config=self.config
-        ):
-            if self.aborted:
-                break
+    @contextlib.contextmanager
+    def trace_run(self):
+        """Root span of a call when tracing is on, the totals of the run are attached once it ends"""
+        if self.tracer is None:
+            yield
+            return
+
+        with self.tracer.start_run("run", prompt=self.prompt, model_name=self.model_name, max_questions=self.max_questions, max_notes=self.max_notes, research_width=self.research_width) as root:
+            try:
+                yield
+            finally:
+                session_state = self.st.session_state
+                root.set_attributes(
+                    input_tokens=session_state.input_tokens,
+                    output_tokens=session_state.output_tokens,
+                    answered_questions=len(session_state.answered_questions),
+                    notes=len(session_state.notes),
+                    aborted=self.aborted,
+                    stop_reason=session_state.stop_reason,
+                )
+
+    def call(self, user_input):
+        with self.bound():
+            self.run(user_input)
+
+    def run(self, user_input):
+        self.begin_call(user_input)
+        _printed = set()
+
+        try:
+            with self.trace_run():
+                for event in self.graph.stream(
+                    self.st.session_state.llm_state,
+                    stream_mode="values",
+                    config=self.config
+                ):
+                    if self.aborted:
+                        break
+
+                    _print_event(event, _printed)
+                    self.handle_event(event)
+        finally:
+            self.save_cassette()
+
+    async def acall(self, user_input):
+        """Async twin of call, LLM requests and searches are awaited so many sessions can share one event loop"""
+        with self.bound():
+            await self.arun(user_input)
+
+    async def arun(self, user_input):
+        self.begin_call(user_input)
+        _printed = set()
+
+        try:
+            with self.trace_run():
+                async for event in self.graph.astream(
+                    self.st.session_state.llm_state,
+                    stream_mode="values",
+                    config=self.config
+                ):
+                    if self.aborted:
+                        break
+
+                    _print_event(event, _printed)
+                    self.handle_event(event)
+        finally:
+            self.save_cassette()
+
+    def save_cassette(self):
+        """Writes out a recording cassette together with the settings of the run, so it can be replayed the same way"""
+        cassette = self.st.options.get('cassette')
+        if not cassette or not cassette.recording:
+            return
 
-            _print_event(event, _printed)
-            self.handle_event(event)
+        cassette.metadata.update({
+            "prompt": self.prompt,
+            "max_questions": self.max_questions,
+            "max_notes": self.max_notes,
+            "research_width": self.research_width,
+        })
+        cassette.save()
 
     def handle_event(self, event):
         if not self.event_callback:
@@ -226,7 +515,7 @@ class AgentGraph():
     def load_system_prompt(self, agent):
         """Wipes memory and loads the system prompt for a given agent"""
 
-        state = self.st.session_state.llm_state
+        state = agent.st.session_state.llm_state
         state = self.reset_memory(state)
         
         # Update messages in place
@@ -238,35 +527,184 @@ class AgentGraph():
 
         print("---------------->>> EDGE EVENT: system prompt reset", agent.name)
 
-        self.st.session_state.llm_state = state
+        agent.st.session_state.llm_state = state
+        agent.st.session_state.message_ledger.reset()
+
+    def research_batch(self, state: MessagesState):
+        """Researches up to research_width queued questions concurrently and merges the results back in queue order"""
+        batch = self.st.session_state.questions[:self.research_width]
+        base_notes = len(self.st.session_state.notes)
+        children = [ST_Proxy(parent=self.st) for _ in batch]
+
+        # every sub-run gets a copy of this context, so its spans become children of the research_batch span
+        with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, self.run_subresearch, question, child, children)
+                for question, child in zip(batch, children)
+            ]
+            results = [future.result() for future in futures]
+
+        return self.merge_research(batch, base_notes, results)
+
+    async def aresearch_batch(self, state: MessagesState):
+        """Async twin of research_batch, the sub-runs are gathered on the event loop instead of a thread pool"""
+        batch = self.st.session_state.questions[:self.research_width]
+        base_notes = len(self.st.session_state.notes)
+        children = [ST_Proxy(parent=self.st) for _ in batch]
+
+        results = await asyncio.gather(*[
+            self.arun_subresearch(question, child, children)
+            for question, child in zip(batch, children)
+        ])
+
+        return self.merge_research(batch, base_notes, results)
+
+    def merge_research(self, batch, base_notes, results):
+        # merging happens in queue order, so the outcome doesn't depend on which sub-run finished first
+        messages = self.st.session_state.llm_state["messages"]
+        for question, (answer, transcript, child) in zip(batch, results):
+            self.st.merge(child, base_notes)
+            self.st.session_state.answered_questions.append(f"{question} -> {answer}")
+            self.st.session_state.question_index.mark_answered(question)
+            messages += transcript
+
+        del self.st.session_state.questions[:len(batch)]
+        return self.st.session_state.llm_state
+
+    def subresearch_steps(self, question, child, children):
+        """The researcher ReAct loop for one question on an isolated state, shared by run_subresearch and arun_subresearch
+        yields ("researcher", llm_state) when the researcher takes a turn and ("tools", tool_input) when its tool calls
+        have to run, the tool output is sent back in. Returns the answer and transcript
+        children are the proxies of the whole batch, the budget is checked against what all of them spent"""
+        child.fork(question)
+        self.load_system_prompt(self.researcher)
+        llm_state = child.session_state.llm_state
+        context_length = len(llm_state["messages"])
+
+        answer = "I could not find anything on this"
+        for _ in range(self.research_steps):
+            if self.aborted:
+                break
+            if self.over_budget(*(sibling.session_state for sibling in children)):
+                answer = "Research stopped, the budget ran out"
+                break
+
+            yield "researcher", llm_state
+            last_message = llm_state["messages"][-1]
+            if not last_message.tool_calls:
+                answer = last_message.content
+                break
+
+            tool_output = yield "tools", {"messages": llm_state["messages"]}
+            llm_state["messages"] += tool_output["messages"]
+
+        return answer, llm_state["messages"][context_length:]
+
+    def run_subresearch(self, question, child, children):
+        """Runs subresearch_steps for one question, returns the answer, transcript and state
+        the shared researcher works on the child proxy, bound for this sub-run only"""
+        researcher = self.researcher
+        with SessionContext.bind(child), Tracing.span("subresearch", kind="node", question=question):
+            steps = self.subresearch_steps(question, child, children)
+            output = None
+            try:
+                while True:
+                    step, value = steps.send(output)
+                    if step == "researcher":
+                        output = researcher(value, self.config)
+                    else:
+                        output = researcher.tools.tools_fallback.invoke(value)
+            except StopIteration as finished:
+                answer, transcript = finished.value
+            return answer, transcript, child
+
+    async def arun_subresearch(self, question, child, children):
+        """Async twin of run_subresearch, gather runs it in its own task so the binding stays with it"""
+        researcher = self.researcher
+        with SessionContext.bind(child), Tracing.span("subresearch", kind="node", question=question):
+            steps = self.subresearch_steps(question, child, children)
+            output = None
+            try:
+                while True:
+                    step, value = steps.send(output)
+                    if step == "researcher":
+                        output = await researcher.acall(value, self.config)
+                    else:
+                        output = await researcher.tools.tools_fallback.ainvoke(value)
+            except StopIteration as finished:
+                answer, transcript = finished.value
+            return answer, transcript, child
+
+    def over_budget(self, *sub_states):
+        """Name of the budget that is spent, recorded as the stop reason, None while there is budget left
+        sub_states are the states of running sub-runs, which are only merged into the main state once they finish"""
+        if self.budget is None:
+            return None
+
+        exhausted = self.budget.exhausted(model_name_of(self.questioner.llm), self.st.session_state, *sub_states)
+        if exhausted and self.st.session_state.stop_reason is None:
+            print("---------------->>> EDGE EVENT: budget spent", exhausted)
+            self.st.session_state.stop_reason = exhausted
+            self.st.session_state.metrics.inc('budget_stops', budget=exhausted)
+        return exhausted
+
+    def wind_down(self):
+        """Skips whatever research is left and lets the builder write up what was found so far"""
+        self.load_system_prompt(self.builder)
+        return "builder"
 
     def should_continue_dequeuer(self, state: MessagesState):
         """Determines if dequeuer should continue processing questions or return to questioner"""
+        if self.over_budget():
+            return self.wind_down()
+
         if not self.st.session_state.questions:  # No more questions in queue
             self.load_system_prompt(self.questioner)
             return "questioner"  # Always go back to questioner when done
-        
+
+        if self.research_width > 1:
+            return "research_batch"
+
         self.load_system_prompt(self.researcher)
         return "researcher" # Go to researcher if there is stuff in the question queue
 
     def should_continue_researcher(self, state: MessagesState):
         """Determines if researcher should continue processing questions or return to dequeuer"""
         if state["messages"][-1].tool_calls:
+            if self.over_budget():
+                return self.wind_down()
             return "researcher_tools"
         else:
             # if the LLM doesn't call any more tools, assume its response is the answer to the question
             answer = state["messages"][-1].content
             question = self.st.session_state.questions.pop(0)
             self.st.session_state.answered_questions.append(f"{question} -> {answer}")
+            self.st.session_state.question_index.mark_answered(question)
             return "dequeuer"
 
+    def should_continue_researcher_tools(self, state: MessagesState):
+        """Back to the researcher with the tool results, unless the searches spent the budget"""
+        if self.over_budget():
+            return self.wind_down()
+        return "researcher"
+
     def should_continue_questioner(self, state: MessagesState):
         """Go to builder if LLM has no more questions, go to tools if LLM wants to add questions for research"""
         last_message = state["messages"][-1]
-        
-        if not last_message.tool_calls or len(self.st.session_state.answered_questions) >= self.max_questions or len(self.st.session_state.notes) >= self.max_notes:
-            self.load_system_prompt(self.builder)
-            return "builder"  # Continue if no tool was called
+        session_state = self.st.session_state
+
+        if self.over_budget():
+            return self.wind_down()
+
+        if not last_message.tool_calls or len(session_state.answered_questions) >= self.max_questions or len(session_state.notes) >= self.max_notes:
+            if not last_message.tool_calls:
+                session_state.stop_reason = "finished"
+            elif len(session_state.answered_questions) >= self.max_questions:
+                session_state.stop_reason = "max_questions"
+            else:
+                session_state.stop_reason = "max_notes"
+
+            return self.wind_down()  # Continue if no tool was called
         else:
             print("---------------->>> EDGE EVENT: moving to tools")
             return "questioner_tools"  # Handle tool execution
@@ -274,6 +712,9 @@ class AgentGraph():
     def should_continue_questioner_tools(self, state: MessagesState):
         """Go to dequeuer if LLM has questions, go back to questioner if there's no questions or issues"""
         last_message = state["messages"][-1]
+
+        if self.over_budget():
+            return self.wind_down()
         
         if self.st.session_state.questions: # make sure the LLM doesn't ask bad questions that get rejected
             return "dequeuer"  # Handle tool execution
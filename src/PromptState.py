@@ -0,0 +1,105 @@
+import math
+import threading
+
+from Similarity import normalize_tokens
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+def count_tokens(text):
+    """Token count with the gpt-4o tokenizer, falls back to ~4 characters per token if tiktoken can't load"""
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            try:
+                import tiktoken
+                _encoder = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                _encoder = False # don't retry on every call
+
+    if _encoder is False:
+        return max(1, math.ceil(len(text) / 4))
+    return len(_encoder.encode(text))
+
+class RenderedList():
+    """Numbered lines of an append-only list, each line is formatted and tokenized only once"""
+    def __init__(self):
+        self.source = [] # the items the cache was built from
+        self.lines = []
+        self.tokens = []
+        self.terms = []
+
+    def update(self, items):
+        cached = len(self.source)
+        # the lists only grow during a run, anything else means the state was reset
+        if len(items) < cached or (cached and (items[0] is not self.source[0] or items[cached - 1] is not self.source[cached - 1])):
+            self.source, self.lines, self.tokens, self.terms = [], [], [], []
+            cached = 0
+
+        for i in range(cached, len(items)):
+            line = f"{i + 1}. {items[i]}"
+            self.source.append(items[i])
+            self.lines.append(line)
+            self.tokens.append(count_tokens(line + "\n"))
+            self.terms.append(set(normalize_tokens(items[i])))
+
+    def copy(self):
+        rendered = RenderedList()
+        rendered.source = list(self.source)
+        rendered.lines = list(self.lines)
+        rendered.tokens = list(self.tokens)
+        rendered.terms = list(self.terms)
+        return rendered
+
+class StateRenderer():
+    """Renders the answered questions and notes of the prompt state, trimmed to a token budget when one is set"""
+    def __init__(self, token_budget=None):
+        self.token_budget = token_budget
+        self.answered = RenderedList()
+        self.notes = RenderedList()
+
+    def copy(self):
+        renderer = StateRenderer(token_budget=self.token_budget)
+        renderer.answered = self.answered.copy()
+        renderer.notes = self.notes.copy()
+        return renderer
+
+    def render(self, session_state, query=None, trim=True):
+        """Returns (answered questions text, notes text) and adds the tokens trimmed away to session_state.input_tokens_saved
+        trim=False renders everything whatever the budget, for the builder which has to see every note"""
+        self.answered.update(session_state.answered_questions)
+        self.notes.update(session_state.notes)
+
+        sections = [self.answered, self.notes]
+        full_tokens = sum(sum(section.tokens) for section in sections)
+        if not trim or self.token_budget is None or full_tokens <= self.token_budget:
+            return tuple("\n".join(section.lines) for section in sections)
+
+        # score every line against the research question, newer lines win ties
+        query_terms = set(normalize_tokens(query)) if query else set()
+        candidates = []
+        for section_index, section in enumerate(sections):
+            for i, terms in enumerate(section.terms):
+                overlap = len(query_terms & terms) / math.sqrt(len(terms)) if terms else 0.0
+                candidates.append((overlap, i / max(1, len(section.terms)), section_index, i))
+        candidates.sort(reverse=True)
+
+        # keep the most relevant lines until the budget runs out, the remainder gets a one line summary
+        kept = [set(), set()]
+        used = 0
+        for _, _, section_index, i in candidates:
+            cost = sections[section_index].tokens[i]
+            if used + cost <= self.token_budget:
+                kept[section_index].add(i)
+                used += cost
+
+        rendered = []
+        for section, keep in zip(sections, kept):
+            lines = [section.lines[i] for i in sorted(keep)]
+            omitted = len(section.lines) - len(keep)
+            if omitted:
+                lines.append(f"({omitted} more entr{'ies' if omitted != 1 else 'y'} omitted, less relevant to the current question)")
+            rendered.append("\n".join(lines))
+
+        session_state.input_tokens_saved += max(0, full_tokens - sum(count_tokens(text + "\n") for text in rendered))
+        return tuple(rendered)
@@ -0,0 +1,101 @@
+"""
+Canonical search cache keys, so 'Mamba LLM', 'mamba llm ' and 'Mamba LLM timeline' share one cache entry.
+
+A key is the search term run through the rules of its backend (BACKEND_RULES, DEFAULT_RULES for the rest), every
+rule is a str -> str function and more can be added with register_rule. The rules only fold what can't change the
+results: 'C++', 'C#' and 'C' or 'new york' and 'york new' stay different keys. Wikipedia keys also resolve through the
+titles wikipedia redirected earlier searches to (learn_wikipedia_title), kept in the search cache like a backend.
+Only the cache and in-flight lookups use the key, the search itself still runs on the term the LLM wrote.
+The raw terms are logged too (look_up_term), to tell the hits the canonical key added from those the raw term had.
+"""
+import re
+import unicodedata
+from urllib.parse import unquote
+
+from SearchCache import get_search_cache
+
+# 'a', 'it' and 'who' are left out, case folding would turn 'Vitamin A', 'IT' and 'WHO' into them
+STOPWORDS = frozenset(
+    "about an and are as at be by for from in into is its of on or that the this to was were what when where which with".split()
+)
+
+# words the agents like to add to a search that don't change what comes back
+NOISE_WORDS = frozenset(["timeline", "timelines", "chronology"])
+
+def fold_case(term):
+    """Lower case without accents, 'Gödel' and 'godel' are the same search"""
+    decomposed = unicodedata.normalize("NFKD", term)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+def fold_punctuation(term):
+    """Quotes, brackets, commas and the like go, '+' and '#' stay ('C++', 'C#') and so do dots inside a word ('node.js', '3.5')"""
+    term = re.sub(r"[^\w\s+#.]|_", " ", term)
+    return re.sub(r"(?<!\w)\.|\.(?!\w)", " ", term)
+
+def fold_whitespace(term):
+    return " ".join(term.split())
+
+def drop_stopwords(term):
+    words = [word for word in term.split() if word not in STOPWORDS and word not in NOISE_WORDS]
+    return " ".join(words) if words else term
+
+def sort_words(term):
+    """Word order and repeated words are ignored, not in DEFAULT_RULES as they do change most searches
+    ('C++ vs C#', 'new york'), register_rule can add it to a backend where they don't"""
+    return " ".join(sorted(set(term.split())))
+
+def wikipedia_title(term):
+    """A wikipedia URL becomes its title, and a mention of wikipedia itself is dropped"""
+    match = re.search(r"wikipedia\.org/wiki/([^?#\s]+)", term)
+    if match:
+        term = unquote(match.group(1))
+    return re.sub(r"\b(wikipedia|wiki)\b", " ", term, flags=re.IGNORECASE)
+
+DEFAULT_RULES = [fold_case, fold_punctuation, fold_whitespace, drop_stopwords]
+
+BACKEND_RULES = {
+    'wikipedia_shallow': [wikipedia_title] + DEFAULT_RULES,
+    'wikipedia_deep': [wikipedia_title] + DEFAULT_RULES,
+}
+
+def register_rule(backend, rule):
+    """Appends a rule to the canonicalization of a backend"""
+    BACKEND_RULES[backend] = BACKEND_RULES.get(backend, DEFAULT_RULES) + [rule]
+
+# bumped whenever the rules change, entries cached under keys of older rules are never looked up again
+# (version 1 sorted words and dropped all punctuation, its keys mixed up different searches)
+RULES_VERSION = 2
+
+def canonical(backend, term):
+    for rule in BACKEND_RULES.get(backend, DEFAULT_RULES):
+        term = rule(term)
+    return f"v{RULES_VERSION}:{term}"
+
+# learned wikipedia redirects are stored in the search cache under this pseudo backend
+TITLE_BACKEND = 'wikipedia_title'
+
+def learn_wikipedia_title(search_term, title):
+    """Remembers which article a search landed on, so a later search for the title or another alias of it is a hit"""
+    key, resolved = canonical('wikipedia_deep', search_term), canonical('wikipedia_deep', title)
+    if key != resolved:
+        get_search_cache().set(TITLE_BACKEND, key, resolved)
+
+def cache_key(cache, backend, search_term):
+    key = canonical(backend, search_term)
+    if backend.startswith('wikipedia'):
+        resolved, _ = cache.get(TITLE_BACKEND, key)
+        if resolved is not None:
+            return resolved
+    return key
+
+# every raw search term looked up is stored in the search cache under this pseudo backend, on disk like the
+# results, so a hit after a restart still tells whether a key on the raw term would have been a hit as well
+TERM_BACKEND = 'search_term'
+
+def look_up_term(cache, backend, search_term):
+    """Records that search_term was looked up, returns whether it had been before"""
+    key = f"{backend}:{search_term}"
+    seen, _ = cache.get(TERM_BACKEND, key)
+    if seen is None:
+        cache.set(TERM_BACKEND, key, "1")
+    return seen is not None
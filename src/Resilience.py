@@ -0,0 +1,278 @@
+"""
+Shared resilience layer of the search backends: an adaptive token bucket per service, retries with exponential
+backoff and full jitter bounded by a retry budget, and a circuit breaker that fails fast while a service is down.
+
+The guards are process-wide like the search cache, so every session shares one view of each service's health.
+Both wikipedia backends are the 'wikipedia' service. A call that fails for good (circuit open, retries or retry
+budget used up) raises BackendUnavailable, on which Tools.run_search falls back to another backend (Tools.FALLBACKS).
+Breaker transitions, retries, throttling and rate limit waits are recorded into the calling run's MetricsRegistry.
+"""
+import random
+import threading
+import time
+
+import Tracing
+
+# requests per second and burst size per service, the arXiv API asks for at most one request every 3 seconds
+# services missing here are not rate limited
+RATE_LIMITS = {
+    'duck_duck_go': (1.0, 3),
+    'wikipedia': (5.0, 10),
+    'arxiv': (1 / 3, 1),
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class BackendUnavailable(Exception):
+    """The circuit of a service is open, or it kept failing through every retry"""
+
+def service_of(backend):
+    return 'wikipedia' if backend.startswith('wikipedia') else backend
+
+def is_rate_limit(error):
+    text = f"{type(error).__name__} {error}".lower()
+    return "ratelimit" in text or "rate limit" in text or "429" in text
+
+# the search clients raise their own exception types, they are told apart by name so none of them has to be imported
+TRANSIENT_NAMES = ("timeout", "httperror", "connectionerror", "unexpectedemptypage")
+
+def is_transient(error):
+    """Errors worth retrying, a missing wikipedia page or a bad query fails the same way every time"""
+    if isinstance(error, (ConnectionError, TimeoutError)) or is_rate_limit(error):
+        return True
+    name = type(error).__name__.lower()
+    return any(part in name for part in TRANSIENT_NAMES)
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    """Full jitter, uniform between 0 and the exponential backoff of the attempt"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class TokenBucket():
+    """Rate limit with bursts, the rate halves on every rate limit response and creeps back up on successes"""
+    def __init__(self, rate, capacity, min_rate_fraction=1 / 16, recovery=0.1):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = rate * min_rate_fraction
+        self.recovery = recovery
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, possibly one that isn't there yet, returns the seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def cancel(self):
+        with self.lock:
+            self.tokens += 1
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * self.recovery)
+
+class CircuitBreaker():
+    """Opens after failure_threshold consecutive failures. After reset_seconds a single probe call is let through
+    (half open), its outcome closes the circuit or opens it again. The methods return the (from, to) transition, if any."""
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.transitions = {} # (from, to) -> count
+        self.lock = threading.Lock()
+
+    def transition(self, state):
+        change = (self.state, state)
+        self.state = state
+        self.transitions[change] = self.transitions.get(change, 0) + 1
+        return change
+
+    def is_open(self):
+        """Whether calls fail fast right now, an open circuit that is due for a probe counts as available"""
+        return self.state == OPEN and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def allow(self):
+        """(allowed, transition) for a new call"""
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    return False, None
+                self.probing = True
+                return True, self.transition(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    return False, None
+                self.probing = True
+            return True, None
+
+    def release(self):
+        """A probe that ended without reaching the service, the next call probes instead"""
+        with self.lock:
+            self.probing = False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != CLOSED:
+                return self.transition(CLOSED)
+            return None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                return self.transition(OPEN)
+            return None
+
+class RetryBudget():
+    """Every call deposits ratio of a retry and every retry withdraws a whole one, so retries add at most ratio
+    extra load on top of the calls themselves. The reserve lets a quiet service still be retried."""
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = float(reserve)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+class ServiceGuard():
+    def __init__(self, rate_limit, failure_threshold, reset_seconds, retry_ratio):
+        self.bucket = TokenBucket(*rate_limit) if rate_limit else None
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.retry_budget = RetryBudget(retry_ratio)
+
+class Resilience():
+    def __init__(self, rate_limits=RATE_LIMITS, max_attempts=3, base_delay=0.5, max_delay=8.0, failure_threshold=5, reset_seconds=30.0, retry_ratio=0.2, max_wait=30.0):
+        self.rate_limits = rate_limits
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.retry_ratio = retry_ratio
+        self.max_wait = max_wait # a call that would wait longer than this for the rate limit fails instead
+
+        self.guards = {} # service -> ServiceGuard
+        self.lock = threading.Lock()
+
+    def guard(self, service):
+        with self.lock:
+            if service not in self.guards:
+                self.guards[service] = ServiceGuard(self.rate_limits.get(service), self.failure_threshold, self.reset_seconds, self.retry_ratio)
+            return self.guards[service]
+
+    def available(self, backend):
+        return not self.guard(service_of(backend)).breaker.is_open()
+
+    def call(self, backend, fetch, search_term, metrics=None):
+        """fetch(search_term) under the service's rate limit, retries and circuit breaker"""
+        service = service_of(backend)
+        guard = self.guard(service)
+
+        def count(name, **labels):
+            if metrics is not None:
+                metrics.inc(name, backend=service, **labels)
+
+        def record(transition):
+            if transition is not None:
+                count('backend_state_transitions', from_state=transition[0], to_state=transition[1])
+
+        allowed, transition = guard.breaker.allow()
+        record(transition)
+        if not allowed:
+            count('backend_short_circuits')
+            raise BackendUnavailable(f"{service} is temporarily unavailable after repeated failures")
+
+        guard.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if guard.bucket is not None:
+                wait = guard.bucket.reserve()
+                if wait > self.max_wait:
+                    guard.bucket.cancel()
+                    guard.breaker.release()
+                    count('backend_short_circuits')
+                    raise BackendUnavailable(f"{service} is rate limited, the next request slot is {wait:.0f}s away")
+                if metrics is not None:
+                    metrics.observe('backend_rate_limit_wait_seconds', wait, backend=service)
+                if wait:
+                    time.sleep(wait)
+
+            try:
+                result = fetch(search_term)
+            except Exception as error:
+                if not is_transient(error):
+                    # the service answered, the request itself was bad
+                    record(guard.breaker.success())
+                    raise
+
+                if is_rate_limit(error) and guard.bucket is not None:
+                    guard.bucket.throttle()
+                    count('backend_throttles')
+                record(guard.breaker.failure())
+
+                attempt += 1
+                Tracing.set_attributes(attempts=attempt)
+                if guard.breaker.state == OPEN or attempt >= self.max_attempts or not guard.retry_budget.withdraw():
+                    raise BackendUnavailable(f"{service} failed after {attempt} attempt{'s' if attempt != 1 else ''}: {error}") from error
+
+                count('backend_retries')
+                time.sleep(backoff_delay(attempt - 1, self.base_delay, self.max_delay))
+                continue
+
+            record(guard.breaker.success())
+            if guard.bucket is not None:
+                guard.bucket.recover()
+            return result
+
+    def stats(self):
+        with self.lock:
+            guards = dict(self.guards)
+        return {
+            service: {
+                "state": guard.breaker.state,
+                "rate": guard.bucket.rate if guard.bucket else None,
+                "base_rate": guard.bucket.base_rate if guard.bucket else None,
+                "retry_balance": guard.retry_budget.balance,
+                "transitions": {f"{old}->{new}": count for (old, new), count in guard.breaker.transitions.items()},
+            }
+            for service, guard in sorted(guards.items())
+        }
+
+_shared_resilience = None
+_shared_resilience_lock = threading.Lock()
+
+def get_resilience():
+    """Returns the process-wide resilience layer, created on first use"""
+    global _shared_resilience
+    with _shared_resilience_lock:
+        if _shared_resilience is None:
+            _shared_resilience = Resilience()
+        return _shared_resilience
@@ -0,0 +1,47 @@
+"""
+Content addressed cache of LLM responses, stored as the 'llm' backend of the shared search cache (see SearchCache.py).
+
+A response is keyed on the model name, the schemas of the tools bound to it and a hash of the cleaned messages
+(normalized as in Cassette.py, so the date/time in the system prompts doesn't change the key). Only deterministic
+requests are cached: a model sampling with temperature > 0 (or the provider's default) bypasses the cache.
+"""
+import hashlib
+import json
+import uuid
+
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from Cassette import normalize_message
+
+def model_name_of(llm):
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+def cacheable(llm):
+    """Only greedy decoding repeats itself, None means the provider default which samples"""
+    temperature = getattr(llm, "temperature", None)
+    return temperature is not None and temperature <= 0
+
+def tool_schemas(tools):
+    return sorted((convert_to_openai_tool(tool) for tool in tools), key=lambda schema: schema["function"]["name"])
+
+def response_key(model_name, schemas, messages):
+    data = json.dumps(
+        [model_name, schemas, [normalize_message(message) for message in messages]],
+        sort_keys=True, separators=(",", ":"), default=str,
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def dump_response(message):
+    return json.dumps(message_to_dict(message), separators=(",", ":"))
+
+def load_response(value):
+    message = messages_from_dict([json.loads(value)])[0]
+
+    # a repeated request gets fresh tool call ids, the message ledger tells tool calls apart by id
+    raw_tool_calls = message.additional_kwargs.get("tool_calls") or []
+    for position, tool_call in enumerate(message.tool_calls):
+        tool_call["id"] = f"call_{uuid.uuid4().hex[:24]}"
+        if position < len(raw_tool_calls):
+            raw_tool_calls[position]["id"] = tool_call["id"]
+    return message
@@ -0,0 +1,131 @@
+"""
+Compact formatting of search results for the LLM, the cache and the document store keep the raw results.
+
+Each backend has a template (FORMATTERS) that drops the quoting and key noise of the raw result, shortens URLs,
+keeps at most MAX_PER_HOST results of one site and cuts the snippets down so the whole output fits in max_chars.
+A raw result that doesn't parse is passed through with only its whitespace compacted and the same cut.
+"""
+import ast
+import re
+from urllib.parse import urlsplit
+
+# results of one site after the first ones rarely add anything new
+MAX_PER_HOST = 2
+
+# no snippet is cut shorter than this, with many results the output can go over max_chars instead
+MIN_SNIPPET_CHARS = 80
+
+def compact_whitespace(text):
+    return " ".join(text.split())
+
+def truncate(text, max_chars):
+    """Cuts at a word boundary, or at the end of a sentence if one is close"""
+    text = compact_whitespace(text)
+    if max_chars is None or len(text) <= max_chars:
+        return text
+
+    cut = text[:max_chars]
+    sentence_end = cut.rfind(". ")
+    if sentence_end > max_chars * 0.7:
+        return cut[:sentence_end + 1]
+    return cut.rsplit(" ", 1)[0] + " ..."
+
+def shorten_url(url, max_path=40):
+    """Host and path only, without scheme, www, query, fragment or an arXiv version"""
+    parts = urlsplit(url.strip())
+    if not parts.netloc:
+        return url.strip()
+
+    host = parts.netloc.lower().removeprefix("www.")
+    path = parts.path.rstrip("/")
+    if host.endswith("arxiv.org"):
+        path = re.sub(r"v\d+$", "", path)
+    if len(path) > max_path:
+        path = path[:max_path] + "..."
+    return host + path
+
+def host_of(url):
+    return urlsplit(url.strip()).netloc.lower().removeprefix("www.")
+
+def snippet_chars(max_chars, count, overhead):
+    if max_chars is None:
+        return None
+    return max(MIN_SNIPPET_CHARS, (max_chars - overhead) // max(1, count))
+
+def format_duck_duck_go(raw, max_chars):
+    """The raw result is the repr of DDGS().text, a list of {'title', 'href', 'body'}"""
+    results = ast.literal_eval(raw)
+    if not results:
+        return "No results found."
+
+    kept = []
+    omitted = {} # host -> results dropped past MAX_PER_HOST
+    per_host = {}
+    for result in results:
+        host = host_of(result.get('href', ''))
+        per_host[host] = per_host.get(host, 0) + 1
+        if per_host[host] > MAX_PER_HOST:
+            omitted[host] = omitted.get(host, 0) + 1
+            continue
+        kept.append(result)
+
+    lines = []
+    heads = [f"{i}. {compact_whitespace(result.get('title', ''))} ({shorten_url(result.get('href', ''))})" for i, result in enumerate(kept, 1)]
+    body_chars = snippet_chars(max_chars, len(kept), sum(len(head) + 5 for head in heads))
+    for head, result in zip(heads, kept):
+        lines.append(head)
+        body = truncate(result.get('body', ''), body_chars)
+        if body:
+            lines.append(f"   {body}")
+    for host, count in omitted.items():
+        lines.append(f"({count} more from {host} omitted)")
+    return "\n".join(lines)
+
+ARXIV_PAPER = re.compile(
+    r"^\d+\. Title: (?P<title>.*?)\n\s+Authors: (?P<authors>.*?)\n\s+Published: (?P<published>\S+).*?\n"
+    r"\s+URL: (?P<url>\S+)\n\s+Abstract: (?P<abstract>.*?)(?=\n\n\d+\. Title: |\s*\Z)",
+    re.MULTILINE | re.DOTALL,
+)
+
+def format_arxiv(raw, max_chars):
+    """The raw result is the text fetch_arxiv writes, authors are cut down to the first one"""
+    papers = list(ARXIV_PAPER.finditer(raw))
+    if not papers:
+        return truncate(raw, max_chars)
+
+    heads = []
+    for i, paper in enumerate(papers, 1):
+        authors = [author.strip() for author in paper['authors'].split(",") if author.strip()]
+        byline = authors[0] + (" et al." if len(authors) > 1 else "") if authors else "unknown authors"
+        heads.append(f"{i}. {compact_whitespace(paper['title'])} ({paper['published']}, {byline}) {shorten_url(paper['url'])}")
+
+    abstract_chars = snippet_chars(max_chars, len(papers), sum(len(head) + 5 for head in heads))
+    lines = [f"{len(papers)} most recent arXiv papers:"]
+    for head, paper in zip(heads, papers):
+        lines.append(head)
+        lines.append(f"   {truncate(paper['abstract'], abstract_chars)}")
+    return "\n".join(lines)
+
+def format_wikipedia_shallow(raw, max_chars):
+    return truncate(raw, max_chars)
+
+def format_wikipedia_deep(raw, max_chars):
+    """The whole article is what the tool promises, only the blank lines and padding around headings go"""
+    return re.sub(r"\n\s*\n+", "\n", raw).strip()
+
+FORMATTERS = {
+    'duck_duck_go': format_duck_duck_go,
+    'arxiv': format_arxiv,
+    'wikipedia_shallow': format_wikipedia_shallow,
+    'wikipedia_deep': format_wikipedia_deep,
+}
+
+def format_result(backend, raw, max_chars=None):
+    formatter = FORMATTERS.get(backend)
+    if formatter is None:
+        return raw
+    try:
+        return formatter(raw, max_chars)
+    except (ValueError, SyntaxError, TypeError, AttributeError):
+        # not the shape the template expects, ex. an error message or a result cached by an older version
+        return truncate(raw, max_chars)
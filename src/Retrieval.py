@@ -0,0 +1,121 @@
+import math
+import re
+import threading
+
+from Similarity import normalize_tokens
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# wikipedia's plain text content marks headings as "== History ==", "=== Early life ===", ...
+HEADING = re.compile(r"^(=+)\s*(.+?)\s*\1\s*$", re.MULTILINE)
+
+def chunk_article(content, max_chars=1200):
+    """Splits a wikipedia article into passages that stay within one section, long sections are packed paragraph by paragraph"""
+    sections = []
+    path = []
+    position = 0
+    title = "Introduction"
+    for match in HEADING.finditer(content):
+        sections.append((title, content[position:match.start()]))
+        level = len(match.group(1)) - 1
+        path = path[:max(0, level - 1)] + [match.group(2)]
+        title = " > ".join(path)
+        position = match.end()
+    sections.append((title, content[position:]))
+
+    chunks = []
+    for title, text in sections:
+        current = ""
+        pieces = []
+        for paragraph in (p.strip() for p in text.split("\n")):
+            # long paragraphs (or text without any line breaks) are packed sentence by sentence instead
+            pieces += SENTENCE_END.split(paragraph) if len(paragraph) > max_chars else [paragraph]
+
+        for paragraph in pieces:
+            if not paragraph:
+                continue
+            # a single sentence longer than max_chars becomes its own oversized chunk rather than being cut mid sentence
+            if current and len(current) + len(paragraph) + 1 > max_chars:
+                chunks.append((title, current))
+                current = ""
+            current = f"{current}\n{paragraph}" if current else paragraph
+        if current:
+            chunks.append((title, current))
+    return chunks
+
+class BM25Index():
+    """Okapi BM25 over an inverted index, documents can be added at any time"""
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = [] # (text, metadata)
+        self.lengths = []
+        self.total_length = 0
+        self.postings = {} # term -> {document id: term frequency}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, text, metadata=None):
+        tokens = normalize_tokens(text)
+        with self.lock:
+            document_id = len(self.documents)
+            self.documents.append((text, metadata))
+            self.lengths.append(len(tokens))
+            self.total_length += len(tokens)
+
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, frequency in frequencies.items():
+                self.postings.setdefault(token, {})[document_id] = frequency
+        return document_id
+
+    def rank(self, query):
+        """Returns [(document id, score)] of every document sharing a term with the query, best first"""
+        with self.lock:
+            if not self.documents:
+                return []
+
+            count = len(self.documents)
+            average_length = self.total_length / count or 1
+            scores = {}
+            # only documents containing a query term are ever touched
+            for term in set(normalize_tokens(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for document_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[document_id] / average_length)
+                    scores[document_id] = scores.get(document_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def search(self, query, k=5, offset=0):
+        """Returns [(score, text, metadata)] of the best matches, offset skips that many results for paging"""
+        ranked = self.rank(query)[offset:offset + k]
+        return [(score, *self.documents[document_id]) for document_id, score in ranked]
+
+class DocumentStore():
+    """Everything the research tools fetched during a run, split into passages and searchable with BM25"""
+    def __init__(self):
+        self.index = BM25Index()
+        self.sources = set() # (backend, search term) already stored
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, backend, search_term, text):
+        with self.lock:
+            if (backend, search_term) in self.sources:
+                return
+            self.sources.add((backend, search_term))
+
+        for title, passage in chunk_article(text):
+            self.index.add(passage, metadata=(backend, search_term, title))
+
+    def search(self, query, k=5):
+        return self.index.search(query, k=k)
@@ -0,0 +1,326 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# seconds before a cached search result goes stale, news moves faster than encyclopedia pages
+BACKEND_TTL = {
+    'duck_duck_go': 6 * 60 * 60,
+    'wikipedia_shallow': 7 * 24 * 60 * 60,
+    'wikipedia_deep': 7 * 24 * 60 * 60,
+    'arxiv': 24 * 60 * 60,
+    'llm': 24 * 60 * 60, # LLM responses, see ResponseCache.py
+    'wikipedia_title': 30 * 24 * 60 * 60, # which article a wikipedia search redirected to, see QueryKeys.py
+    'search_term': 7 * 24 * 60 * 60, # raw search terms looked up, as long as the longest lived result, see QueryKeys.py
+}
+
+# set TIMELINER_CACHE_PATH to an empty string to keep the cache in memory only
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "timeliner", "search_cache.sqlite3")
+
+class MemoryLRU():
+    """Process-wide in-memory tier, least recently used entries are evicted once max_entries is reached"""
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (value, expires_at)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires_at):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class CompressedLRU():
+    """In-memory tier bounded by total bytes instead of entry count, values are kept zlib compressed
+    and only decompressed on a hit, meant for full wikipedia articles"""
+    def __init__(self, max_bytes=32 * 1024 * 1024, level=6):
+        self.max_bytes = max_bytes
+        self.level = level
+        self.entries = OrderedDict() # key -> (compressed value, expires_at, uncompressed size)
+        self.lock = threading.Lock()
+
+        self.total_bytes = 0 # compressed size of everything held
+        self.raw_bytes = 0 # size the same entries would take uncompressed
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self.discard(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            compressed = entry[0]
+
+        return zlib.decompress(compressed).decode("utf-8")
+
+    def set(self, key, value, expires_at):
+        raw = value.encode("utf-8")
+        compressed = zlib.compress(raw, self.level)
+
+        with self.lock:
+            # an older value under this key goes even if the new one is rejected, it would be stale
+            if key in self.entries:
+                self.discard(key)
+            if len(compressed) > self.max_bytes:
+                return # would evict everything else and still not fit
+
+            self.entries[key] = (compressed, expires_at, len(raw))
+            self.total_bytes += len(compressed)
+            self.raw_bytes += len(raw)
+
+            while self.total_bytes > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def discard(self, key):
+        # caller holds the lock
+        compressed, _, raw_size = self.entries.pop(key)
+        self.total_bytes -= len(compressed)
+        self.raw_bytes -= raw_size
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes': self.total_bytes,
+            'raw_bytes': self.raw_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+class DiskCache():
+    """SQLite tier that survives restarts, each backend keeps at most max_entries rows"""
+    def __init__(self, path, max_entries=20000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # one connection shared by every thread, access is serialized by self.lock
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            "backend TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, "
+            "accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (backend, key))"
+        )
+        self.connection.commit()
+
+    def get(self, backend, key):
+        with self.lock:
+            now = time.time()
+            row = self.connection.execute(
+                "SELECT value, expires_at FROM search_cache WHERE backend = ? AND key = ?",
+                (backend, key),
+            ).fetchone()
+
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None, None
+
+            self.connection.execute(
+                "UPDATE search_cache SET accessed_at = ? WHERE backend = ? AND key = ?",
+                (now, backend, key),
+            )
+            self.connection.commit()
+            self.hits += 1
+            return row[0], row[1]
+
+    def set(self, backend, key, value, expires_at):
+        with self.lock:
+            now = time.time()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO search_cache (backend, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (backend, key, value, expires_at, now),
+            )
+
+            # expired rows go first, then the least recently used rows above the size cap
+            evicted = self.connection.execute(
+                "DELETE FROM search_cache WHERE backend = ? AND expires_at < ?", (backend, now)
+            ).rowcount
+            evicted += self.connection.execute(
+                "DELETE FROM search_cache WHERE backend = ? AND key IN ("
+                "SELECT key FROM search_cache WHERE backend = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (backend, backend, self.max_entries),
+            ).rowcount
+            self.connection.commit()
+            self.evictions += evicted
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class Flight():
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight():
+    """Coalesces identical in-flight requests, the first caller of a key runs the fetch and later callers wait for its result"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {} # key -> Flight
+        self.coalesced = 0
+
+    def do(self, key, fetch):
+        """Returns (value, coalesced), an exception raised by the fetch is raised in every caller"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = fetch()
+            return flight.value, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+class SearchCache():
+    """Two-tier search cache, memory first and SQLite second, shared by every Tools instance in the process"""
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttls=None, memory_entries=2048, disk_entries=20000, article_bytes=32 * 1024 * 1024, response_entries=512):
+        self.ttls = dict(BACKEND_TTL if ttls is None else ttls)
+        self.memory = MemoryLRU(max_entries=memory_entries)
+        self.disk = DiskCache(path, max_entries=disk_entries) if path else None
+
+        # full articles are large enough that an entry count says nothing about memory use
+        self.articles = CompressedLRU(max_bytes=article_bytes)
+        # LLM responses get their own tier so they don't push search results out, and vice versa
+        self.responses = MemoryLRU(max_entries=response_entries)
+        # raw search terms are only bookkeeping, they don't get to push search results out either
+        self.terms = MemoryLRU(max_entries=memory_entries)
+        self.memory_tiers = {
+            'wikipedia_deep': self.articles,
+            'llm': self.responses,
+            'search_term': self.terms,
+        }
+
+        # a miss that is already being fetched by another caller waits for that fetch instead of repeating it
+        self.flights = SingleFlight()
+
+    def memory_tier(self, backend):
+        return self.memory_tiers.get(backend, self.memory)
+
+    def get(self, backend, key):
+        """Returns (value, tier) where tier is 'memory' or 'disk', or (None, None) on a miss"""
+        value = self.memory_tier(backend).get((backend, key))
+        if value is not None:
+            return value, 'memory'
+
+        if self.disk is None:
+            return None, None
+
+        value, expires_at = self.disk.get(backend, key)
+        if value is None:
+            return None, None
+
+        # promote so the next lookup doesn't touch the disk
+        self.memory_tier(backend).set((backend, key), value, expires_at)
+        return value, 'disk'
+
+    def set(self, backend, key, value):
+        expires_at = time.time() + self.ttls.get(backend, 24 * 60 * 60)
+        self.memory_tier(backend).set((backend, key), value, expires_at)
+        if self.disk is not None:
+            self.disk.set(backend, key, value, expires_at)
+
+    def fetch_once(self, backend, key, fetch, resolve=None):
+        """Runs fetch() for a miss and caches its result, identical concurrent misses share the one call.
+        Returns (value, coalesced), coalesced is True for callers that got another caller's result.
+        resolve, if given, returns the key to store the result under once it is fetched, ex. a redirected wikipedia title"""
+        def fetch_and_set():
+            value = fetch()
+            self.set(backend, resolve() if resolve else key, value)
+            return value
+
+        return self.flights.do((backend, key), fetch_and_set)
+
+    def stats(self):
+        return {
+            'coalesced': self.flights.coalesced,
+            'memory': self.memory.stats(),
+            'articles': self.articles.stats(),
+            'responses': self.responses.stats(),
+            'disk': self.disk.stats() if self.disk is not None else None,
+        }
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def get_search_cache():
+    """Returns the process-wide search cache, created on first use"""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = SearchCache(path=os.environ.get("TIMELINER_CACHE_PATH", DEFAULT_CACHE_PATH))
+        return _shared_cache
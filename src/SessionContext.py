@@ -0,0 +1,34 @@
+"""
+Per-session state for objects shared by every session of the process.
+
+The agents, their tools, the chat model client and the compiled graph are built once (see ModelGraph.GraphRuntime)
+and hold a CurrentSession as their st. It forwards to the ST_Proxy bound here by the session they are working for,
+so the shared objects never keep any state of their own. AgentGraph binds its ST_Proxy around every call and a
+parallel researcher sub-run binds its forked child proxy.
+
+The binding lives in a contextvar. LangGraph runs nodes and tools in copies of the caller's context, and so does
+asyncio for tasks. Threads started by hand have to run in one too (contextvars.copy_context().run), as for Tracing.
+"""
+import contextlib
+import contextvars
+
+_current = contextvars.ContextVar("timeliner_session", default=None)
+
+@contextlib.contextmanager
+def bind(st):
+    token = _current.set(st)
+    try:
+        yield st
+    finally:
+        _current.reset(token)
+
+def current():
+    st = _current.get()
+    if st is None:
+        raise RuntimeError("No session is bound, shared agents and tools only work inside AgentGraph.call or SessionContext.bind")
+    return st
+
+class CurrentSession():
+    """Stands in for the ST_Proxy of whichever session is bound, attribute access is forwarded to it"""
+    def __getattr__(self, name):
+        return getattr(current(), name)
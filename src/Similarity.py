@@ -0,0 +1,164 @@
+import random
+import re
+import zlib
+
+# words that carry no topic information in a research question
+STOPWORDS = {
+    'a', 'about', 'after', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'been', 'before', 'between', 'by',
+    'can', 'current', 'currently', 'did', 'do', 'does', 'during', 'for', 'from', 'happen', 'happened',
+    'has', 'have', 'how', 'i', 'in', 'into', 'is', 'it', 'its', 'key', 'main', 'major', 'me', 'most',
+    'of', 'on', 'or', 'over', 'since', 'so', 'some', 'that', 'the', 'their', 'there', 'these', 'this',
+    'to', 'was', 'were', 'what', 'when', 'where', 'which', 'who', 'why', 'will', 'with', 'within',
+}
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+def stem(token):
+    # crude suffix stripping, enough to line up "releases"/"released"/"releasing"
+    for suffix in ('ing', 'ed', 'es', 's', 'e'):
+        if len(token) > len(suffix) + 2 and token.endswith(suffix):
+            return token[:-len(suffix)]
+    return token
+
+def normalize_tokens(text):
+    """Lowercased, stemmed word tokens of a text without stopwords"""
+    return [stem(token) for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+class QuestionIndex():
+    """MinHash/LSH index of every question asked in a run, finds near-duplicates without scanning the history"""
+    def __init__(self, threshold=0.6, bands=21, rows=3, seed=689):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+
+        generator = random.Random(seed)
+        self.permutations = [
+            (generator.randrange(1, _MERSENNE_PRIME), generator.randrange(0, _MERSENNE_PRIME))
+            for _ in range(bands * rows)
+        ]
+
+        self.entries = [] # [question, token set, answered]
+        self.exact = {} # normalized question -> entry index
+        self.buckets = [{} for _ in range(bands)] # band -> {band signature: [entry index]}
+
+    def signature(self, tokens):
+        hashes = [zlib.crc32(token.encode("utf-8")) for token in tokens]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self.permutations]
+
+    def band_keys(self, signature):
+        return [tuple(signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def add(self, question, answered=False):
+        tokens = normalize_tokens(question)
+        key = " ".join(tokens)
+        if key in self.exact:
+            self.entries[self.exact[key]][2] |= answered
+            return
+
+        index = len(self.entries)
+        self.entries.append([question, set(tokens), answered])
+        self.exact[key] = index
+
+        if tokens:
+            for band, band_key in enumerate(self.band_keys(self.signature(tokens))):
+                self.buckets[band].setdefault(band_key, []).append(index)
+
+    def mark_answered(self, question):
+        key = " ".join(normalize_tokens(question))
+        if key in self.exact:
+            self.entries[self.exact[key]][2] = True
+        else:
+            self.add(question, answered=True)
+
+    def find(self, question):
+        """Returns (earlier question, similarity, answered) of the closest match above the threshold, or None"""
+        tokens = normalize_tokens(question)
+        key = " ".join(tokens)
+        if key in self.exact:
+            match = self.entries[self.exact[key]]
+            return match[0], 1.0, match[2]
+
+        if not tokens:
+            return None
+
+        # only entries sharing at least one band with the question are compared
+        candidates = set()
+        for band, band_key in enumerate(self.band_keys(self.signature(tokens))):
+            candidates.update(self.buckets[band].get(band_key, ()))
+
+        token_set = set(tokens)
+        best = None
+        for index in sorted(candidates):
+            match_question, match_tokens, answered = self.entries[index]
+            similarity = len(token_set & match_tokens) / len(token_set | match_tokens)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (match_question, similarity, answered)
+
+        return best
+
+# matches the (MM-DD-YYYY) prefix the researcher is told to put on every note
+NOTE_DATE = re.compile(r"^\(?\s*(\d{1,2})[-/](\d{1,2})[-/](\d{2,4})\s*\)?\s*:?\s*")
+
+_rouge_scorer = None
+
+def get_rouge_scorer():
+    """ROUGE-L scorer from rouge-score, None if the package isn't installed"""
+    global _rouge_scorer
+    if _rouge_scorer is None:
+        try:
+            from rouge_score import rouge_scorer
+        except ImportError:
+            return None
+        _rouge_scorer = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
+    return _rouge_scorer
+
+class NoteIndex():
+    """Duplicate check for notes, an exact match on the normalized text first,
+    then ROUGE-L against the notes logged under the same date"""
+    def __init__(self, threshold=0.6):
+        self.threshold = threshold
+        self.exact = {} # normalized note -> note
+        self.by_date = {} # (month, day, year) -> [(note, body)]
+
+    @staticmethod
+    def normalize(note):
+        return " ".join(note.lower().split())
+
+    @staticmethod
+    def split_date(note):
+        """Returns the (month, day, year) of a note and the text after the date, the date is None if there's no prefix"""
+        match = NOTE_DATE.match(note)
+        if not match:
+            return None, note
+        month, day, year = (int(part) for part in match.groups())
+        return (month, day, year), note[match.end():]
+
+    def find(self, note):
+        """Returns (existing note, similarity) if the note is a duplicate, or None"""
+        existing = self.exact.get(self.normalize(note))
+        if existing is not None:
+            return existing, 1.0
+
+        date, body = self.split_date(note)
+        scorer = get_rouge_scorer()
+        if date is None or scorer is None:
+            return None
+
+        best = None
+        for existing, existing_body in self.by_date.get(date, ()):
+            similarity = scorer.score(existing_body, body)['rougeL'].fmeasure
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (existing, similarity)
+        return best
+
+    def add(self, note):
+        self.exact[self.normalize(note)] = note
+        date, body = self.split_date(note)
+        if date is not None:
+            self.by_date.setdefault(date, []).append((note, body))
+
+    def copy(self):
+        index = NoteIndex(threshold=self.threshold)
+        index.exact = dict(self.exact)
+        index.by_date = {date: list(notes) for date, notes in self.by_date.items()}
+        return index
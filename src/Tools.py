@@ -2,27 +2,144 @@ from langchain_core.tools import tool
 from langchain_core.messages import ToolMessage
 from langchain_core.runnables import RunnableLambda
 from langgraph.prebuilt import ToolNode
-import streamlit as st
+import asyncio
 import functools
 import datetime
-from duckduckgo_search import DDGS
-import wikipedia
-import arxiv
+import threading
+import weakref
+from collections import OrderedDict
+
+from SearchCache import get_search_cache
+from Resilience import get_resilience, BackendUnavailable
+from Retrieval import BM25Index, chunk_article
+import QueryKeys
+from ResultFormat import format_result
+from PromptState import count_tokens
+import Tracing
 
 # from GoogleAPIHelper import GoogleAPIHelper
 # google_api = GoogleAPIHelper()
 
+# the search clients are imported on first use, headless workers that never search don't pay for them
+
+def fetch_duck_duck_go(search_term):
+    from duckduckgo_search import DDGS
+    result = DDGS().text(search_term, max_results=10)
+    return str(result)
+
+def fetch_arxiv(search_term):
+    import arxiv
+
+    # Create client and search
+    client = arxiv.Client()
+    search = arxiv.Search(
+        query=search_term,
+        max_results=5,
+        sort_by=arxiv.SortCriterion.SubmittedDate
+    )
+
+    # Fetch results
+    results = []
+    for result in client.results(search):
+        paper_info = {
+            'title': result.title,
+            'authors': ', '.join(author.name for author in result.authors),
+            'abstract': result.summary,
+            'url': result.entry_id,
+            'published': result.published.strftime('%Y-%m-%d')
+        }
+        results.append(paper_info)
+
+    # Format results as a string
+    if not results:
+        return "No papers found matching the search term."
+
+    result_str = "Top 5 most recent papers:\n\n"
+    for i, paper in enumerate(results, 1):
+        result_str += f"{i}. Title: {paper['title']}\n"
+        result_str += f"   Authors: {paper['authors']}\n"
+        result_str += f"   Published: {paper['published']} (YYYY-MM-DD)\n"
+        result_str += f"   URL: {paper['url']}\n"
+        result_str += f"   Abstract: {paper['abstract']}\n\n"
+    return result_str
+
+def fetch_wikipedia_shallow(search_term):
+    import wikipedia
+    # the same requests wikipedia.summary makes, the page tells which article the search landed on
+    page = wikipedia.page(search_term)
+    QueryKeys.learn_wikipedia_title(search_term, page.title)
+    return str(page.summary)
+
+def fetch_wikipedia_deep(search_term):
+    import wikipedia
+    page = wikipedia.page(search_term)
+    QueryKeys.learn_wikipedia_title(search_term, page.title)
+    return str(page.content)
+
+# the function behind each search backend, benchmarks and tests swap entries for stubs
+BACKENDS = {
+    'duck_duck_go': fetch_duck_duck_go,
+    'arxiv': fetch_arxiv,
+    'wikipedia_shallow': fetch_wikipedia_shallow,
+    'wikipedia_deep': fetch_wikipedia_deep,
+}
+
+# the session counter of every backend, and where a search goes while its backend is unavailable
+BACKEND_COUNTERS = {
+    'duck_duck_go': 'DDGS_calls',
+    'arxiv': 'arxiv_calls',
+    'wikipedia_shallow': 'wikipedia_shallow_calls',
+    'wikipedia_deep': 'wikipedia_deep_calls',
+}
+
+FALLBACKS = {
+    'duck_duck_go': ['wikipedia_shallow'],
+    'arxiv': ['duck_duck_go'],
+    'wikipedia_shallow': ['duck_duck_go'],
+    'wikipedia_deep': ['duck_duck_go'],
+}
+
+# caps the number of in-flight requests per search backend for the async tool variants
+# these are shared by every session running on the same event loop
+BACKEND_CONCURRENCY = {
+    'duck_duck_go': 4,
+    'wikipedia': 4,
+    'arxiv': 2,
+}
+
+_backend_semaphores = weakref.WeakKeyDictionary() # event loop -> {backend: semaphore}
+
+def get_backend_semaphore(backend):
+    """Returns the semaphore of a backend for the running event loop, asyncio primitives can't be shared across loops"""
+    semaphores = _backend_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if backend not in semaphores:
+        semaphores[backend] = asyncio.Semaphore(BACKEND_CONCURRENCY[backend])
+    return semaphores[backend]
+
+def with_async_variant(search_tool, backend):
+    """Gives a blocking search tool an async variant that waits for a backend slot before running"""
+    # the search libraries only ship blocking clients, so the request runs on the default executor
+    # the semaphore keeps the number of threads parked on one backend bounded no matter how many sessions are waiting
+    async def coroutine(search_term: str, **kwargs) -> str:
+        async with get_backend_semaphore(backend):
+            return await asyncio.to_thread(search_tool.func, search_term, **kwargs)
+
+    search_tool.coroutine = coroutine
+    return search_tool
+
 class Tools:
     def __init__(self, st=None, assistant=None, tool_set="questioner"):
         self.st = st
+
+        # caches reduce the chances of a rate limit error, this one is shared by every session and survives restarts
+        self.cache = get_search_cache()
+        # rate limits, retries and circuit breakers of the backends, also shared by every session, see Resilience.py
+        self.resilience = get_resilience()
+        self.passage_indexes = OrderedDict() # search term -> BM25 index over the article's passages
+        self.passage_lock = threading.Lock()
+
         self.tools = self.get_tools(tool_set)
         if self.tools:
-            # caches reduce the chances of a rate limit error
-            self.ddg_cache = {}
-            self.wiki_shallow_cache = {}
-            self.wiki_deep_cache = {}
-            self.arxiv_cache = {}
-
             self.tools_fallback = self.create_tool_node_with_fallback(self.tools)
             self.assistant = assistant.bind_tools(self.tools)
         else:
@@ -49,10 +166,174 @@ class Tools:
             [RunnableLambda(handle_tool_error)], exception_key="error"
         )
 
+    def with_timing(self, timed_tool):
+        """Records the duration (and a tracing span) of every call of the tool under tool=name, async variants call the same func"""
+        func = timed_tool.func
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with Tracing.span(timed_tool.name, kind="tool", arguments=str(kwargs or args)[:300]):
+                with self.st.session_state.metrics.timer('tool_seconds', tool=timed_tool.name):
+                    return func(*args, **kwargs)
+
+        timed_tool.func = timed
+        return timed_tool
+
+    def run_search(self, backend, counter, search_term, present=None, fallback=True):
+        """Shared plumbing of the research tools: call counting, cache lookup, blacklist and error handling
+        present, if given, turns a successful (cached or fetched) result into what the LLM sees
+        fallback, if the backend is unavailable, answers from a FALLBACKS backend instead (not for present)"""
+        private_information_blacklist = self.st.secrets.BLACKLIST_SEARCH_TERMS or []
+
+        self.st.session_state[counter] += 1
+
+        # a replay is served from the cassette alone, it doesn't depend on or change what is cached
+        cassette = self.st.options.get('cassette')
+        replaying = cassette is not None and cassette.replaying
+
+        # Check cache first, under the canonical form of the search term (see QueryKeys.py)
+        key, cached, tier, seen_term = None, None, None, False
+        if not replaying:
+            key = self.cache_key(backend, search_term)
+            cached, tier = self.cache.get(backend, key)
+            # a hit on a term looked up before would have been a hit with the raw term as the key as well
+            seen_term = QueryKeys.look_up_term(self.cache, backend, search_term)
+        Tracing.set_attributes(backend=backend, cache_key=key, cache_hit=cached is not None, cache_tier=tier)
+        if cached is not None:
+            self.st.session_state.web_call_cache_hits += 1
+            self.st.session_state[f"web_call_cache_hits_{tier}"] += 1
+            if seen_term:
+                self.st.session_state.web_call_cache_hits_exact += 1
+            self.st.session_state.document_store.add(backend, search_term, cached)
+            if cassette:
+                cassette.observe(backend, search_term, cached)
+            return self.show(backend, cached, present)
+
+        try:
+            for term in private_information_blacklist:
+                if term in search_term.lower():
+                    self.st.session_state.call_failures += 1
+                    return f"There was an error executing the search: You cannot search private information online ({term})"
+
+            # the cassette records an unavailable backend too, so a replay takes the same fallback
+            guarded = functools.partial(self.resilience.call, backend, BACKENDS[backend], metrics=self.st.session_state.metrics)
+
+            def fetch():
+                if cassette:
+                    return cassette.fetch(backend, search_term, guarded, errors=(BackendUnavailable,))
+                return guarded(search_term)
+
+            if replaying:
+                result_str, coalesced = fetch(), False
+            else:
+                # the result is cached by the cache itself, identical searches in flight right now share this one
+                resolve = lambda: self.cache_key(backend, search_term)
+                result_str, coalesced = self.cache.fetch_once(backend, key, fetch, resolve=resolve)
+            Tracing.set_attributes(coalesced=coalesced)
+            if coalesced:
+                self.st.session_state.web_call_coalesced += 1
+                if cassette:
+                    cassette.observe(backend, search_term, result_str)
+            self.st.session_state.document_store.add(backend, search_term, result_str)
+
+            return self.show(backend, result_str, present)
+        except BackendUnavailable as e:
+            self.st.session_state.call_failures += 1
+            Tracing.set_attributes(error=f"{type(e).__name__}: {e}")
+            if fallback and present is None:
+                return self.fall_back(backend, search_term, e)
+            return f"There was an error executing the search: {str(e)}. Try a different search tool for now."
+        except Exception as e:
+            self.st.session_state.call_failures += 1
+            Tracing.set_attributes(error=f"{type(e).__name__}: {e}")
+            return f"There was an error executing the search: {str(e)}"
+
+    def show(self, backend, result_str, present=None):
+        """What the LLM sees of a raw result, compacted per backend (see ResultFormat.py) unless present is given.
+        The tokens of the raw and the shown result are recorded for every call."""
+        if present:
+            shown = present(result_str)
+        elif self.st.options.get('compact_search_results', True):
+            shown = format_result(backend, result_str, self.st.options.get('search_result_chars'))
+        else:
+            shown = result_str
+
+        raw_tokens, shown_tokens = count_tokens(result_str), count_tokens(shown)
+        self.st.session_state.search_tokens_raw += raw_tokens
+        self.st.session_state.search_tokens_shown += shown_tokens
+        self.st.session_state.metrics.inc('search_tokens_raw', raw_tokens, backend=backend)
+        self.st.session_state.metrics.inc('search_tokens_shown', shown_tokens, backend=backend)
+        Tracing.set_attributes(tokens_raw=raw_tokens, tokens_shown=shown_tokens)
+        return shown
+
+    def cache_key(self, backend, search_term):
+        if not self.st.options.get('canonical_search_keys', True):
+            return search_term
+        return QueryKeys.cache_key(self.cache, backend, search_term)
+
+    def fall_back(self, backend, search_term, error):
+        """Runs the search on the first available fallback of an unavailable backend, so the LLM doesn't spend a turn retrying"""
+        for other in FALLBACKS.get(backend, []):
+            if not self.resilience.available(other):
+                continue
+
+            self.st.session_state.metrics.inc('backend_fallbacks', backend=backend, fallback=other)
+            result_str = self.run_search(other, BACKEND_COUNTERS[other], search_term, fallback=False)
+            return f"{backend} is unavailable right now ({error}), these are the results of {other} instead:\n\n{result_str}"
+
+        return f"There was an error executing the search: {str(error)}. Try a different search tool for now."
+
+    def select_passages(self, search_term, article, page=1):
+        """Ranks the sections of a wikipedia article against the search term and research question, returns one page of passages"""
+        k = self.st.options.get('wiki_passages')
+        max_chars = self.st.options.get('wiki_passage_chars', 4000)
+
+        # chunking and indexing an article is redone only when a different article comes in
+        with self.passage_lock:
+            index = self.passage_indexes.get(search_term)
+            if index is None:
+                index = BM25Index()
+                for title, text in chunk_article(article):
+                    index.add(f"{title}\n{text}", metadata=title)
+                self.passage_indexes[search_term] = index
+            self.passage_indexes.move_to_end(search_term)
+            while len(self.passage_indexes) > 8:
+                self.passage_indexes.popitem(last=False)
+
+        questions = self.st.session_state.questions
+        query = f"{search_term} {questions[0]}" if questions else search_term
+
+        # best matches first, then whatever didn't match in article order so paging can still reach every passage
+        matched = [document_id for document_id, _ in index.rank(query)]
+        matched_ids = set(matched)
+        order = matched + [document_id for document_id in range(len(index)) if document_id not in matched_ids]
+
+        page = max(1, page)
+        page_ids = order[(page - 1) * k:page * k]
+        if not page_ids:
+            return f"No more passages in the wikipedia article for '{search_term}'."
+        passages = [index.documents[document_id] for document_id in page_ids]
+
+        result_str = f"Wikipedia passages for '{search_term}' (page {page}, {len(index)} passages in the article):\n\n"
+        for text, title in passages:
+            body = text.split("\n", 1)[-1]
+            passage = f"[{title}]\n{body}\n\n"
+            if len(result_str) + len(passage) > max_chars:
+                passage = passage[:max(0, max_chars - len(result_str))] + " ...\n\n"
+                result_str += passage
+                break
+            result_str += passage
+
+        if page * k < len(order):
+            result_str += f"Call wikipedia_deep with search_term='{search_term}' and page={page + 1} for more passages."
+        return result_str
+
     def get_tools(self, tool_set="questioner"):
         def action_request(func): # ideally some tools should ask us for confirmation before submitting but I'm out of time to code this
             @functools.wraps(func) # we need this to preserve the docstrings for each tool when we wrap it
             def wrapper(*args, **kwargs):
+                import streamlit as st # confirmations only exist in the streamlit page
+
                 # Generate the confirmation message
                 params = ', '.join([str(arg) for arg in args] + [f"{k}={v}" for k, v in kwargs.items()])
                 confirmation_message = f"Do you want to execute '{func.__name__}' with parameters: {params}? Reply 'yes' or 'no'."
@@ -96,19 +377,17 @@ class Tools:
                     error_messages.append(f"Question already exists: '{cleaned_question}'")
                     continue
                     
-                # Check if question is a substring of or contains any answered questions
-                substring_match = False
-                for answered in self.st.session_state.answered_questions:
-                    if cleaned_question.lower() in answered.lower() or answered.lower() in cleaned_question.lower():
-                        error_messages.append(f"Question '{cleaned_question}' is too similar to previously answered question: '{answered}'")
-                        substring_match = True
-                        break
-                        
-                if substring_match:
+                # Check if question is a near-duplicate of a queued or answered question
+                match = self.st.session_state.question_index.find(cleaned_question)
+                if match:
+                    earlier_question, similarity, answered = match
+                    status = "previously answered" if answered else "already queued"
+                    error_messages.append(f"Question '{cleaned_question}' is too similar to {status} question: '{earlier_question}' (similarity {similarity:.2f})")
                     continue
                     
                 # Add the question if it passes all checks
                 self.st.session_state.questions.append(cleaned_question)
+                self.st.session_state.question_index.add(cleaned_question)
                 success_count += 1
             
             # Construct response message
@@ -123,149 +402,51 @@ class Tools:
         @tool
         def duck_duck_go(search_term: str) -> str:
             '''Search online. Useful for initial search or informal searching. Do not search private information online. Information may be incorrect.'''
-            private_information_blacklist = st.secrets["BLACKLIST_SEARCH_TERMS"]
-
-            self.st.session_state.DDGS_calls += 1
-
-            # Check cache first
-            if search_term in self.ddg_cache:
-                self.st.session_state.web_call_cache_hits += 1
-                return self.ddg_cache[search_term]
-
-            try:
-                for term in private_information_blacklist:
-                    if term in search_term.lower():
-                        self.st.session_state.call_failures += 1
-                        return f"There was an error executing the search: You cannot search private information online ({term})"
-
-                result = DDGS().text(search_term, max_results=10)
-                result_str = str(result)
-                
-                # Cache the result
-                self.ddg_cache[search_term] = result_str
-                
-                return result_str
-            except Exception as e:
-                self.st.session_state.call_failures += 1
-                return f"There was an error executing the search: {str(e)}"
+            return self.run_search('duck_duck_go', 'DDGS_calls', search_term)
         
         @tool
         def arxiv_search(search_term: str) -> str:
             '''Search on arxiv. Returns abstracts of the top 5 most recent academic papers matching the search term.'''
-            private_information_blacklist = st.secrets["BLACKLIST_SEARCH_TERMS"]
-
-            self.st.session_state.arxiv_calls += 1
-
-            # Check cache first
-            if search_term in self.arxiv_cache:
-                self.st.session_state.web_call_cache_hits += 1
-                return self.arxiv_cache[search_term]
-
-            try:
-                # Check for blacklisted terms
-                for term in private_information_blacklist:
-                    if term in search_term.lower():
-                        self.st.session_state.call_failures += 1
-                        return f"There was an error executing the search: You cannot search private information online ({term})"
-
-                # Create client and search
-                client = arxiv.Client()
-                search = arxiv.Search(
-                    query=search_term,
-                    max_results=5,
-                    sort_by=arxiv.SortCriterion.SubmittedDate
-                )
-
-                # Fetch results
-                results = []
-                for result in client.results(search):
-                    paper_info = {
-                        'title': result.title,
-                        'authors': ', '.join(author.name for author in result.authors),
-                        'abstract': result.summary,
-                        'url': result.entry_id,
-                        'published': result.published.strftime('%Y-%m-%d')
-                    }
-                    results.append(paper_info)
-
-                # Format results as a string
-                if not results:
-                    result_str = "No papers found matching the search term."
-                else:
-                    result_str = "Top 5 most recent papers:\n\n"
-                    for i, paper in enumerate(results, 1):
-                        result_str += f"{i}. Title: {paper['title']}\n"
-                        result_str += f"   Authors: {paper['authors']}\n"
-                        result_str += f"   Published: {paper['published']} (YYYY-MM-DD)\n"
-                        result_str += f"   URL: {paper['url']}\n"
-                        result_str += f"   Abstract: {paper['abstract']}\n\n"
-
-                # Cache the result
-                self.arxiv_cache[search_term] = result_str
-                
-                return result_str
-            except Exception as e:
-                self.st.session_state.call_failures += 1
-                return f"There was an error executing the search: {str(e)}"
+            return self.run_search('arxiv', 'arxiv_calls', search_term)
 
         @tool
         def wikipedia_shallow(search_term: str) -> str:
             '''Shallow wikipedia search, only provides a summary. Useful for quick referencing and low token usage. For a deeper search, use wikipedia_deep.'''
-            private_information_blacklist = st.secrets["BLACKLIST_SEARCH_TERMS"]
-
-            self.st.session_state.wikipedia_shallow_calls += 1
-
-            # Check cache first
-            if search_term in self.wiki_shallow_cache:
-                self.st.session_state.web_call_cache_hits += 1
-                return self.wiki_shallow_cache[search_term]
-
-            try:
-                for term in private_information_blacklist:
-                    if term in search_term.lower():
-                        self.st.session_state.call_failures += 1
-                        return f"There was an error executing the search: You cannot search private information online ({term})"
-
-                result = wikipedia.summary(search_term)
-                result_str = str(result)
-                
-                # Cache the result
-                self.wiki_shallow_cache[search_term] = result_str
-                
-                return result_str
-            except Exception as e:
-                self.st.session_state.call_failures += 1
-                return f"There was an error executing the search: {str(e)}"
+            return self.run_search('wikipedia_shallow', 'wikipedia_shallow_calls', search_term)
 
         @tool
         def wikipedia_deep(search_term: str) -> str:
             '''Provides the full wikipedia text on requested content. This is VERY expensive. It is recommended that wikipedia_shallow is called first.'''
-            private_information_blacklist = st.secrets["BLACKLIST_SEARCH_TERMS"]
-
-            self.st.session_state.wikipedia_deep_calls += 1
+            return self.run_search('wikipedia_deep', 'wikipedia_deep_calls', search_term)
 
-            # Check cache first
-            if search_term in self.wiki_deep_cache:
-                self.st.session_state.web_call_cache_hits += 1
-                return self.wiki_deep_cache[search_term]
-
-            try:
-                for term in private_information_blacklist:
-                    if term in search_term.lower():
-                        self.st.session_state.call_failures += 1
-                        return f"There was an error executing the search: You cannot search private information online ({term})"
-
-                result = wikipedia.page(search_term).content
-                result_str = str(result)
-                
-                # Cache the result
-                self.wiki_deep_cache[search_term] = result_str
-                
-                return result_str
-            except Exception as e:
-                self.st.session_state.call_failures += 1
-                return f"There was an error executing the search: {str(e)}"
+        @tool("wikipedia_deep")
+        def wikipedia_passages(search_term: str, page: int = 1) -> str:
+            '''Reads the wikipedia article on requested content and returns only the passages most relevant to the search term and your research question. It is recommended that wikipedia_shallow is called first. Call again with page=2, 3, ... to read further passages.'''
+            present = lambda article: self.select_passages(search_term, article, page)
+            return self.run_search('wikipedia_deep', 'wikipedia_deep_calls', search_term, present=present)
             
+        @tool
+        def search_fetched(query: str) -> str:
+            '''Searches the pages already fetched in this session by any search tool, without going online. Cheap and fast, try this before searching online.'''
+            self.st.session_state.search_fetched_calls += 1
+
+            store = self.st.session_state.document_store
+            results = store.search(query, k=5)
+            if not results:
+                return "Nothing fetched so far matches this query. Search online instead."
+
+            max_chars = self.st.options.get('fetched_passage_chars', 4000)
+            result_str = f"Passages from previously fetched pages ({len(store)} stored):\n\n"
+            for _, text, (backend, search_term, title) in results:
+                passage = f"[{backend}: '{search_term}', {title}]\n{text}\n\n"
+                if len(result_str) + len(passage) > max_chars:
+                    result_str += passage[:max(0, max_chars - len(result_str))] + " ...\n\n"
+                    break
+                result_str += passage
+
+            self.st.session_state.search_fetched_hits += 1
+            return result_str
+
         @tool
         def log_timeline(day: int, month: int, year: int, title: str, description: str) -> str:
             '''Log information learned from online sources, this log will be used to build a timeline. Avoid appending duplicates.'''
@@ -292,14 +473,19 @@ class Tools:
                 # Remove excess whitespace and normalize
                 cleaned_note = " ".join(note.strip().split())
                 
-                # Check for duplicates (case insensitive)
-                if any(existing_note.lower() == cleaned_note.lower() 
-                    for existing_note in self.st.session_state.notes):
-                    error_messages.append(f"Note already exists: '{cleaned_note}'")
+                # Check for duplicates (case insensitive), and reworded notes about the same date
+                match = self.st.session_state.note_index.find(cleaned_note)
+                if match:
+                    existing_note, similarity = match
+                    if similarity >= 1.0:
+                        error_messages.append(f"Note already exists: '{cleaned_note}'")
+                    else:
+                        error_messages.append(f"Note '{cleaned_note}' repeats an existing note from the same date: '{existing_note}' (ROUGE-L {similarity:.2f})")
                     continue
                     
                 # Add the note if it passes all checks
                 self.st.session_state.notes.append(cleaned_note)
+                self.st.session_state.note_index.add(cleaned_note)
                 success_count += 1
             
             # Construct response message
@@ -321,10 +507,21 @@ class Tools:
             
             return "Research has ended"
 
+        for timed_tool in [ask_questions, duck_duck_go, arxiv_search, wikipedia_shallow, wikipedia_deep, wikipedia_passages, search_fetched, log_timeline, take_notes, done]:
+            self.with_timing(timed_tool)
+
+        with_async_variant(duck_duck_go, 'duck_duck_go')
+        with_async_variant(wikipedia_shallow, 'wikipedia')
+        with_async_variant(wikipedia_deep, 'wikipedia')
+        with_async_variant(wikipedia_passages, 'wikipedia')
+        with_async_variant(arxiv_search, 'arxiv')
+
         if tool_set == "questioner":
             tools = [ask_questions]
         elif tool_set == "researcher":
-            tools = [duck_duck_go, take_notes, wikipedia_shallow, wikipedia_deep, arxiv_search]
+            # unless passage retrieval is turned off, wikipedia_deep only hands back the relevant parts of the article
+            wikipedia_article = wikipedia_deep if self.st.options.get('wiki_passages') is None else wikipedia_passages
+            tools = [search_fetched, duck_duck_go, take_notes, wikipedia_shallow, wikipedia_article, arxiv_search]
         elif tool_set == "builder":
             tools = []
 
@@ -0,0 +1,198 @@
+"""
+Structured tracing of a research run: one root span per AgentGraph.call, with child spans for every node visit,
+LLM request and tool call. Finished spans are appended to a JSONL file, one span per line.
+
+The current span lives in a contextvar, so spans nest across asyncio tasks by themselves. Threads started by hand
+have to run in a copy of the caller's context (contextvars.copy_context().run, see AgentGraph.research_batch).
+Outside of a traced run span() does nothing.
+
+    python src/Tracing.py traces.jsonl                        # self time per span name, slowest first
+    python src/Tracing.py traces.jsonl --chrome trace.json    # open in chrome://tracing or ui.perfetto.dev
+"""
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+_current_span = contextvars.ContextVar("timeliner_current_span", default=None)
+
+class Span():
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "kind", "attributes", "start", "end", "error", "lane")
+
+    def __init__(self, tracer, trace_id, parent_id, name, kind, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+        self.lane = current_lane()
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start,
+            "end_ns": self.end,
+            "duration_ms": round((self.end - self.start) / 1e6, 3),
+            "lane": self.lane,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+def current_lane():
+    """Where the span ran, the thread plus the asyncio task if any, so concurrent spans land on separate tracks"""
+    lane = threading.current_thread().name
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        lane += f"/{task.get_name()}"
+    return lane
+
+class JsonlExporter():
+    """Appends every finished span as one JSON line"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(line)
+
+class Tracer():
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    @contextlib.contextmanager
+    def start_run(self, name="run", **attributes):
+        """Root span of a new trace"""
+        with self.start_span(uuid.uuid4().hex, None, name, "run", attributes) as span:
+            yield span
+
+    @contextlib.contextmanager
+    def start_span(self, trace_id, parent_id, name, kind, attributes):
+        span = Span(self, trace_id, parent_id, name, kind, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end = time.time_ns()
+            self.exporter.export(span)
+
+class _NoSpan():
+    def set_attributes(self, **attributes):
+        pass
+
+NO_SPAN = _NoSpan()
+
+@contextlib.contextmanager
+def span(name, kind="internal", **attributes):
+    """A child of the current span, a no-op outside of a traced run"""
+    parent = _current_span.get()
+    if parent is None:
+        yield NO_SPAN
+        return
+
+    with parent.tracer.start_span(parent.trace_id, parent.span_id, name, kind, attributes) as child:
+        yield child
+
+def set_attributes(**attributes):
+    """Adds attributes to the current span, if there is one"""
+    current = _current_span.get()
+    if current is not None:
+        current.set_attributes(**attributes)
+
+def read_spans(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def to_chrome_trace(spans):
+    """Chrome trace event format, one complete event per span, every trace is a process and every lane a thread"""
+    pids = {}
+    tids = {}
+    events = []
+    for span in sorted(spans, key=lambda span: span["start_ns"]):
+        pid = pids.setdefault(span["trace_id"], len(pids) + 1)
+        tid = tids.setdefault((pid, span["lane"]), len(tids) + 1)
+        args = dict(span["attributes"])
+        if span["error"]:
+            args["error"] = span["error"]
+        events.append({
+            "name": span["name"],
+            "cat": span["kind"],
+            "ph": "X",
+            "ts": span["start_ns"] / 1000,
+            "dur": (span["end_ns"] - span["start_ns"]) / 1000,
+            "pid": pid,
+            "tid": tid,
+            "args": args,
+        })
+
+    for trace_id, pid in pids.items():
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"run {trace_id[:8]}"}})
+    for (pid, lane), tid in tids.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": lane}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def self_times(spans):
+    """Milliseconds per span name not covered by a child span, which is where the time of a run actually went"""
+    children = defaultdict(float)
+    for span in spans:
+        if span["parent_id"]:
+            children[span["parent_id"]] += span["duration_ms"]
+
+    totals = defaultdict(lambda: [0, 0.0, 0.0]) # name -> calls, total ms, self ms
+    for span in spans:
+        total = totals[span["name"]]
+        total[0] += 1
+        total[1] += span["duration_ms"]
+        # concurrent children can add up to more than their parent
+        total[2] += max(0.0, span["duration_ms"] - children[span["span_id"]])
+    return dict(totals)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize or convert a JSONL trace of research runs.")
+    parser.add_argument("trace", help="JSONL file written by the JsonlExporter")
+    parser.add_argument("--chrome", metavar="OUTPUT", help="write a Chrome trace event file for chrome://tracing or Perfetto")
+    args = parser.parse_args(argv)
+
+    spans = read_spans(args.trace)
+    if args.chrome:
+        with open(args.chrome, "w") as file:
+            json.dump(to_chrome_trace(spans), file)
+        print(f"{len(spans)} spans written to {args.chrome}")
+        return
+
+    print(f"{'span':<28} {'calls':>6} {'total ms':>11} {'self ms':>11}")
+    for name, (calls, total, own) in sorted(self_times(spans).items(), key=lambda item: -item[1][2]):
+        print(f"{name:<28} {calls:>6} {total:>11.1f} {own:>11.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,16 @@ from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.tools import tool
 
 from ModelGraph import AgentGraph
+from SearchCache import get_search_cache
+from Resilience import get_resilience
+from Config import estimate_cost
+from EventLog import EventLog, Throttle
+import ResponseCache
+
+# the transcript keeps the last EVENT_WINDOW events on screen, tool outputs longer than PREVIEW_CHARS are collapsed
+EVENT_WINDOW = 50
+PREVIEW_CHARS = 800
+META_REFRESH_SECONDS = 1.0
 
 # Streamlit app layout
 st.title("Timeline Researcher")
@@ -15,6 +25,29 @@ st.write("- DuckDuckGo")
 st.write("- Wikipedia")
 
 # Callback to handle event updates
+def format_latency(metrics, name, label):
+    """One line per node or tool, slowest in total first"""
+    lines = []
+    for labels, histogram in sorted(metrics.series(name), key=lambda item: -item[1].sum):
+        p = histogram.percentiles()
+        line = (
+            f"- {labels[label]}: {histogram.count:,} calls, {histogram.sum:.2f}s total, "
+            f"p50 {p['p50']:.2f}s, p95 {p['p95']:.2f}s, p99 {p['p99']:.2f}s"
+        )
+        if label == "node":
+            node = labels[label]
+            tokens = metrics.counter('node_input_tokens', node=node) + metrics.counter('node_output_tokens', node=node)
+            cache_hits = metrics.counter('node_llm_cache_hits', node=node) + metrics.counter('node_search_cache_hits', node=node) + metrics.counter('node_search_coalesced', node=node)
+            if tokens or cache_hits:
+                line += f", {tokens:,} tokens, {cache_hits:,} cache hits"
+        lines.append(line)
+    return "\n".join(lines) + "\n" if lines else "- N/A (nothing ran yet)\n"
+
+def format_saved(before, after):
+    if not before:
+        return "nothing saved yet"
+    return f"{(before - after) / before * 100:.1f}% saved"
+
 def get_meta_data():
     graph = st.session_state.my_graph
     session_state = graph.st.session_state
@@ -30,26 +63,88 @@ def get_meta_data():
     # Calculate total tokens
     total_tokens = session_state.input_tokens + session_state.output_tokens
 
+    # dollar figures use the questioner's model, every agent is built with the same one
+    model_name = ResponseCache.model_name_of(graph.questioner.llm)
+    total_cost = estimate_cost(model_name, session_state.input_tokens, session_state.output_tokens)
+    llm_cache_saved = estimate_cost(model_name, session_state.llm_cache_input_tokens_saved, session_state.llm_cache_output_tokens_saved)
+
+    budget_info = ""
+    if graph.budget is not None:
+        units = {'tokens': "{:,.0f}", 'cost': "${:.4f}", 'seconds': "{:.0f}s", 'calls': "{:,}"}
+        budget_info = "**Budget:**\n" + "".join(
+            f"- {name.capitalize()}: {units[name].format(used)} of {units[name].format(limit)}\n"
+            for name, (used, limit) in graph.budget.report(model_name, session_state).items()
+        ) + "\n"
+
     cache_info = "N/A (no API calls yet)"
     if total_api_calls > 0:
-        cache_info = f"{(session_state.web_call_cache_hits / total_api_calls * 100):.1f}% (of total calls)"
+        # the exact rate is what keying the cache on the raw search term would have given
+        cache_info = (
+            f"{(session_state.web_call_cache_hits / total_api_calls * 100):.1f}% (of total calls), "
+            f"{(session_state.web_call_cache_hits_exact / total_api_calls * 100):.1f}% with exact search terms only"
+        )
+
+    # the search cache is shared by every session, these numbers cover the whole process
+    cache_stats = get_search_cache().stats()
+    shared_cache_info = (
+        f"- Memory Tier: {cache_stats['memory']['entries']:,} entries, {cache_stats['memory']['evictions']:,} evictions\n"
+        f"- Coalesced In-Flight Searches: {cache_stats['coalesced']:,}\n"
+    )
+    responses = cache_stats['responses']
+    shared_cache_info += f"- LLM Response Tier: {responses['entries']:,} entries, {responses['evictions']:,} evictions\n"
+    articles = cache_stats['articles']
+    shared_cache_info += (
+        f"- Article Tier: {articles['entries']:,} entries, {articles['hits']:,} hits, {articles['misses']:,} misses, {articles['evictions']:,} evictions, "
+        f"{articles['bytes'] / 1024 / 1024:.1f} MB compressed of {articles['max_bytes'] / 1024 / 1024:.0f} MB ({articles['raw_bytes'] / 1024 / 1024:.1f} MB raw)\n"
+    )
+    if cache_stats['disk'] is not None:
+        shared_cache_info += f"- Disk Tier: {cache_stats['disk']['entries']:,} entries, {cache_stats['disk']['evictions']:,} evictions\n"
     
+    # breaker state and current rate limit of every backend used so far, shared by every session like the cache
+    backend_info = ""
+    for service, health in get_resilience().stats().items():
+        backend_info += f"- {service}: {health['state'].replace('_', ' ')}"
+        if health['rate'] is not None:
+            backend_info += f", {health['rate']:.2f}/{health['base_rate']:.2f} requests/s"
+        backend_info += "\n"
+    metrics = session_state.metrics
+    backend_info += f"- Retries: {metrics.total('backend_retries'):,}, Fallbacks: {metrics.total('backend_fallbacks'):,} (this run)\n"
+
     return (
         "### Cost Summary\n"
         f"**Token Usage:**\n"
         f"- Input Tokens: {session_state.input_tokens:,}\n"
         f"- Output Tokens: {session_state.output_tokens:,}\n"
-        f"- Total Tokens: {total_tokens:,}\n\n"
+        f"- Total Tokens: {total_tokens:,}\n"
+        f"- Input Tokens Saved (state budget): {session_state.input_tokens_saved:,}\n"
+        f"- Estimated Cost ({model_name}): ${total_cost:.4f}\n"
+        f"- Stop Reason: {session_state.stop_reason or 'N/A'}\n\n"
+        f"{budget_info}"
+        f"**LLM Response Cache:**\n"
+        f"- Cache Hits: {session_state.llm_cache_hits:,}\n"
+        f"- Tokens Saved: {session_state.llm_cache_input_tokens_saved:,} input, {session_state.llm_cache_output_tokens_saved:,} output (${llm_cache_saved:.4f})\n\n"
         f"**API Calls:**\n"
         f"- Arxiv: {session_state.arxiv_calls:,}\n"
         f"- Wikipedia (Deep): {session_state.wikipedia_deep_calls:,}\n"
         f"- Wikipedia (Shallow): {session_state.wikipedia_shallow_calls:,}\n"
         f"- DuckDuckGo Search: {session_state.DDGS_calls:,}\n"
-        f"- Total API Calls: {total_api_calls:,}\n\n"
+        f"- Total API Calls: {total_api_calls:,}\n"
+        f"- Search Output Tokens: {session_state.search_tokens_raw:,} raw, {session_state.search_tokens_shown:,} shown to the LLM ({format_saved(session_state.search_tokens_raw, session_state.search_tokens_shown)})\n"
+        f"- Fetched Page Lookups: {session_state.search_fetched_calls:,} ({session_state.search_fetched_hits:,} with results)\n\n"
         f"- API Call Failures: {session_state.call_failures:,}\n\n"
         f"**Cache Performance:**\n"
-        f"- Cache Hits: {session_state.web_call_cache_hits:,}\n"
-        f"- Cache Hit Rate: {cache_info}"
+        f"- Cache Hits: {session_state.web_call_cache_hits:,} "
+        f"(memory: {session_state.web_call_cache_hits_memory:,}, disk: {session_state.web_call_cache_hits_disk:,})\n"
+        f"- Coalesced Calls: {session_state.web_call_coalesced:,} (shared an identical search already in flight)\n"
+        f"- Cache Hit Rate: {cache_info}\n\n"
+        f"**Shared Search Cache:**\n"
+        f"{shared_cache_info}\n"
+        f"**Search Backends:**\n"
+        f"{backend_info}\n"
+        f"**Latency per Node:**\n"
+        f"{format_latency(session_state.metrics, 'node_seconds', 'node')}\n"
+        f"**Latency per Tool:**\n"
+        f"{format_latency(session_state.metrics, 'tool_seconds', 'tool')}"
     )
 
 def tostring_event(event):
@@ -68,17 +163,62 @@ def tostring_event(event):
 
     return event
 
+def render_entry(entry):
+    with entry.placeholder.container():
+        st.markdown(entry.text)
+        if entry.truncated:
+            with st.expander(f"Full output ({len(entry.full):,} characters)"):
+                st.text(entry.full)
+        st.markdown("---")
+
+def render_hidden_count():
+    hidden = st.session_state.event_log.hidden
+    if hidden:
+        hidden_container.caption(f"{hidden:,} earlier events hidden")
+
+def refresh_meta_data(force=False):
+    # the panel rebuilds a lot of text, on long runs it is refreshed at a fixed rate instead of on every event
+    if st.session_state.meta_throttle.ready(force):
+        meta_data_container.markdown(get_meta_data())
+
 def event_callback(event):
     print("---> event callback", event)
-    # st.session_state.response_text = f"{tostring_event(event)}" # mode: delete previous text and replace
-    # st.session_state.response_text = f"{st.session_state.response_text}\n\n{tostring_event(event)}" # mode: read from top down
-    st.session_state.response_text = f"{tostring_event(event)}\n\n---\n\n{st.session_state.response_text}" # mode: read from bottom up
-    response_container.markdown(f"{st.session_state.response_text}")
-    meta_data_container.markdown(get_meta_data())
+
+    # each event is rendered once into its own element, older events are never touched again
+    kind = next(iter(event))
+    entry, evicted = st.session_state.event_log.add(kind, tostring_event(event), truncate=kind == "tool_response")
+
+    # the finished message takes over the element its streamed text was shown in, the user and tool_call
+    # events of the same turn arrive before it and leave the streamed text alone
+    if kind == "assistant" and st.session_state.partial_placeholder is not None:
+        entry.placeholder = st.session_state.partial_placeholder
+        st.session_state.partial_placeholder = None
+        st.session_state.partial_text = ""
+    else:
+        entry.placeholder = events_container.empty()
+    render_entry(entry)
+
+    for old_entry in evicted:
+        old_entry.placeholder.empty()
+    render_hidden_count()
+    refresh_meta_data()
+
+def drop_partial_text():
+    """Removes streamed text no assistant event took over, ex. of a run that was aborted mid-turn"""
+    if st.session_state.partial_placeholder is not None:
+        st.session_state.partial_placeholder.empty()
+    st.session_state.partial_placeholder = None
+    st.session_state.partial_text = ""
 
 # Callback to handle streaming text
 def stream_callback(text_chunk):
-    pass
+    # text deltas of the LLM turn in progress, shown below the finished events until event_callback gets the whole turn
+    if st.session_state.partial_placeholder is None:
+        st.session_state.partial_placeholder = events_container.empty()
+    st.session_state.partial_text += text_chunk
+    st.session_state.partial_placeholder.markdown(
+        f"**{st.session_state.my_graph.model_name}:** \n\n{st.session_state.partial_text}▌"
+    )
 
 # Initialize session state variables
 if "chat_history" not in st.session_state:
@@ -90,8 +230,17 @@ if "confirmations" not in st.session_state:
 if "is_generating" not in st.session_state:
     st.session_state.is_generating = False
 
-if "response_text" not in st.session_state:
-    st.session_state.response_text = ""
+if "event_log" not in st.session_state:
+    st.session_state.event_log = EventLog(window=EVENT_WINDOW, preview_chars=PREVIEW_CHARS)
+
+if "meta_throttle" not in st.session_state:
+    st.session_state.meta_throttle = Throttle(META_REFRESH_SECONDS)
+
+if "partial_text" not in st.session_state:
+    st.session_state.partial_text = ""
+
+if "partial_placeholder" not in st.session_state:
+    st.session_state.partial_placeholder = None
 
 if "my_graph" not in st.session_state:
     st.session_state.my_graph = AgentGraph(st=st, model_name="TimelineGPT", event_callback=event_callback, stream_callback=stream_callback)
@@ -106,7 +255,14 @@ with st.form(key="chat_form"):
     user_input = st.text_input("Type your query:")
     submit_button = st.form_submit_button("Send")
 
-response_container = st.empty()
+# events are appended below each other, the log is re-rendered once after a rerun since elements don't survive it
+hidden_container = st.empty()
+events_container = st.container()
+render_hidden_count()
+for entry in st.session_state.event_log:
+    entry.placeholder = events_container.empty()
+    render_entry(entry)
+
 st.markdown("---")
 history_container = st.empty()
 
@@ -121,13 +277,15 @@ def update_history():
             st.markdown("---")
 
 def empty_response_container():
-    st.session_state.response_text = ""
-    response_container.empty()
+    for entry in st.session_state.event_log:
+        entry.placeholder.empty()
+    st.session_state.event_log.clear()
+    hidden_container.empty()
 
 def submit_response_to_history():
     if True: # CONFIGURABLE BLOCK: if you turn off LLM memory, you can enable chat history, otherwise it just repeats itself, very messy
         return
-    st.session_state.chat_history.append(st.session_state.response_text)
+    st.session_state.chat_history.append("\n\n---\n\n".join(entry.full or entry.text for entry in st.session_state.event_log))
     empty_response_container()
     update_history()
 
@@ -163,9 +321,21 @@ if submit_button and user_input:
         st.session_state.chat_history = []
         st.session_state.confirmations = []
         st.session_state.is_generating = False
-        st.session_state.response_text = ""
+        # elements of an earlier script run are gone, the placeholder is only forgotten
+        st.session_state.partial_text = ""
+        st.session_state.partial_placeholder = None
 
         st.session_state.my_graph.call(user_input)
+        drop_partial_text()
+        refresh_meta_data(force=True)
+
         submit_response_to_history()
 
-        st.session_state.is_generating = False
\ No newline at end of file
+        st.session_state.is_generating = False
+
+# the metrics of the last run, for a Prometheus push gateway or a notebook
+with st.expander("Export metrics"):
+    metrics = st.session_state.my_graph.st.session_state.metrics
+    left, right = st.columns(2)
+    left.download_button("Prometheus", metrics.to_prometheus(), file_name="timeliner_metrics.prom", mime="text/plain")
+    right.download_button("JSON", metrics.to_json_text(), file_name="timeliner_metrics.json", mime="application/json")
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+import Resilience
+import SearchCache
+import Tools
+from Cassette import Cassette
+from ModelGraph import AgentGraph
+
+# end to end benchmark of AgentGraph with a scripted chat model and stub search backends, no network or API key
+# reports time per node, graph overhead per step (wall time minus model and backend time),
+# growth of llm_state['messages'] and how all of it scales with max_questions/max_notes
+# run with python src/testbench/graph_bench.py [--repeats 3] [--baseline old.json]
+# --cassette run.json.gz profiles a recorded real run instead (see Cassette.py), with the settings it was recorded with
+# results are written to src/testbench/results/graph_bench.json (not versioned, timings only compare on one machine),
+# keep a copy from before a change and pass it as --baseline to see the relative change
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "graph_bench.json")
+
+# (max_questions, max_notes) pairs, every researched question logs exactly one note
+SIZES = [(3, 3), (6, 6), (12, 12), (24, 24)]
+WIDTHS = [1, 3]
+
+PROMPT = "Build a timeline of the history of the benchmark."
+
+class Clock():
+    """Time spent outside the graph itself, in the scripted model and the stub backends"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.llm = 0.0
+        self.backend = 0.0
+        self.llm_calls = 0
+        self.backend_calls = 0
+
+    def add(self, kind, elapsed):
+        with self.lock:
+            setattr(self, kind, getattr(self, kind) + elapsed)
+            setattr(self, f"{kind}_calls", getattr(self, f"{kind}_calls") + 1)
+
+class ScriptedChatModel(BaseChatModel):
+    """Answers by role, recognized from the system prompt, with the same script on every run:
+    the questioner asks 3 new questions per turn, the researcher searches, takes one note and answers,
+    and the builder prints the notes back"""
+    clock: Clock
+    latency: float = 0.0
+    counters: dict = {}
+    lock: object = None
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def next_id(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            return self.counters[name]
+
+    def respond(self, messages):
+        system = messages[0].content
+        if "timeline builder" in system:
+            events = [line.strip(" -") for line in messages[2].content.splitlines() if "): " in line]
+            return AIMessage(content="\n".join(f"- {event}" for event in events) or "No events were found.")
+
+        if "assigned a research question" not in system:
+            questions = [f"What happened to topic {self.next_id('question')} of the benchmark?" for _ in range(3)]
+            return AIMessage(content="", tool_calls=[self.tool_call("ask_questions", {"questions": questions})])
+
+        tool_names = [message.name for message in messages if isinstance(message, ToolMessage)]
+        if not tool_names:
+            term = f"benchmark topic {self.next_id('search')}"
+            return AIMessage(content="", tool_calls=[
+                self.tool_call("search_fetched", {"query": term}),
+                self.tool_call("duck_duck_go", {"search_term": term}),
+                self.tool_call("wikipedia_shallow", {"search_term": term}),
+            ])
+        if "take_notes" not in tool_names:
+            n = self.next_id("note")
+            note = f"({n % 12 + 1:02d}-01-{1000 + n}): Benchmark event number {n} took place."
+            return AIMessage(content="", tool_calls=[self.tool_call("take_notes", {"notes": [note]})])
+        return AIMessage(content="The benchmark event happened as noted.")
+
+    def tool_call(self, name, args):
+        return {"name": name, "args": args, "id": f"call_{self.next_id('call')}", "type": "tool_call"}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+
+        message = self.respond(messages)
+        input_tokens = sum(len(str(m.content)) for m in messages) // 4
+        output_tokens = len(str(message.content) + str(message.tool_calls)) // 4
+        message.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+        self.clock.add("llm", time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+def stub_backend(clock, backend, latency, size):
+    def fetch(search_term):
+        start = time.perf_counter()
+        if latency:
+            time.sleep(latency)
+        sentence = f"{backend} result for {search_term}, an event of the benchmark happened on 01-01-1999. "
+        result = (sentence * (size // len(sentence) + 1))[:size]
+        clock.add("backend", time.perf_counter() - start)
+        return result
+    return fetch
+
+def run_once(args, max_questions, max_notes, width, trace_memory=False):
+    clock = Clock()
+    llm = ScriptedChatModel(clock=clock, latency=args.llm_latency, counters={}, lock=threading.Lock())
+    cassette = None
+    if args.cassette:
+        # replayed responses stand in for both the model and the backends, the stubs only answer what wasn't recorded
+        llm = None
+        cassette = Cassette(args.cassette, mode="replay", latency_scale=args.latency_scale)
+    for backend in Tools.BACKENDS:
+        Tools.BACKENDS[backend] = stub_backend(clock, backend, args.backend_latency, args.result_chars)
+
+    # a cold cache for every run, otherwise later runs would measure cache hits instead of the graph
+    SearchCache._shared_cache = SearchCache.SearchCache(path=os.path.join(args.cache_dir, f"{time.perf_counter_ns()}.sqlite3"))
+    # the stubs never fail, rate limiting them would only measure the token buckets
+    Resilience._shared_resilience = Resilience.Resilience(rate_limits={})
+
+    graph = AgentGraph(
+        model_name="GraphBench", secrets={"OPENAI_API_KEY": "graph-bench"}, llm=llm, cassette=cassette,
+        max_questions=max_questions, max_notes=max_notes, recursion_depth=10000, research_width=width,
+    )
+
+    nodes = {}
+    message_counts = []
+    message_chars = []
+
+    def record(update, elapsed):
+        for node in update:
+            count, total = nodes.get(node, (0, 0.0))
+            nodes[node] = (count + 1, total + elapsed)
+        messages = graph.st.session_state.llm_state["messages"]
+        message_counts.append(len(messages))
+        message_chars.append(sum(len(str(m.content)) for m in messages))
+
+    async def astream():
+        last = time.perf_counter()
+        async for update in graph.graph.astream(graph.st.session_state.llm_state, stream_mode="updates", config=graph.config):
+            now = time.perf_counter()
+            record(update, now - last)
+            last = time.perf_counter()
+
+    if trace_memory:
+        tracemalloc.start()
+
+    # the nodes run on agents shared by every session, they find this one through the binding
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), graph.bound():
+        graph.begin_call(cassette.metadata["prompt"] if cassette else PROMPT)
+        if args.mode == "async":
+            asyncio.run(astream())
+        else:
+            last = time.perf_counter()
+            for update in graph.graph.stream(graph.st.session_state.llm_state, stream_mode="updates", config=graph.config):
+                now = time.perf_counter()
+                record(update, now - last)
+                last = time.perf_counter()
+
+    # the sum of the node times, so the bookkeeping in record() isn't counted against the graph
+    wall = sum(total for _, total in nodes.values())
+
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    session_state = graph.st.session_state
+    steps = sum(count for count, _ in nodes.values())
+    return {
+        "wall": wall,
+        "llm": clock.llm,
+        "backend": clock.backend,
+        "llm_calls": clock.llm_calls,
+        "backend_calls": clock.backend_calls,
+        "steps": steps,
+        "nodes": nodes,
+        "answered": len(session_state.answered_questions),
+        "notes": len(session_state.notes),
+        "input_tokens": session_state.input_tokens,
+        "messages_peak": max(message_counts, default=0),
+        "message_chars_peak": max(message_chars, default=0),
+        "tracemalloc_peak": peak,
+        "cassette_misses": cassette.misses if cassette else 0,
+        "cassette_loose_hits": cassette.loose_hits if cassette else 0,
+    }
+
+def run_config(args, max_questions, max_notes, width):
+    runs = [run_once(args, max_questions, max_notes, width) for _ in range(args.repeats)]
+    memory = run_once(args, max_questions, max_notes, width, trace_memory=True)
+
+    def median(key):
+        return statistics.median(run[key] for run in runs)
+
+    wall, llm, backend = median("wall"), median("llm"), median("backend")
+    steps = runs[0]["steps"]
+    per_node = {}
+    for node in sorted(runs[0]["nodes"]):
+        count = runs[0]["nodes"][node][0]
+        total = statistics.median(run["nodes"][node][1] for run in runs)
+        per_node[node] = {"count": count, "total_ms": round(total * 1000, 2), "mean_ms": round(total * 1000 / count, 3)}
+
+    return {
+        "max_questions": max_questions,
+        "max_notes": max_notes,
+        "research_width": width,
+        "steps": steps,
+        "llm_calls": runs[0]["llm_calls"],
+        "backend_calls": runs[0]["backend_calls"],
+        "answered": runs[0]["answered"],
+        "notes": runs[0]["notes"],
+        "input_tokens": runs[0]["input_tokens"],
+        "wall_ms": round(wall * 1000, 2),
+        "overhead_ms": round((wall - llm - backend) * 1000, 2),
+        "overhead_ms_per_step": round((wall - llm - backend) * 1000 / steps, 3),
+        "messages_peak": runs[0]["messages_peak"],
+        "message_chars_peak": runs[0]["message_chars_peak"],
+        "tracemalloc_peak_kb": round(memory["tracemalloc_peak"] / 1024, 1),
+        "cassette_misses": runs[0]["cassette_misses"],
+        "cassette_loose_hits": runs[0]["cassette_loose_hits"],
+        "nodes": per_node,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path) as file:
+        baseline = {
+            (r["max_questions"], r["max_notes"], r["research_width"]): r
+            for r in json.load(file)["results"]
+        }
+
+    print(f"\nagainst {baseline_path}")
+    for result in results:
+        old = baseline.get((result["max_questions"], result["max_notes"], result["research_width"]))
+        if not old:
+            continue
+        changes = []
+        for key in ["wall_ms", "overhead_ms_per_step", "messages_peak", "tracemalloc_peak_kb"]:
+            if old[key]:
+                changes.append(f"{key} {100 * (result[key] - old[key]) / old[key]:+.1f}%")
+        print(f"q={result['max_questions']:<3} n={result['max_notes']:<3} w={result['research_width']}  " + "  ".join(changes))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark AgentGraph with a scripted model and stub search backends.")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per configuration, the median is reported")
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync", help="drive the graph with stream or astream")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the scripted model sleeps per call")
+    parser.add_argument("--backend-latency", type=float, default=0.0, help="seconds each stub backend sleeps per call")
+    parser.add_argument("--result-chars", type=int, default=2000, help="size of every stub search result")
+    parser.add_argument("--cassette", help="replay a recorded run instead of the scripted model")
+    parser.add_argument("--latency-scale", type=float, default=0.0, help="with --cassette, 1.0 replays at the recorded speed")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--baseline", help="earlier results to print the relative change against")
+    args = parser.parse_args(argv)
+
+    sizes, widths = SIZES, WIDTHS
+    if args.cassette:
+        metadata = Cassette(args.cassette).metadata
+        sizes, widths = [(metadata["max_questions"], metadata["max_notes"])], [metadata["research_width"]]
+
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        args.cache_dir = cache_dir
+        run_once(args, *sizes[0], widths[0]) # warm up imports and lazy clients before anything is timed
+        print(f"{'q':>3} {'n':>3} {'w':>2} {'steps':>6} {'wall ms':>9} {'overhead/step ms':>17} {'msgs':>5} {'peak KB':>9}")
+        for (max_questions, max_notes), width in itertools.product(sizes, widths):
+            result = run_config(args, max_questions, max_notes, width)
+            results.append(result)
+            print(
+                f"{max_questions:>3} {max_notes:>3} {width:>2} {result['steps']:>6} {result['wall_ms']:>9.1f} "
+                f"{result['overhead_ms_per_step']:>17.3f} {result['messages_peak']:>5} {result['tracemalloc_peak_kb']:>9.1f}"
+            )
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "settings": {
+            "repeats": args.repeats,
+            "mode": args.mode,
+            "llm_latency": args.llm_latency,
+            "backend_latency": args.backend_latency,
+            "result_chars": args.result_chars,
+            "cassette": args.cassette,
+            "latency_scale": args.latency_scale,
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+        file.write("\n")
+    print(f"\nwritten to {args.output}")
+
+if __name__ == "__main__":
+    main()
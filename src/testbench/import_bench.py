@@ -0,0 +1,47 @@
+import os
+import statistics
+import subprocess
+import sys
+
+# cold start benchmark: time to import each core module in a fresh interpreter,
+# and which heavy optional dependencies got pulled in along the way
+# run with python src/testbench/import_bench.py [repeats]
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["Config", "Tools", "Assistant", "Agents", "ModelGraph", "BatchRunner"]
+
+HEAVY = ["streamlit", "langchain_openai", "openai", "langchain_anthropic", "anthropic",
+         "langchain_community", "duckduckgo_search", "wikipedia", "arxiv", "rouge_score", "tiktoken"]
+
+PROBE = (
+    "import sys, time, warnings\n"
+    "warnings.simplefilter('ignore')\n"
+    "start = time.perf_counter()\n"
+    "import {module}\n"
+    "elapsed = time.perf_counter() - start\n"
+    "heavy = [name for name in {heavy!r} if name in sys.modules]\n"
+    "print(elapsed, ','.join(heavy))\n"
+)
+
+def time_import(module, repeats):
+    samples = []
+    heavy = ""
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+            cwd=SRC, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        samples.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ""
+    return statistics.median(samples), heavy
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"{'module':<12} {'median (s)':>10}  heavy imports")
+    for module in MODULES:
+        elapsed, heavy = time_import(module, repeats)
+        print(f"{module:<12} {elapsed:>10.3f}  {heavy or '-'}")
+
+if __name__ == "__main__":
+    main()
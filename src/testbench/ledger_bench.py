@@ -0,0 +1,96 @@
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+from Agents import MessageLedger, copy_tool_output_over
+
+# microbenchmark for copy_tool_output_over: cost of one reconciliation step as the history grows
+# run with PYTHONPATH=src python src/testbench/ledger_bench.py
+
+def legacy_copy_tool_output_over(source_list, target_list):
+    """The nested-scan version copy_tool_output_over used to be, kept here as the baseline"""
+    pending_tool_calls = []
+    existing_responses = {}
+
+    call_position = 0
+    for msg in target_list:
+        if isinstance(msg, AIMessage) and msg.tool_calls:
+            for tool_call in msg.tool_calls:
+                existing_responses[(tool_call['id'], call_position)] = 0
+                call_position += 1
+        if isinstance(msg, ToolMessage):
+            for (call_id, pos), count in existing_responses.items():
+                if call_id == msg.tool_call_id:
+                    existing_responses[(call_id, pos)] = count + 1
+                    break
+
+    call_position = 0
+    for msg in target_list:
+        if isinstance(msg, AIMessage) and msg.tool_calls:
+            for tool_call in msg.tool_calls:
+                if existing_responses[(tool_call['id'], call_position)] < 1:
+                    pending_tool_calls.append((tool_call, call_position))
+                call_position += 1
+
+    if not pending_tool_calls:
+        return
+
+    tool_responses = []
+    source_responses_used = set()
+    for msg in reversed(source_list):
+        if isinstance(msg, ToolMessage):
+            response_id = (msg.tool_call_id, msg.content, id(msg))
+            if response_id not in source_responses_used:
+                for (tool_call, pos) in pending_tool_calls[:]:
+                    if tool_call['id'] == msg.tool_call_id and tool_call['name'] == msg.name:
+                        tool_responses.append(msg)
+                        source_responses_used.add(response_id)
+                        pending_tool_calls.remove((tool_call, pos))
+                        break
+        if not pending_tool_calls:
+            break
+
+    target_list.extend(reversed(tool_responses))
+
+def build_history(length):
+    """A ReAct style history of AI tool calls each followed by their tool response"""
+    messages = [SystemMessage(content="system"), HumanMessage(content="prompt")]
+    step = 0
+    while len(messages) < length:
+        call_id = f"call_{step}"
+        messages.append(AIMessage(content="", tool_calls=[{"name": "duck_duck_go", "args": {"search_term": str(step)}, "id": call_id}]))
+        messages.append(ToolMessage(content=f"result {step}", tool_call_id=call_id, name="duck_duck_go"))
+        step += 1
+    return messages, step
+
+def time_steps(reconcile, length, steps=50):
+    """Average seconds per reconciliation when one new tool call and its response arrive each step"""
+    source, step = build_history(length)
+    target = list(source)
+    reconcile(source, target) # warm up, the ledger indexes the existing history once here
+
+    elapsed = 0.0
+    for i in range(steps):
+        call_id = f"call_{step + i}"
+        call = AIMessage(content="", tool_calls=[{"name": "duck_duck_go", "args": {"search_term": "x"}, "id": call_id}])
+        response = ToolMessage(content="result", tool_call_id=call_id, name="duck_duck_go")
+        source += [call, response]
+        target.append(call)
+
+        start = time.perf_counter()
+        reconcile(source, target)
+        elapsed += time.perf_counter() - start
+
+        assert target[-1] is response
+    return elapsed / steps
+
+def main():
+    print(f"{'messages':>10} {'legacy (us)':>14} {'ledger (us)':>14}")
+    for length in [100, 500, 1000, 2000, 5000, 10000]:
+        ledger = MessageLedger()
+        legacy = time_steps(legacy_copy_tool_output_over, length)
+        indexed = time_steps(lambda source, target: copy_tool_output_over(source, target, ledger), length)
+        print(f"{length:>10} {legacy * 1e6:>14.1f} {indexed * 1e6:>14.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import gc
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+from ModelGraph import AgentGraph
+
+# cost of a new session: how long AgentGraph takes to construct and how much memory every live session holds on to
+# the sessions are built the way main.py builds them, with the real chat model client and no network requests
+# run with python src/testbench/session_bench.py [--sessions 50]
+
+SECRETS = {"OPENAI_API_KEY": "session-bench"}
+
+def new_session():
+    return AgentGraph(model_name="SessionBench", secrets=SECRETS, event_callback=lambda event: None, stream_callback=lambda text: None)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the latency and memory of new AgentGraph sessions.")
+    parser.add_argument("--sessions", type=int, default=50, help="sessions kept alive at the same time")
+    args = parser.parse_args(argv)
+
+    # the first session pays for imports and anything built once per process
+    start = time.perf_counter()
+    sessions = [new_session()]
+    first_ms = (time.perf_counter() - start) * 1000
+
+    latencies = []
+    for _ in range(args.sessions):
+        start = time.perf_counter()
+        sessions.append(new_session())
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # memory is measured on a second batch, tracemalloc would slow the timed one down
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for _ in range(args.sessions):
+        sessions.append(new_session())
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"first session      {first_ms:9.1f} ms")
+    print(f"new session median {statistics.median(latencies):9.2f} ms  (p95 {sorted(latencies)[int(len(latencies) * 0.95) - 1]:.2f} ms)")
+    print(f"memory per session {(after - before) / args.sessions / 1024:9.1f} KB  ({args.sessions} sessions alive)")
+
+if __name__ == "__main__":
+    main()
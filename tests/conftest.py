@@ -0,0 +1,23 @@
+import threading
+
+import pytest
+
+import graph_bench
+import Resilience
+import SearchCache
+import Tools
+from ModelGraph import AgentGraph
+
+@pytest.fixture
+def offline_graph(monkeypatch):
+    """Builds AgentGraphs on graph_bench's scripted chat model and stub backends, with a fresh in-memory cache"""
+    clock = graph_bench.Clock()
+    for backend in list(Tools.BACKENDS):
+        monkeypatch.setitem(Tools.BACKENDS, backend, graph_bench.stub_backend(clock, backend, 0.0, 500))
+    monkeypatch.setattr(SearchCache, "_shared_cache", SearchCache.SearchCache(path=None))
+    monkeypatch.setattr(Resilience, "_shared_resilience", Resilience.Resilience(rate_limits={}))
+
+    def build(model=graph_bench.ScriptedChatModel, **options):
+        llm = model(clock=clock, latency=0.0, counters={}, lock=threading.Lock())
+        return AgentGraph(model_name="Test", secrets={"OPENAI_API_KEY": "test"}, llm=llm, recursion_depth=10000, **options)
+    return build
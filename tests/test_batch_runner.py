@@ -0,0 +1,78 @@
+import json
+import os
+import time
+
+import pytest
+
+import BatchRunner
+from BatchRunner import WorkerPool, read_jobs
+
+def fake_worker(tasks, results, *worker_args):
+    results.send(("ready", None, None))
+    while True:
+        job = tasks.recv()
+        if job is None:
+            return
+        if job["prompt"] == "die before start":
+            os._exit(3)
+        results.send(("start", job["id"], None))
+        if job["prompt"] == "die":
+            os._exit(4)
+        if job["prompt"] == "hang":
+            time.sleep(60)
+        results.send(("done", job["id"], {"id": job["id"], "status": "ok"}))
+        if job["prompt"] == "done then hang":
+            time.sleep(60)
+
+class FakePool(WorkerPool):
+    worker = staticmethod(fake_worker)
+
+def run_pool(prompts, size=2):
+    jobs = [{"id": str(i), "prompt": prompt} for i, prompt in enumerate(prompts)]
+    reported = []
+    pool = FakePool(size, {}, timeout=0.5)
+    try:
+        pool.run(jobs, reported.append)
+    finally:
+        pool.close()
+    return {record["id"]: record["status"] for record in reported}, len(reported)
+
+def test_every_job_is_reported_exactly_once(monkeypatch):
+    monkeypatch.setattr(BatchRunner, "KILL_GRACE", 0.5)
+    prompts = ["ok", "die before start", "ok", "die", "hang", "done then hang", "ok", "ok"]
+    statuses, reported = run_pool(prompts)
+
+    assert reported == len(prompts)
+    assert statuses["0"] == "ok"
+    assert statuses["1"] == "error" # died before posting start, still accounted for
+    assert statuses["3"] == "error"
+    assert statuses["4"] == "timeout"
+    assert statuses["5"] == "ok"
+    assert statuses["7"] == "ok"
+
+def test_duplicate_job_ids_are_rejected(tmp_path):
+    path = tmp_path / "jobs.jsonl"
+    path.write_text("\n".join([
+        json.dumps({"id": "a", "prompt": "first"}),
+        json.dumps({"prompt": "second"}),
+        json.dumps({"id": "2", "prompt": "same id as the line above"}),
+    ]))
+    with pytest.raises(ValueError, match="line 2"):
+        read_jobs(str(path))
+
+    with pytest.raises(ValueError, match="duplicate"):
+        FakePool(0, {}, timeout=1).run([{"id": "a", "prompt": "x"}, {"id": "a", "prompt": "y"}], print)
+
+def crashing_worker(tasks, results, *worker_args):
+    os._exit(2)
+
+class CrashingPool(WorkerPool):
+    worker = staticmethod(crashing_worker)
+
+def test_workers_that_never_start_end_the_run():
+    pool = CrashingPool(1, {}, timeout=1)
+    try:
+        with pytest.raises(RuntimeError, match="before they were ready"):
+            pool.run([{"id": "a", "prompt": "x"}], print)
+    finally:
+        pool.close()
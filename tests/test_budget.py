@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from Budget import Budget
+from ModelGraph import ST_Proxy
+
+def session_state(**counters):
+    state = ST_Proxy(secrets={"OPENAI_API_KEY": "test"}).session_state
+    for key, value in counters.items():
+        state[key] = value
+    return state
+
+def test_usage_sums_the_main_state_and_every_sub_run():
+    budget = Budget(max_tokens=1000)
+    main = session_state(input_tokens=100, output_tokens=50, DDGS_calls=3, web_call_cache_hits=1)
+    sub_runs = [session_state(input_tokens=200, arxiv_calls=2, web_call_coalesced=1) for _ in range(2)]
+
+    used = budget.usage("gpt-4o-mini", main, *sub_runs)
+    assert used["tokens"] == 550
+    # cache hits and coalesced searches never left the process
+    assert used["calls"] == 3 + 2 * 2 - 1 - 2
+
+def test_reserve_applies_to_tokens_but_not_to_calls():
+    budget = Budget(max_tokens=1000, max_calls=5, reserve=0.1)
+    assert budget.exhausted("gpt-4o-mini", session_state(input_tokens=899)) is None
+    assert budget.exhausted("gpt-4o-mini", session_state(input_tokens=900)) == "tokens"
+    assert budget.exhausted("gpt-4o-mini", session_state(DDGS_calls=4)) is None
+    assert budget.exhausted("gpt-4o-mini", session_state(DDGS_calls=5)) == "calls"
+
+def test_unlimited_budget_is_never_exhausted():
+    assert Budget().exhausted("gpt-4o-mini", session_state(input_tokens=10 ** 9, DDGS_calls=10 ** 6)) is None
+
+def test_sibling_sub_runs_are_counted_together():
+    budget = Budget(max_tokens=1000, reserve=0.0)
+    siblings = [session_state(input_tokens=400) for _ in range(3)]
+    assert budget.exhausted("gpt-4o-mini", session_state(), siblings[0]) is None
+    assert budget.exhausted("gpt-4o-mini", session_state(), *siblings) == "tokens"
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+@pytest.mark.parametrize("width", [1, 3])
+def test_concurrent_research_stays_within_the_token_budget(offline_graph, mode, width):
+    limit = 10000
+    graph = offline_graph(max_questions=12, max_notes=12, research_width=width, budget=Budget(max_tokens=limit))
+    if mode == "sync":
+        graph.call("history of x")
+    else:
+        asyncio.run(graph.acall("history of x"))
+
+    state = graph.st.session_state
+    assert state.stop_reason == "tokens"
+    # the reserve covers the steps in flight and the builder, whatever the research width
+    assert state.input_tokens + state.output_tokens <= limit * 1.05
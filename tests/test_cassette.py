@@ -0,0 +1,61 @@
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import graph_bench
+import SearchCache
+from Cassette import Cassette
+
+def conversation(tool_output):
+    return [
+        HumanMessage(content="Timeline of Mamba"),
+        AIMessage(content="", tool_calls=[{"name": "duck_duck_go", "args": {"search_term": "Mamba"}, "id": "call_1"}]),
+        ToolMessage(content=tool_output, name="duck_duck_go", tool_call_id="call_1"),
+    ]
+
+def record(path):
+    cassette = Cassette(path, mode="record")
+    cassette.invoke("researcher", conversation("results recorded"), lambda messages: AIMessage(content="answer"))
+    cassette.fetch("duck_duck_go", "Mamba", lambda term: f"results for {term}")
+    cassette.save()
+
+def test_replay_counts_loose_matches(tmp_path):
+    path = str(tmp_path / "run.json.gz")
+    record(path)
+
+    cassette = Cassette(path, mode="replay")
+    assert cassette.invoke("researcher", conversation("results recorded"), None).content == "answer"
+    assert cassette.stats()["loose_hits"] == 0
+
+    # different tool output only matches the loose key
+    assert cassette.invoke("researcher", conversation("other results"), None).content == "answer"
+    assert cassette.stats()["loose_hits"] == 1
+    assert cassette.stats()["hits"] == 2
+
+    assert cassette.fetch("duck_duck_go", "Mamba", None) == "results for Mamba"
+    assert cassette.stats()["loose_hits"] == 1
+
+class GreedyScriptedChatModel(graph_bench.ScriptedChatModel):
+    """Scripted model with temperature 0, so its responses go through the LLM response cache"""
+    temperature: float = 0.0
+
+def test_recording_with_a_warm_response_cache_replays(offline_graph, tmp_path, monkeypatch):
+    path = str(tmp_path / "run.json.gz")
+    options = dict(model=GreedyScriptedChatModel, max_questions=4, max_notes=4, llm_cache=True)
+    offline_graph(**options).call("Timeline of Mamba")
+
+    recorder = Cassette(path, mode="record")
+    graph = offline_graph(cassette=recorder, **options)
+    graph.call("Timeline of Mamba")
+    timeline = graph.st.session_state.llm_state["messages"][-1].content
+    assert graph.st.session_state.llm_cache_hits > 0
+
+    # every LLM response came from the cache, the recording holds them all the same
+    llm_entries = [entry for entry in recorder.responses if isinstance(entry["response"], dict) and "type" in entry["response"]]
+    assert len(llm_entries) == graph.st.session_state.llm_cache_hits
+
+    # the replay doesn't need the cache that served the recording
+    monkeypatch.setattr(SearchCache, "_shared_cache", SearchCache.SearchCache(path=None))
+    player = Cassette(path, mode="replay")
+    graph = offline_graph(cassette=player, **options)
+    graph.call("Timeline of Mamba")
+    assert player.stats()["misses"] == 0
+    assert graph.st.session_state.llm_state["messages"][-1].content == timeline
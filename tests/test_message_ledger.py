@@ -0,0 +1,93 @@
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import SessionContext
+from Agents import MessageLedger, copy_tool_output_over
+
+def call(call_id, name="duck_duck_go"):
+    return {"name": name, "args": {"search_term": call_id}, "id": call_id}
+
+def response(call_id, content=None, name="duck_duck_go"):
+    return ToolMessage(content=content or f"results for {call_id}", name=name, tool_call_id=call_id)
+
+def test_responses_are_filled_in_call_order():
+    target = [HumanMessage(content="Timeline of Mamba"), AIMessage(content="", tool_calls=[call("a"), call("b"), call("c")])]
+    # the tools finished in a different order than they were called
+    source = list(target) + [response("c"), response("a"), response("b")]
+
+    copy_tool_output_over(source, target, MessageLedger())
+
+    assert [msg.tool_call_id for msg in target[2:]] == ["a", "b", "c"]
+
+def test_only_missing_responses_are_filled():
+    ledger = MessageLedger()
+    target = [AIMessage(content="", tool_calls=[call("a"), call("b")])]
+    source = list(target) + [response("a")]
+
+    copy_tool_output_over(source, target, ledger)
+    assert [msg.tool_call_id for msg in target[1:]] == ["a"]
+
+    # a later response for b is picked up, a is not copied a second time
+    source += [response("b")]
+    copy_tool_output_over(source, target, ledger)
+    assert [msg.tool_call_id for msg in target[1:]] == ["a", "b"]
+
+    copy_tool_output_over(source, target, ledger)
+    assert len(target) == 3
+
+def test_response_for_another_tool_is_not_copied():
+    target = [AIMessage(content="", tool_calls=[call("a")])]
+    source = list(target) + [response("a", name="arxiv")]
+
+    copy_tool_output_over(source, target, MessageLedger())
+
+    assert len(target) == 1
+
+def test_latest_response_wins():
+    target = [AIMessage(content="", tool_calls=[call("a")])]
+    source = list(target) + [response("a", "first"), response("a", "retried")]
+
+    copy_tool_output_over(source, target)
+
+    assert target[-1].content == "retried"
+
+def test_ledger_resets_when_the_target_list_is_replaced():
+    ledger = MessageLedger()
+    first = [HumanMessage(content="one"), HumanMessage(content="two"), AIMessage(content="", tool_calls=[call("a")])]
+    source = list(first) + [response("a")]
+    copy_tool_output_over(source, first, ledger)
+    assert len(first) == 4
+
+    # a shorter new list, without a reset the ledger would skip its first messages
+    replaced = [AIMessage(content="", tool_calls=[call("b")])]
+    source += [response("b")]
+    copy_tool_output_over(source, replaced, ledger)
+    assert [msg.tool_call_id for msg in replaced[1:]] == ["b"]
+
+    # a longer new list can't be told apart from an appended one, it needs an explicit reset
+    ledger.reset()
+    longer = [AIMessage(content="", tool_calls=[call("c")])] + [HumanMessage(content=str(i)) for i in range(3)]
+    source += [response("c")]
+    copy_tool_output_over(source, longer, ledger)
+    assert [msg.tool_call_id for msg in longer[4:]] == ["c"]
+
+def test_replaced_source_list_drops_old_responses():
+    ledger = MessageLedger()
+    source = [response("a")]
+    ledger.sync_source(source)
+    assert "a" in ledger.responses
+
+    ledger.sync_source([])
+    assert ledger.responses == {}
+
+def test_system_prompt_reset_resets_the_ledger(offline_graph):
+    graph = offline_graph()
+    ledger = graph.st.session_state.message_ledger
+    messages = [AIMessage(content="", tool_calls=[call("a")])]
+    copy_tool_output_over([], messages, ledger)
+    assert "a" in ledger.pending
+
+    # load_system_prompt replaces llm_state's message list
+    with SessionContext.bind(graph.st):
+        graph.load_system_prompt(graph.questioner)
+    assert ledger.pending == {}
+    assert ledger.target_seen == 0
@@ -0,0 +1,56 @@
+import pytest
+
+import QueryKeys
+from SearchCache import SearchCache
+
+@pytest.mark.parametrize("backend", ["duck_duck_go", "arxiv", "wikipedia_deep"])
+@pytest.mark.parametrize("first, second", [
+    ("C++", "C"),
+    ("C#", "C"),
+    ("C++", "C#"),
+    ("C++ vs C#", "C# vs C++"),
+    ("C++ vs C#", "C vs"),
+    ("new york", "york new"),
+    ("go go", "go"),
+    ("node.js", "node js"),
+    ("Vitamin A", "vitamin"),
+    ("IT jobs", "jobs"),
+])
+def test_different_searches_keep_different_keys(backend, first, second):
+    assert QueryKeys.canonical(backend, first) != QueryKeys.canonical(backend, second)
+
+@pytest.mark.parametrize("first, second", [
+    ("Mamba LLM", "mamba  llm "),
+    ("Mamba LLM", "Mamba LLM timeline"),
+    ("Gödel", "godel"),
+    ("\"Mamba\" (LLM)", "mamba llm"),
+    ("history of C++.", "history C++"),
+])
+def test_equivalent_searches_share_a_key(first, second):
+    assert QueryKeys.canonical("duck_duck_go", first) == QueryKeys.canonical("duck_duck_go", second)
+
+def test_wikipedia_url_and_learned_title_share_a_key(monkeypatch):
+    cache = SearchCache(path=None)
+    monkeypatch.setattr(QueryKeys, "get_search_cache", lambda: cache)
+
+    url_key = QueryKeys.cache_key(cache, "wikipedia_deep", "https://en.wikipedia.org/wiki/Mamba_(deep_learning)")
+    assert url_key == QueryKeys.canonical("wikipedia_deep", "Mamba deep learning")
+
+    QueryKeys.learn_wikipedia_title("mamba llm wikipedia", "Mamba (deep learning)")
+    assert QueryKeys.cache_key(cache, "wikipedia_deep", "Mamba LLM") == url_key
+    assert QueryKeys.cache_key(cache, "wikipedia_deep", "C++") != url_key
+
+def test_keys_carry_the_rules_version():
+    assert QueryKeys.canonical("duck_duck_go", "c").startswith(f"v{QueryKeys.RULES_VERSION}:")
+
+def test_looked_up_terms_survive_a_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SearchCache(path=path)
+    assert QueryKeys.look_up_term(cache, "duck_duck_go", "Mamba LLM") is False
+    assert QueryKeys.look_up_term(cache, "duck_duck_go", "Mamba LLM") is True
+    # only the exact term and backend count
+    assert QueryKeys.look_up_term(cache, "duck_duck_go", "mamba llm") is False
+    assert QueryKeys.look_up_term(cache, "arxiv", "Mamba LLM") is False
+
+    restarted = SearchCache(path=path)
+    assert QueryKeys.look_up_term(restarted, "duck_duck_go", "Mamba LLM") is True
@@ -0,0 +1,116 @@
+import pytest
+
+from Similarity import NoteIndex, QuestionIndex, normalize_tokens
+
+def jaccard(a, b):
+    a, b = set(normalize_tokens(a)), set(normalize_tokens(b))
+    return len(a & b) / len(a | b)
+
+def test_reworded_question_is_found_through_lsh():
+    index = QuestionIndex()
+    index.add("When did Nvidia release the H100 GPU?")
+
+    # same tokens in another order, so it isn't an exact key match
+    match = index.find("When was the H100 GPU released by Nvidia?")
+    assert match == ("When did Nvidia release the H100 GPU?", 1.0, False)
+
+@pytest.mark.parametrize("question, expected", [
+    ("Mamba paper benchmark scores", 0.6), # 3 of 5 tokens shared, on the threshold
+    ("Mamba paper results", 0.75),
+    ("Mamba paper benchmark leaderboard ranking", 0.5),
+    ("Ethereum price", 0.0),
+])
+def test_question_threshold(question, expected):
+    asked = "Mamba paper benchmark results"
+    assert jaccard(asked, question) == pytest.approx(expected)
+
+    index = QuestionIndex(threshold=0.6)
+    index.add(asked)
+    match = index.find(question)
+    if expected >= 0.6:
+        assert match[0] == asked and match[1] == pytest.approx(expected)
+    else:
+        assert match is None
+
+def test_question_threshold_is_configurable():
+    index = QuestionIndex(threshold=0.7)
+    index.add("Mamba paper benchmark results")
+
+    assert index.find("Mamba paper benchmark scores") is None
+
+def test_closest_question_wins_and_reports_answered():
+    index = QuestionIndex()
+    index.add("Mamba paper benchmark results")
+    index.add("Mamba paper benchmark scores released")
+    index.mark_answered("Mamba paper benchmark scores released")
+
+    question, similarity, answered = index.find("Mamba paper benchmark scores release")
+    assert question == "Mamba paper benchmark scores released"
+    assert similarity == 1.0
+    assert answered
+
+def test_question_of_stopwords_only_matches_nothing():
+    index = QuestionIndex()
+    index.add("Mamba paper benchmark results")
+
+    assert index.find("What is it about?") is None
+
+def test_exact_note_matches_regardless_of_case_and_spacing():
+    index = NoteIndex()
+    index.add("(12-01-2023): Mamba is released")
+
+    assert index.find("(12-01-2023):  mamba is RELEASED") == ("(12-01-2023): Mamba is released", 1.0)
+
+@pytest.fixture
+def scorer():
+    pytest.importorskip("rouge_score")
+    from Similarity import get_rouge_scorer
+    return get_rouge_scorer()
+
+NOTE = "(11-14-2022): Nvidia announced the H100 GPU at GTC"
+
+@pytest.mark.parametrize("note, duplicate", [
+    ("(11-14-2022): Nvidia unveiled the H100 GPU at its GTC keynote", True),
+    ("(11-14-2022): OpenAI released GPT-4 to paying ChatGPT users", False),
+    # the same text under another date is a separate event
+    ("(03-21-2023): Nvidia announced the H100 GPU at GTC", False),
+    # without a date prefix only an exact match counts
+    ("Nvidia announced the H100 GPU at GTC!", False),
+])
+def test_note_threshold(scorer, note, duplicate):
+    index = NoteIndex(threshold=0.6)
+    index.add(NOTE)
+
+    match = index.find(note)
+    if duplicate:
+        assert match[0] == NOTE and match[1] >= 0.6
+    else:
+        assert match is None
+
+def test_note_threshold_is_on_the_rouge_l_score(scorer):
+    body = "Nvidia unveiled the H100 GPU at its GTC keynote"
+    score = scorer.score(NoteIndex.split_date(NOTE)[1], body)['rougeL'].fmeasure
+    assert 0.6 <= score < 1.0
+
+    note = f"(11-14-2022): {body}"
+    below, above = NoteIndex(threshold=score + 0.01), NoteIndex(threshold=score)
+    below.add(NOTE)
+    above.add(NOTE)
+    assert below.find(note) is None
+    assert above.find(note) == (NOTE, pytest.approx(score))
+
+def test_note_date_formats_are_equivalent(scorer):
+    index = NoteIndex()
+    index.add(NOTE)
+
+    # same day written as 11/14/2022 without parentheses
+    assert index.find("11/14/2022: Nvidia unveiled the H100 GPU at its GTC keynote")[0] == NOTE
+
+def test_copy_is_independent():
+    index = NoteIndex()
+    index.add(NOTE)
+    copy = index.copy()
+    copy.add("(12-01-2023): Mamba is released")
+
+    assert index.find("(12-01-2023): Mamba is released") is None
+    assert copy.find(NOTE) == (NOTE, 1.0)